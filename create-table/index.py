@@ -1,10 +1,13 @@
 import json
+import base64
 import mysql.connector
 import redis
 import requests
 import os
 import logging
 import time
+import re
+from datetime import date, timedelta
 import boto3
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger()
@@ -22,92 +25,162 @@ except redis.RedisError as e:
     logger.error(f"Failed to initialize Valkey connection: {e}")
     raise
 
-# Biến toàn cục để lưu token và thời gian hết hạn
-cached_token = None
-token_expiry = 0
+# Sharding theo customer_id: SHARD_BACKENDS (JSON) liệt kê các backend MySQL, mỗi phần tử gồm
+# host, port, database, user và password (bỏ trống password để dùng IAM token qua RDS Proxy).
+# Không đặt biến này thì chỉ có một backend là PROXY_ENDPOINT như trước.
+SHARD_SLOTS = int(os.environ.get('SHARD_SLOTS', 1024))
 
-def get_db_token():
-    global cached_token, token_expiry
+
+def load_shard_backends():
+    spec = os.environ.get('SHARD_BACKENDS')
+    if spec:
+        return json.loads(spec)
+    return [{
+        'host': os.environ.get('PROXY_ENDPOINT'),
+        'port': 3306,
+        'database': os.environ.get('DB_NAME'),
+        'user': os.environ.get('DB_USER'),
+    }]
+
+
+SHARD_BACKENDS = load_shard_backends()
+
+# Token IAM được cache theo từng host
+cached_tokens = {}
+
+def get_db_token(backend):
     current_time = time.time()
 
     # Kiểm tra nếu token còn hợp lệ (giả sử TTL là 840 giây để có buffer 60 giây trước khi hết hạn)
+    cached_token, token_expiry = cached_tokens.get(backend['host'], (None, 0))
     if cached_token and current_time < token_expiry:
         return cached_token
 
     # Tạo token mới
     rds_client = boto3.client('rds')
     cached_token = rds_client.generate_db_auth_token(
-        DBHostname=os.environ['PROXY_ENDPOINT'],
-        Port=3306,
-        DBUsername=os.environ['DB_USER'],
+        DBHostname=backend['host'],
+        Port=backend.get('port', 3306),
+        DBUsername=backend['user'],
         Region=os.environ['AWS_REGION']
     )
     # Cập nhật thời gian hết hạn (15 phút = 900 giây, trừ 60 giây để an toàn)
-    token_expiry = current_time + 840
+    cached_tokens[backend['host']] = (cached_token, current_time + 840)
     return cached_token
 
 
-def get_db_connection():
-    """Establish a MySQL database connection via RDS Proxy."""
+def get_db_connection(shard=0):
+    """Establish a MySQL database connection to one shard backend (RDS Proxy by default)."""
     try:
-        db_token = get_db_token()
-        # secret_dict = get_secret()
+        backend = SHARD_BACKENDS[shard]
         return mysql.connector.connect(
-            # host=os.environ.get('PROXY_ENDPOINT'),
-            # user=secret_dict['username'],
-            # password=secret_dict['password'],
-            # database=secret_dict['dbname'],
-            # port=int(secret_dict['port']),
-            # connection_timeout=10
-            host=os.environ['PROXY_ENDPOINT'],
-            port=3306,
-            user=os.environ['DB_USER'],
-            password=db_token,
-            database=os.environ['DB_NAME'],
+            host=backend['host'],
+            port=backend.get('port', 3306),
+            user=backend['user'],
+            password=backend.get('password') or get_db_token(backend),
+            database=backend['database'],
             connection_timeout=10
         )
     except mysql.connector.Error as e:
-        logger.error(f"Database connection error: {e}")
+        logger.error(f"Database connection error (shard {shard}): {e}")
         raise
     except Exception as e:
-        logger.error(f"Error creating database connection: {str(e)}")
+        logger.error(f"Error creating database connection (shard {shard}): {str(e)}")
         raise
 
-def create_orders_table():
-    CREATE_ORDERS_TABLE_SQL = """
-    CREATE TABLE IF NOT EXISTS orders (
-        order_id VARCHAR(36) NOT NULL,
-        customer_id VARCHAR(36) NOT NULL,
-        order_date DATETIME NOT NULL,
-        total_amount DECIMAL(10, 2) NOT NULL,
-        status ENUM('pending', 'processing', 'shipped', 'delivered', 'cancelled') NOT NULL,
-        shipping_address VARCHAR(255) NOT NULL,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
-        PRIMARY KEY (order_id, order_date),
-        INDEX idx_customer_id (customer_id),
-        INDEX idx_order_date (order_date),
-        INDEX idx_status (status),
-        INDEX idx_composite (customer_id, order_date, status)
-    ) PARTITION BY RANGE (TO_DAYS(order_date)) (
-        PARTITION p2023 VALUES LESS THAN (TO_DAYS('2024-01-01')),
-        PARTITION p2024 VALUES LESS THAN (TO_DAYS('2025-01-01')),
-        PARTITION p2025 VALUES LESS THAN (TO_DAYS('2026-01-01')),
-        PARTITION p_future VALUES LESS THAN (MAXVALUE)
-    );
-    """
+# Định dạng lưu order_id/customer_id: 'uuid' (VARCHAR(36)) hoặc 'binary' (BINARY(16), UUIDv7)
+ORDER_ID_FORMAT = os.environ.get('ORDER_ID_FORMAT', 'uuid')
+ID_COLUMN_TYPES = {'uuid': 'VARCHAR(36)', 'binary': 'BINARY(16)'}
+
+CREATE_ORDERS_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS {table} (
+    order_id {id_type} NOT NULL,
+    customer_id {id_type} NOT NULL,
+    order_date DATETIME NOT NULL,
+    total_amount DECIMAL(10, 2) NOT NULL,
+    status ENUM('pending', 'processing', 'shipped', 'delivered', 'cancelled') NOT NULL,
+    shipping_address VARCHAR(255) NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+    PRIMARY KEY (order_id, order_date),
+    INDEX idx_customer_id (customer_id),
+    INDEX idx_order_date (order_date),
+    INDEX idx_status (status),
+    INDEX idx_composite (customer_id, order_date, status)
+) PARTITION BY RANGE (TO_DAYS(order_date)) (
+    PARTITION p2023 VALUES LESS THAN (TO_DAYS('2024-01-01')),
+    PARTITION p2024 VALUES LESS THAN (TO_DAYS('2025-01-01')),
+    PARTITION p2025 VALUES LESS THAN (TO_DAYS('2026-01-01')),
+    PARTITION p_future VALUES LESS THAN (MAXVALUE)
+);
+"""
+
+# Bảng slot -> shard nằm trên shard 0; dòng thêm sau ghi đè dòng trước (xem reshard-orders)
+CREATE_SHARD_MAP_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS shard_map (
+    id INT AUTO_INCREMENT PRIMARY KEY,
+    slot_start INT NOT NULL,
+    slot_end INT NOT NULL,
+    shard INT NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+"""
+
+# Chỉ mục từ của shipping_address cho tìm kiếm địa chỉ (FULLTEXT không hỗ trợ bảng partition).
+# Collation mặc định utf8mb4_0900_ai_ci nên tìm "ha noi" khớp cả "Hà Nội".
+CREATE_ADDRESS_TOKENS_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS order_address_tokens (
+    token VARCHAR(32) NOT NULL,
+    order_id {id_type} NOT NULL,
+    order_date DATETIME NOT NULL,
+    PRIMARY KEY (token, order_id, order_date),
+    INDEX idx_order (order_id, order_date)
+);
+"""
+ADDRESS_TOKEN_MAX_LENGTH = 32
+ADDRESS_TOKEN_PATTERN = re.compile(r'[^\W_]+')
+INSERT_ADDRESS_TOKENS_SQL = "INSERT IGNORE INTO order_address_tokens (token, order_id, order_date) VALUES (%s, %s, %s)"
+
+
+def address_tokens(address):
+    """Split a shipping address into distinct lowercase word tokens of at least 2 characters."""
+    return sorted({
+        token[:ADDRESS_TOKEN_MAX_LENGTH] for token in ADDRESS_TOKEN_PATTERN.findall(str(address).lower()) if len(token) >= 2
+    })
+
+MIGRATION_TABLE = 'orders_binary'
+MIGRATION_BACKUP_TABLE = 'orders_uuid_backup'
+
+
+def create_orders_table(id_format=ORDER_ID_FORMAT):
+    if id_format not in ID_COLUMN_TYPES:
+        return {
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'statusCode': 400,
+            'body': json.dumps({'error': f"Invalid id_format '{id_format}', expected one of {sorted(ID_COLUMN_TYPES)}"})
+        }
+
     conn = None
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        logger.info("Executing CREATE TABLE statement for 'orders' table")
-        cursor.execute(CREATE_ORDERS_TABLE_SQL)
-        conn.commit()
-        logger.info("Table 'orders' created successfully")
+        for shard in range(len(SHARD_BACKENDS)):
+            conn = get_db_connection(shard)
+            cursor = conn.cursor()
+            logger.info(f"Executing CREATE TABLE statement for 'orders' table on shard {shard} (id_format={id_format})")
+            cursor.execute(CREATE_ORDERS_TABLE_SQL.format(table='orders', id_type=ID_COLUMN_TYPES[id_format]))
+            cursor.execute(CREATE_ADDRESS_TOKENS_TABLE_SQL.format(id_type=ID_COLUMN_TYPES[id_format]))
+            if shard == 0:
+                cursor.execute(CREATE_SHARD_MAP_TABLE_SQL)
+            conn.commit()
+            conn.close()
+        logger.info(f"Table 'orders' created successfully on {len(SHARD_BACKENDS)} shard(s)")
         return {
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
             'statusCode': 200,
-            'body': json.dumps({'message': 'Table "orders" created successfully!'})
+            'body': json.dumps({
+                'message': 'Table "orders" created successfully!',
+                'id_format': id_format,
+                'shards': len(SHARD_BACKENDS)
+            })
         }
     except mysql.connector.Error as e:
         logger.error(f"Database error when creating table: {e}")
@@ -128,10 +201,474 @@ def create_orders_table():
             conn.close()
             logger.info("Database connection closed")
 
+def migrate_orders_to_binary(batch_size, context=None, shard=0):
+    """Copy a VARCHAR(36) orders table into a BINARY(16) one and swap them.
+
+    Rows are copied in primary-key ranges with INSERT IGNORE, so the migration can be
+    re-invoked until it reports 'completed'; each call stops before the Lambda timeout.
+    Writes to 'orders' should be paused while the migration runs. With several shards
+    the migration is run once per shard. Archived orders keep their VARCHAR(36) ids, so the
+    migration is refused while orders_archive has rows; an empty archive is recreated with
+    BINARY(16) ids so EXCHANGE PARTITION and federated reads still match.
+    """
+    conn = None
+    try:
+        conn = get_db_connection(shard)
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT DATA_TYPE FROM information_schema.COLUMNS "
+            "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'orders' AND COLUMN_NAME = 'order_id'"
+        )
+        row = cursor.fetchone()
+        if row is None or row[0] == 'binary':
+            return {
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'statusCode': 409,
+                'body': json.dumps({'error': 'Table "orders" is missing or already uses BINARY(16) ids'})
+            }
+        if table_exists(cursor, ARCHIVE_TABLE):
+            cursor.execute(f"SELECT EXISTS (SELECT 1 FROM {ARCHIVE_TABLE})")
+            if cursor.fetchone()[0]:
+                return {
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'statusCode': 409,
+                    'body': json.dumps({'error': f'Table "{ARCHIVE_TABLE}" has archived orders with VARCHAR(36) ids'})
+                }
+
+        cursor.execute(CREATE_ORDERS_TABLE_SQL.format(table=MIGRATION_TABLE, id_type=ID_COLUMN_TYPES['binary']))
+        cursor.execute(f"SELECT BIN_TO_UUID(MAX(order_id)) FROM {MIGRATION_TABLE}")
+        last_order_id = cursor.fetchone()[0] or ''
+
+        copied = 0
+        while True:
+            if context and context.get_remaining_time_in_millis() < 5000:
+                logger.info(f"Stopping migration before timeout after {copied} rows, resume from {last_order_id}")
+                return {
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'statusCode': 202,
+                    'body': json.dumps({'status': 'in_progress', 'shard': shard, 'copied': copied, 'last_order_id': last_order_id})
+                }
+
+            cursor.execute(
+                "SELECT order_id FROM orders WHERE order_id > %s ORDER BY order_id LIMIT 1 OFFSET %s",
+                (last_order_id, batch_size - 1)
+            )
+            upper = cursor.fetchone()
+            range_sql = "order_id > %s" + (" AND order_id <= %s" if upper else "")
+            range_params = (last_order_id, upper[0]) if upper else (last_order_id,)
+            cursor.execute(
+                f"INSERT IGNORE INTO {MIGRATION_TABLE} "
+                "(order_id, customer_id, order_date, total_amount, status, shipping_address, created_at, updated_at) "
+                "SELECT UUID_TO_BIN(order_id), UUID_TO_BIN(customer_id), order_date, total_amount, status, "
+                f"shipping_address, created_at, updated_at FROM orders WHERE {range_sql}",
+                range_params
+            )
+            conn.commit()
+            copied += cursor.rowcount
+            if not upper:
+                break
+            last_order_id = upper[0]
+
+        cursor.execute(f"RENAME TABLE orders TO {MIGRATION_BACKUP_TABLE}, {MIGRATION_TABLE} TO orders")
+        # Chỉ mục địa chỉ giữ khóa dạng chuỗi nên được tạo lại rỗng; chạy action 'index_addresses' để nạp lại
+        cursor.execute("DROP TABLE IF EXISTS order_address_tokens")
+        cursor.execute(CREATE_ADDRESS_TOKENS_TABLE_SQL.format(id_type=ID_COLUMN_TYPES['binary']))
+        # orders_archive rỗng (đã kiểm tra ở trên) được tạo lại cùng kiểu id với bảng nóng
+        if table_exists(cursor, ARCHIVE_TABLE):
+            cursor.execute(f"DROP TABLE {ARCHIVE_TABLE}")
+            cursor.execute(CREATE_ARCHIVE_TABLE_SQL.format(id_type=ID_COLUMN_TYPES['binary']))
+        logger.info(f"Migration completed, old table kept as '{MIGRATION_BACKUP_TABLE}'")
+        return {
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'statusCode': 200,
+            'body': json.dumps({'status': 'completed', 'shard': shard, 'copied': copied, 'backup_table': MIGRATION_BACKUP_TABLE})
+        }
+    except mysql.connector.Error as e:
+        logger.error(f"Database error during migration: {e}")
+        return {
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'statusCode': 500,
+            'body': json.dumps({'error': f'Database error: {e}'})
+        }
+    except Exception as e:
+        logger.error(f"Unexpected error during migration: {e}")
+        return {
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'statusCode': 500,
+            'body': json.dumps({'error': f'Unexpected error: {e}'})
+        }
+    finally:
+        if conn and conn.is_connected():
+            conn.close()
+            logger.info("Database connection closed")
+
+# Lưu trữ partition cũ: dữ liệu được chép sang bảng nén orders_archive rồi partition được EXCHANGE ra
+# một bảng staging, để bảng nóng không còn giữ dữ liệu cũ trong buffer pool. query-operations đọc
+# orders_archive_ranges để chỉ truy vấn bảng archive khi khoảng ngày yêu cầu giao với dữ liệu đã lưu trữ.
+ARCHIVE_TABLE = 'orders_archive'
+ARCHIVE_AFTER_DAYS = int(os.environ.get('ARCHIVE_AFTER_DAYS', 365))
+ARCHIVE_BATCH_SIZE = int(os.environ.get('ARCHIVE_BATCH_SIZE', 5000))
+ARCHIVE_COLUMNS = ('order_id', 'customer_id', 'order_date', 'total_amount', 'status',
+                   'shipping_address', 'created_at', 'updated_at')
+
+CREATE_ARCHIVE_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS orders_archive (
+    order_id {id_type} NOT NULL,
+    customer_id {id_type} NOT NULL,
+    order_date DATETIME NOT NULL,
+    total_amount DECIMAL(10, 2) NOT NULL,
+    status ENUM('pending', 'processing', 'shipped', 'delivered', 'cancelled') NOT NULL,
+    shipping_address VARCHAR(255) NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+    PRIMARY KEY (order_id, order_date),
+    INDEX idx_order_date (order_date),
+    INDEX idx_composite (customer_id, order_date, status)
+) ROW_FORMAT=COMPRESSED KEY_BLOCK_SIZE=8;
+"""
+
+CREATE_ARCHIVE_RANGES_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS orders_archive_ranges (
+    partition_name VARCHAR(64) PRIMARY KEY,
+    range_start DATE NOT NULL,
+    range_end DATE NOT NULL,
+    status ENUM('copying', 'archived') NOT NULL,
+    row_count BIGINT NOT NULL DEFAULT 0,
+    archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+);
+"""
+
+
+def table_exists(cursor, table):
+    cursor.execute(
+        "SELECT COUNT(*) FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s",
+        (table,)
+    )
+    return cursor.fetchone()[0] > 0
+
+
+def archive_partition(conn, partition, range_start, range_end, batch_size, context=None):
+    """Archive one partition of orders; returns the archived row count, or None when out of time.
+
+    The range is registered as 'copying' before the exchange so readers federate to the archive
+    while the partition is emptied (they de-duplicate rows present in both tables). Re-running
+    resumes: the copy restarts after the highest archived order_id, and a non-empty staging table
+    means the exchange already happened. Address tokens of the archived orders are deleted, since
+    search only covers the hot table.
+    """
+    cursor = conn.cursor()
+    staging = f"orders_exchange_{partition}"
+    columns = ', '.join(ARCHIVE_COLUMNS)
+    cursor.execute(
+        "INSERT INTO orders_archive_ranges (partition_name, range_start, range_end, status) "
+        "VALUES (%s, %s, %s, 'copying') ON DUPLICATE KEY UPDATE status = status",
+        (partition, range_start, range_end)
+    )
+    conn.commit()
+
+    if not table_exists(cursor, staging):
+        cursor.execute(
+            f"SELECT MAX(order_id) FROM {ARCHIVE_TABLE} WHERE order_date >= %s AND order_date < %s",
+            (range_start, range_end)
+        )
+        last_order_id = cursor.fetchone()[0] or ''
+        while True:
+            if context and context.get_remaining_time_in_millis() < 10000:
+                logger.info(f"Stopping archive of {partition} before timeout")
+                return None
+            cursor.execute(
+                f"SELECT order_id FROM orders PARTITION (`{partition}`) WHERE order_id > %s "
+                "ORDER BY order_id LIMIT 1 OFFSET %s",
+                (last_order_id, batch_size - 1)
+            )
+            upper = cursor.fetchone()
+            range_sql = "order_id > %s" + (" AND order_id <= %s" if upper else "")
+            range_params = (last_order_id, upper[0]) if upper else (last_order_id,)
+            cursor.execute(
+                f"INSERT IGNORE INTO {ARCHIVE_TABLE} ({columns}) "
+                f"SELECT {columns} FROM orders PARTITION (`{partition}`) WHERE {range_sql}",
+                range_params
+            )
+            conn.commit()
+            if not upper:
+                break
+            last_order_id = upper[0]
+        cursor.execute(f"CREATE TABLE {staging} LIKE orders")
+        cursor.execute(f"ALTER TABLE {staging} REMOVE PARTITIONING")
+
+    cursor.execute(f"SELECT EXISTS (SELECT 1 FROM {staging})")
+    if not cursor.fetchone()[0]:
+        # Chỉ đổi metadata: partition trở thành bảng staging, partition trong bảng nóng còn rỗng
+        cursor.execute(f"ALTER TABLE orders EXCHANGE PARTITION `{partition}` WITH TABLE {staging}")
+        logger.info(f"Exchanged partition {partition} out of 'orders'")
+
+    # Đồng bộ các thay đổi xảy ra trong lúc copy: staging là bản chính xác cuối cùng của partition
+    cursor.execute(
+        f"REPLACE INTO {ARCHIVE_TABLE} ({columns}) "
+        f"SELECT {', '.join('s.' + column for column in ARCHIVE_COLUMNS)} FROM {staging} s "
+        f"LEFT JOIN {ARCHIVE_TABLE} a ON a.order_id = s.order_id AND a.order_date = s.order_date "
+        "WHERE a.order_id IS NULL OR a.updated_at <> s.updated_at"
+    )
+    cursor.execute(
+        f"DELETE a FROM {ARCHIVE_TABLE} a "
+        f"LEFT JOIN {staging} s ON s.order_id = a.order_id AND s.order_date = a.order_date "
+        "WHERE a.order_date >= %s AND a.order_date < %s AND s.order_id IS NULL",
+        (range_start, range_end)
+    )
+    # Tìm kiếm địa chỉ chỉ phủ bảng nóng: xóa token của các đơn đã lưu trữ theo từng lô khóa của staging
+    if table_exists(cursor, 'order_address_tokens'):
+        last_order_id = ''
+        while True:
+            if context and context.get_remaining_time_in_millis() < 10000:
+                logger.info(f"Stopping address token cleanup of {partition} before timeout")
+                conn.commit()
+                return None
+            cursor.execute(
+                f"SELECT order_id FROM {staging} WHERE order_id > %s ORDER BY order_id LIMIT 1 OFFSET %s",
+                (last_order_id, batch_size - 1)
+            )
+            upper = cursor.fetchone()
+            range_sql = "s.order_id > %s" + (" AND s.order_id <= %s" if upper else "")
+            range_params = (last_order_id, upper[0]) if upper else (last_order_id,)
+            cursor.execute(
+                f"DELETE t FROM order_address_tokens t JOIN {staging} s "
+                f"ON t.order_id = s.order_id AND t.order_date = s.order_date WHERE {range_sql}",
+                range_params
+            )
+            conn.commit()
+            if not upper:
+                break
+            last_order_id = upper[0]
+    cursor.execute(f"SELECT COUNT(*) FROM {staging}")
+    row_count = cursor.fetchone()[0]
+    cursor.execute(
+        "UPDATE orders_archive_ranges SET status = 'archived', row_count = %s WHERE partition_name = %s",
+        (row_count, partition)
+    )
+    conn.commit()
+    cursor.execute(f"DROP TABLE {staging}")
+    cursor.close()
+    return row_count
+
+
+def archive_old_partitions(older_than_days, batch_size, context=None, shard=0):
+    """Archive every partition of orders whose upper bound is older than older_than_days.
+
+    Partitions are processed oldest first; re-invoke while the result is 'in_progress'.
+    With several shards the archiver is run once per shard.
+    """
+    conn = None
+    try:
+        conn = get_db_connection(shard)
+        cursor = conn.cursor()
+        cursor.execute(CREATE_ARCHIVE_TABLE_SQL.format(id_type=ID_COLUMN_TYPES[ORDER_ID_FORMAT]))
+        cursor.execute(CREATE_ARCHIVE_RANGES_TABLE_SQL)
+        cursor.execute("SELECT partition_name FROM orders_archive_ranges WHERE status = 'archived'")
+        archived = {row[0] for row in cursor.fetchall()}
+        cursor.execute(
+            "SELECT PARTITION_NAME, PARTITION_DESCRIPTION FROM information_schema.PARTITIONS "
+            "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'orders' ORDER BY PARTITION_ORDINAL_POSITION"
+        )
+        partitions = cursor.fetchall()
+        cursor.close()
+
+        cutoff = date.today() - timedelta(days=older_than_days)
+        range_start = date(1000, 1, 1)
+        results = []
+        for partition, description in partitions:
+            if description == 'MAXVALUE':
+                break
+            # PARTITION_DESCRIPTION là TO_DAYS(cận trên); TO_DAYS lệch 365 so với date.toordinal()
+            range_end = date.fromordinal(int(description) - 365)
+            if range_end > cutoff:
+                break
+            if partition not in archived:
+                row_count = archive_partition(conn, partition, range_start, range_end, batch_size, context)
+                if row_count is None:
+                    return {
+                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                        'statusCode': 202,
+                        'body': json.dumps({'status': 'in_progress', 'shard': shard, 'archived': results, 'partition': partition})
+                    }
+                results.append({'partition': partition, 'range_start': str(range_start), 'range_end': str(range_end), 'rows': row_count})
+                logger.info(f"Archived partition {partition} ({row_count} rows) on shard {shard}")
+            range_start = range_end
+        return {
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'statusCode': 200,
+            'body': json.dumps({'status': 'completed', 'shard': shard, 'archived': results, 'cutoff': str(cutoff)})
+        }
+    except mysql.connector.Error as e:
+        logger.error(f"Database error during archiving: {e}")
+        return {
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'statusCode': 500,
+            'body': json.dumps({'error': f'Database error: {e}'})
+        }
+    except Exception as e:
+        logger.error(f"Unexpected error during archiving: {e}")
+        return {
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'statusCode': 500,
+            'body': json.dumps({'error': f'Unexpected error: {e}'})
+        }
+    finally:
+        if conn and conn.is_connected():
+            conn.close()
+            logger.info("Database connection closed")
+
+def index_order_addresses(batch_size, context=None, shard=0, after=None):
+    """Create order_address_tokens if needed and backfill it from existing orders in primary-key order.
+
+    Orders written after the table exists are indexed by the write paths; this only covers older
+    rows. Re-invoke with the returned 'after' while the status is 'in_progress'.
+    """
+    conn = None
+    try:
+        conn = get_db_connection(shard)
+        cursor = conn.cursor()
+        cursor.execute(CREATE_ADDRESS_TOKENS_TABLE_SQL.format(id_type=ID_COLUMN_TYPES[ORDER_ID_FORMAT]))
+        last_key = None
+        if after:
+            order_id = bytes.fromhex(after['order_id']) if ORDER_ID_FORMAT == 'binary' else after['order_id']
+            last_key = (order_id, after['order_date'])
+
+        indexed = 0
+        while True:
+            if context and context.get_remaining_time_in_millis() < 5000:
+                resume = {
+                    'order_id': last_key[0].hex() if isinstance(last_key[0], (bytes, bytearray)) else last_key[0],
+                    'order_date': str(last_key[1])
+                }
+                logger.info(f"Stopping address indexing before timeout after {indexed} orders, resume after {resume}")
+                return {
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'statusCode': 202,
+                    'body': json.dumps({'status': 'in_progress', 'shard': shard, 'indexed': indexed, 'after': resume})
+                }
+            sql = "SELECT order_id, order_date, shipping_address FROM orders"
+            params = []
+            if last_key:
+                sql += " WHERE (order_id, order_date) > (%s, %s)"
+                params.extend(last_key)
+            cursor.execute(sql + " ORDER BY order_id, order_date LIMIT %s", params + [batch_size])
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            token_rows = [
+                (token, order_id, order_date) for order_id, order_date, address in rows for token in address_tokens(address)
+            ]
+            if token_rows:
+                cursor.executemany(INSERT_ADDRESS_TOKENS_SQL, token_rows)
+            conn.commit()
+            indexed += len(rows)
+            last_key = rows[-1][:2]
+
+        logger.info(f"Indexed shipping addresses of {indexed} orders on shard {shard}")
+        return {
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'statusCode': 200,
+            'body': json.dumps({'status': 'completed', 'shard': shard, 'indexed': indexed})
+        }
+    except mysql.connector.Error as e:
+        logger.error(f"Database error during address indexing: {e}")
+        return {
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'statusCode': 500,
+            'body': json.dumps({'error': f'Database error: {e}'})
+        }
+    except Exception as e:
+        logger.error(f"Unexpected error during address indexing: {e}")
+        return {
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'statusCode': 500,
+            'body': json.dumps({'error': f'Unexpected error: {e}'})
+        }
+    finally:
+        if conn and conn.is_connected():
+            conn.close()
+            logger.info("Database connection closed")
+
+def get_table_stats():
+    """Report row count, data and index size of the orders tables on every shard for before/after comparisons."""
+    conn = None
+    try:
+        tables = []
+        for shard in range(len(SHARD_BACKENDS)):
+            conn = get_db_connection(shard)
+            cursor = conn.cursor()
+            cursor.execute("ANALYZE TABLE orders")
+            cursor.fetchall()
+            cursor.execute(
+                "SELECT TABLE_NAME, TABLE_ROWS, DATA_LENGTH, INDEX_LENGTH FROM information_schema.TABLES "
+                "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME IN (%s, %s, %s, %s, %s)",
+                ('orders', MIGRATION_TABLE, MIGRATION_BACKUP_TABLE, ARCHIVE_TABLE, 'order_address_tokens')
+            )
+            tables += [
+                {'shard': shard, 'table': name, 'rows': rows, 'data_bytes': data_length, 'index_bytes': index_length}
+                for name, rows, data_length, index_length in cursor.fetchall()
+            ]
+            conn.close()
+        return {
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'statusCode': 200,
+            'body': json.dumps({'tables': tables})
+        }
+    except mysql.connector.Error as e:
+        logger.error(f"Database error when reading table stats: {e}")
+        return {
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'statusCode': 500,
+            'body': json.dumps({'error': f'Database error: {e}'})
+        }
+    except Exception as e:
+        logger.error(f"Unexpected error when reading table stats: {e}")
+        return {
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'statusCode': 500,
+            'body': json.dumps({'error': f'Unexpected error: {e}'})
+        }
+    finally:
+        if conn and conn.is_connected():
+            conn.close()
+            logger.info("Database connection closed")
+
+def request_body(event):
+    """Decode the API Gateway request body, which arrives base64-encoded because of BinaryMediaTypes."""
+    body = event.get('body')
+    if isinstance(body, str) and event.get('isBase64Encoded'):
+        body = base64.b64decode(body).decode('utf-8')
+    return body
+
 def lambda_handler(event, context):
     logger.info(f"Received event: {json.dumps(event, default=str)}")
     try:
-        return create_orders_table()
+        raw_body = request_body(event)
+        body = {} if raw_body is None else json.loads(raw_body)
+        action = body.get('action', 'create')
+        if action == 'create':
+            return create_orders_table(body.get('id_format', ORDER_ID_FORMAT))
+        elif action == 'migrate_to_binary':
+            return migrate_orders_to_binary(int(body.get('batch_size', 5000)), context, int(body.get('shard', 0)))
+        elif action == 'archive':
+            return archive_old_partitions(
+                int(body.get('older_than_days', ARCHIVE_AFTER_DAYS)),
+                int(body.get('batch_size', ARCHIVE_BATCH_SIZE)),
+                context,
+                int(body.get('shard', 0))
+            )
+        elif action == 'index_addresses':
+            return index_order_addresses(
+                int(body.get('batch_size', 5000)), context, int(body.get('shard', 0)), body.get('after')
+            )
+        elif action == 'stats':
+            return get_table_stats()
+        else:
+            return {
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'statusCode': 400,
+                'body': json.dumps({'error': f'Unknown action {action}'})
+            }
     except Exception as e:
         logger.error(f"Unexpected error in lambda_handler: {str(e)}", exc_info=True)
         return {
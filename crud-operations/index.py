@@ -1,21 +1,169 @@
 import json
 import mysql.connector
 import redis
+from redis.backoff import NoBackoff
+from redis.retry import Retry
 import requests
 import os
 import logging
 import time
 import uuid
+import hashlib
+import heapq
+import itertools
+import zlib
+import gzip
+import base64
+from concurrent.futures import ThreadPoolExecutor
+import random
+import threading
+import re
+from datetime import datetime, timezone
+from decimal import Decimal
 import time
 import boto3
+try:
+    import brotli
+except ImportError:
+    brotli = None
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger()
 
+# Circuit breaker theo từng dependency, giữ trong module state giữa các lần gọi (warm container).
+# Khi Valkey/MySQL lỗi liên tiếp, request bỏ qua dependency đó ngay thay vì chờ hết timeout.
+BREAKER_FAILURE_THRESHOLD = int(os.environ.get('BREAKER_FAILURE_THRESHOLD', 3))
+BREAKER_RESET_SECONDS = float(os.environ.get('BREAKER_RESET_SECONDS', 10))
+VALKEY_SOCKET_TIMEOUT = float(os.environ.get('VALKEY_SOCKET_TIMEOUT', 0.25))
+VALKEY_CONNECT_TIMEOUT = float(os.environ.get('VALKEY_CONNECT_TIMEOUT', 0.5))
+DB_CONNECT_TIMEOUT = int(os.environ.get('DB_CONNECT_TIMEOUT', 3))
+# Timeout đọc/ghi socket cho từng câu lệnh, tách khỏi timeout kết nối để truy vấn dài hợp lệ không bị cắt
+DB_READ_TIMEOUT = int(os.environ.get('DB_READ_TIMEOUT', 20))
+BREAKER_STATE_VALUES = {'closed': 0, 'half_open': 1, 'open': 2}
+
+
+class CircuitBreaker:
+    """Fail fast on a dependency after repeated connection failures.
+
+    closed -> open after `failure_threshold` consecutive failures. Once `reset_seconds`
+    have passed, a single call is let through as a half-open probe: success closes the
+    breaker, failure opens it again, and other calls are rejected while it runs. Calls
+    rejected while open raise `open_error`, a subclass of the dependency's own error type
+    so existing fallbacks handle it. `ignored_errors` (e.g. a slow statement hitting its
+    read timeout) count neither as a failure nor as a success.
+    The breaker is shared by request and scatter threads, so its state is kept under a lock.
+    """
+
+    def __init__(self, name, failure_errors, open_error, failure_threshold, reset_seconds, ignored_errors=()):
+        self.name = name
+        self.failure_errors = failure_errors
+        self.ignored_errors = ignored_errors
+        self.open_error = open_error
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0
+        self.lock = threading.Lock()
+
+    def call(self, func, *args, **kwargs):
+        probe = False
+        with self.lock:
+            if self.state == 'half_open' or (self.state == 'open' and time.time() - self.opened_at < self.reset_seconds):
+                emit_metric('CircuitBreakerRejected', 1, Dependency=self.name)
+                raise self.open_error(f"Circuit breaker '{self.name}' is {self.state.replace('_', '-')}")
+            if self.state == 'open':
+                self._transition('half_open')
+                probe = True
+        try:
+            result = func(*args, **kwargs)
+        except self.ignored_errors:
+            # Probe nhận được phản hồi chậm: dependency vẫn kết nối được nên không giữ breaker ở half-open
+            if probe:
+                with self.lock:
+                    self._record_success()
+            raise
+        except self.failure_errors:
+            with self.lock:
+                self._record_failure()
+            raise
+        except Exception:
+            # Dependency đã phản hồi (ví dụ lỗi cú pháp), nên vẫn tính là còn sống
+            with self.lock:
+                self._record_success()
+            raise
+        with self.lock:
+            self._record_success()
+        return result
+
+    def _record_success(self):
+        self.failures = 0
+        if self.state != 'closed':
+            self._transition('closed')
+
+    def _record_failure(self):
+        self.failures += 1
+        if self.state == 'half_open' or self.failures >= self.failure_threshold:
+            self.opened_at = time.time()
+            if self.state != 'open':
+                self._transition('open')
+
+    def _transition(self, state):
+        logger.warning(f"Circuit breaker '{self.name}': {self.state} -> {state} after {self.failures} failure(s)")
+        self.state = state
+        emit_metric('CircuitBreakerState', BREAKER_STATE_VALUES[state], 'None', Dependency=self.name)
+
+
+class ValkeyCircuitOpenError(redis.ConnectionError):
+    pass
+
+
+class DatabaseCircuitOpenError(mysql.connector.errors.OperationalError):
+    pass
+
+
+valkey_breaker = CircuitBreaker(
+    'valkey', (redis.ConnectionError, redis.TimeoutError), ValkeyCircuitOpenError,
+    BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_SECONDS
+)
+db_breakers = {}
+
+
+def db_breaker(shard=0):
+    """Breaker of one MySQL backend, so a failing shard does not cut off the others."""
+    if shard not in db_breakers:
+        db_breakers[shard] = CircuitBreaker(
+            'mysql' if len(SHARD_BACKENDS) == 1 else f"mysql-{shard}",
+            (mysql.connector.errors.InterfaceError, mysql.connector.errors.OperationalError,
+             mysql.connector.errors.ConnectionTimeoutError),
+            DatabaseCircuitOpenError, BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_SECONDS,
+            ignored_errors=(mysql.connector.errors.ReadTimeoutError, mysql.connector.errors.WriteTimeoutError)
+        )
+    return db_breakers[shard]
+
+
+class GuardedPipeline(redis.client.Pipeline):
+    def execute(self, raise_on_error=True):
+        return valkey_breaker.call(super().execute, raise_on_error)
+
+
+class GuardedRedis(redis.Redis):
+    """Valkey client whose commands, scripts and pipelines go through valkey_breaker."""
+
+    def execute_command(self, *args, **options):
+        return valkey_breaker.call(super().execute_command, *args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return GuardedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
 try:
-    primary_cache = redis.Redis(
+    primary_cache = GuardedRedis(
         host=os.environ['VALKEY_PRIMARY_ENDPOINT'],
         port=6379,
         decode_responses=True,
+        socket_timeout=VALKEY_SOCKET_TIMEOUT,
+        socket_connect_timeout=VALKEY_CONNECT_TIMEOUT,
+        # Không retry trong client: circuit breaker quyết định khi nào thử lại
+        retry=Retry(NoBackoff(), 0),
         ssl=True,
         username=os.environ['VALKEY_USER_NAME'],
         password=os.environ['VALKEY_PASSWORD']
@@ -24,58 +172,1037 @@ except redis.RedisError as e:
     logger.error(f"Failed to initialize Valkey connection: {e}")
     raise
 
-# Biến toàn cục để lưu token và thời gian hết hạn
-cached_token = None
-token_expiry = 0
+# Sharding theo customer_id: SHARD_BACKENDS (JSON) liệt kê các backend MySQL, mỗi phần tử gồm
+# host, port, database, user và password (bỏ trống password để dùng IAM token qua RDS Proxy).
+# Không đặt biến này thì chỉ có một backend là PROXY_ENDPOINT như trước.
+SHARD_SLOTS = int(os.environ.get('SHARD_SLOTS', 1024))
+SHARD_MAP_REFRESH_SECONDS = int(os.environ.get('SHARD_MAP_REFRESH_SECONDS', 30))
+
+
+def load_shard_backends():
+    spec = os.environ.get('SHARD_BACKENDS')
+    if spec:
+        return json.loads(spec)
+    return [{
+        'host': os.environ.get('PROXY_ENDPOINT'),
+        'port': 3306,
+        'database': os.environ.get('DB_NAME'),
+        'user': os.environ.get('DB_USER'),
+    }]
+
+
+SHARD_BACKENDS = load_shard_backends()
+
+# Token IAM được cache theo từng host
+cached_tokens = {}
 
-def get_db_token():
-    global cached_token, token_expiry
+def get_db_token(backend):
     current_time = time.time()
 
     # Kiểm tra nếu token còn hợp lệ (giả sử TTL là 840 giây để có buffer 60 giây trước khi hết hạn)
+    cached_token, token_expiry = cached_tokens.get(backend['host'], (None, 0))
     if cached_token and current_time < token_expiry:
         return cached_token
 
     # Tạo token mới
     rds_client = boto3.client('rds')
     cached_token = rds_client.generate_db_auth_token(
-        DBHostname=os.environ['PROXY_ENDPOINT'],
-        Port=3306,
-        DBUsername=os.environ['DB_USER'],
+        DBHostname=backend['host'],
+        Port=backend.get('port', 3306),
+        DBUsername=backend['user'],
         Region=os.environ['AWS_REGION']
     )
     # Cập nhật thời gian hết hạn (15 phút = 900 giây, trừ 60 giây để an toàn)
-    token_expiry = current_time + 840
+    cached_tokens[backend['host']] = (cached_token, current_time + 840)
     return cached_token
 
 
-def get_db_connection():
-    """Establish a MySQL database connection via RDS Proxy."""
+def get_db_connection(shard=0, autocommit=False):
+    """Establish a MySQL database connection to one shard backend (RDS Proxy by default)."""
     try:
-        db_token = get_db_token()
-        # secret_dict = get_secret()
-        return mysql.connector.connect(
-            # host=os.environ.get('PROXY_ENDPOINT'),
-            # user=secret_dict['username'],
-            # password=secret_dict['password'],
-            # database=secret_dict['dbname'],
-            # port=int(secret_dict['port']),
-            # connection_timeout=10
-            host=os.environ['PROXY_ENDPOINT'],
-            port=3306,
-            user=os.environ['DB_USER'],
-            password=db_token,
-            database=os.environ['DB_NAME'],
-            connection_timeout=10
+        backend = SHARD_BACKENDS[shard]
+        return db_breaker(shard).call(
+            mysql.connector.connect,
+            host=backend['host'],
+            port=backend.get('port', 3306),
+            user=backend['user'],
+            password=backend.get('password') or get_db_token(backend),
+            database=backend['database'],
+            # connection_timeout chỉ áp dụng khi kết nối; câu lệnh dùng read/write timeout riêng
+            connection_timeout=DB_CONNECT_TIMEOUT,
+            read_timeout=DB_READ_TIMEOUT,
+            write_timeout=DB_READ_TIMEOUT,
+            autocommit=autocommit
         )
     except mysql.connector.Error as e:
-        logger.error(f"Database connection error: {e}")
+        logger.error(f"Database connection error (shard {shard}): {e}")
         raise
     except Exception as e:
-        logger.error(f"Error creating database connection: {str(e)}")
+        logger.error(f"Error creating database connection (shard {shard}): {str(e)}")
+        raise
+
+# Kết nối được giữ lại giữa các lần gọi (warm container) để tái sử dụng prepared statement.
+# RDS Proxy ghim (pin) session khi client dùng prepared statement, vì vậy kết nối được đóng khi
+# rảnh quá PREPARED_IDLE_SECONDS (nhỏ hơn IdleClientTimeout của proxy) và có thể tắt hẳn bằng
+# PREPARED_STATEMENTS=off để quay về text protocol (không bị ghim).
+PREPARED_STATEMENTS = os.environ.get('PREPARED_STATEMENTS', 'on') == 'on'
+PREPARED_IDLE_SECONDS = int(os.environ.get('PREPARED_IDLE_SECONDS', 45))
+# ER_UNSUPPORTED_PS, ER_MAX_PREPARED_STMT_COUNT_REACHED: chuyển sang text protocol cho container này
+PREPARED_FALLBACK_ERRNOS = {1295, 1461}
+# CR_SERVER_GONE_ERROR, CR_SERVER_LOST, CR_SERVER_LOST_EXTENDED: kết nối giữ lại đã bị đóng phía server/proxy
+CONNECTION_LOST_ERRNOS = {2006, 2013, 2055}
+
+pooled_conns = {}
+pooled_conn_last_used = {}
+statement_caches = {}
+prepared_enabled = PREPARED_STATEMENTS
+# scatter chạy execute_statement trên nhiều luồng (mỗi shard một luồng): các dict dùng chung và cờ
+# prepared_enabled chỉ được sửa khi giữ lock; kết nối được mở và đóng ngoài lock
+pool_lock = threading.Lock()
+
+
+def get_pooled_connection(shard=0):
+    """Return the shard's connection kept across warm invocations, reconnecting after PREPARED_IDLE_SECONDS.
+
+    The connection runs in autocommit mode so every read sees current data instead of a
+    REPEATABLE READ snapshot held across invocations; writes open an explicit transaction.
+    It is not pinged before use: execute_statement reconnects when a statement finds it closed.
+    """
+    now = time.time()
+    with pool_lock:
+        conn = pooled_conns.get(shard)
+        expired = conn is not None and now - pooled_conn_last_used[shard] > PREPARED_IDLE_SECONDS
+    if expired:
+        close_pooled_connection(shard)
+        conn = None
+    if conn is None:
+        conn = get_db_connection(shard, autocommit=True)
+        with pool_lock:
+            pooled_conns[shard] = conn
+            statement_caches[shard] = {}
+    with pool_lock:
+        pooled_conn_last_used[shard] = now
+    return conn
+
+
+def close_pooled_connection(shard=None):
+    """Close the pooled connection of one shard (all shards by default) and drop its prepared statements."""
+    with pool_lock:
+        closing = [shard] if shard is not None else list(pooled_conns)
+        conns = [pooled_conns.pop(closing_shard, None) for closing_shard in closing]
+        for closing_shard in closing:
+            statement_caches.pop(closing_shard, None)
+    for conn in conns:
+        if conn is not None:
+            try:
+                conn.close()
+                logger.info("Database connection closed")
+            except mysql.connector.Error as e:
+                logger.error(f"Error closing database connection: {e}")
+
+
+def execute_statement(sql, params, shard=0):
+    """Execute a hot statement on a shard's pooled connection, prepared server-side when enabled.
+
+    sql must be one of the module-level *_SQL constants: a prepared cursor only skips
+    re-preparing when it is given the same string object again.
+    """
+    in_transaction = shard in pooled_conns and pooled_conns[shard].in_transaction
+    try:
+        return run_statement(sql, params, shard)
+    except (mysql.connector.errors.ReadTimeoutError, mysql.connector.errors.WriteTimeoutError):
+        # Connector đã đóng kết nối sau timeout; bỏ nó khỏi pool để lần sau mở kết nối mới
+        close_pooled_connection(shard)
         raise
+    except mysql.connector.Error as e:
+        # Kết nối đã đóng (proxy hết idle timeout, failover): mở lại và chạy lại một lần.
+        # Không chạy lại bên trong transaction vì các câu lệnh trước đó đã mất cùng kết nối
+        if e.errno not in CONNECTION_LOST_ERRNOS or in_transaction:
+            raise
+        logger.warning(f"Pooled connection to shard {shard} was lost ({e}), reconnecting")
+        close_pooled_connection(shard)
+        return run_statement(sql, params, shard)
+
+
+def begin_transaction(shard=0):
+    """Start a transaction on the shard's pooled connection and return it.
+
+    Statements run through execute_statement stay on this connection until it is committed
+    (no reconnect or prepared-statement fallback inside a transaction), so the caller commits
+    the returned connection rather than looking the pooled one up again.
+    """
+    conn = get_pooled_connection(shard)
+    try:
+        if conn.in_transaction:
+            # Transaction bỏ dở từ lần gọi lỗi trước: hủy để không commit lẫn ghi cũ
+            conn.rollback()
+        conn.start_transaction()
+    except mysql.connector.Error as e:
+        if e.errno not in CONNECTION_LOST_ERRNOS:
+            raise
+        logger.warning(f"Pooled connection to shard {shard} was lost ({e}), reconnecting")
+        close_pooled_connection(shard)
+        conn = get_pooled_connection(shard)
+        conn.start_transaction()
+    return conn
+
+
+def run_statement(sql, params, shard=0):
+    global prepared_enabled
+    conn = get_pooled_connection(shard)
+    if prepared_enabled:
+        try:
+            with pool_lock:
+                cache = statement_caches.setdefault(shard, {})
+                cursor = cache.get(sql)
+            if cursor is None:
+                cursor = conn.cursor(prepared=True)
+                with pool_lock:
+                    cache[sql] = cursor
+            db_breaker(shard).call(cursor.execute, sql, params)
+            return cursor
+        except mysql.connector.Error as e:
+            if e.errno not in PREPARED_FALLBACK_ERRNOS or conn.in_transaction:
+                raise
+            logger.warning(f"Prepared statements unavailable ({e}), falling back to text protocol")
+            with pool_lock:
+                prepared_enabled = False
+            # Chỉ đóng kết nối của shard này: kết nối của shard khác có thể đang chạy truy vấn ở luồng khác
+            close_pooled_connection(shard)
+            conn = get_pooled_connection(shard)
+    cursor = conn.cursor()
+    db_breaker(shard).call(cursor.execute, sql, params)
+    return cursor
+
+# Bảng shard_map trên shard 0 ghi lại các khoảng slot đã được chuyển bằng reshard-orders (bản ghi
+# sau ghi đè bản ghi trước); slot không có trong bảng thuộc về shard theo cách chia đều mặc định.
+SELECT_SHARD_MAP_SQL = "SELECT slot_start, slot_end, shard FROM shard_map ORDER BY id"
+ER_NO_SUCH_TABLE = 1146
+
+shard_map = None
+shard_map_loaded_at = 0
+
+
+def default_shard_map():
+    return [slot * len(SHARD_BACKENDS) // SHARD_SLOTS for slot in range(SHARD_SLOTS)]
+
+
+def get_shard_map():
+    """Return the slot -> shard list, reloaded from shard 0 every SHARD_MAP_REFRESH_SECONDS."""
+    global shard_map, shard_map_loaded_at
+    now = time.time()
+    if shard_map is not None and now - shard_map_loaded_at < SHARD_MAP_REFRESH_SECONDS:
+        return shard_map
+    try:
+        slots = default_shard_map()
+        for slot_start, slot_end, shard in execute_statement(SELECT_SHARD_MAP_SQL, (), 0).fetchall():
+            slots[slot_start:slot_end + 1] = [shard] * (slot_end - slot_start + 1)
+        shard_map = slots
+    except mysql.connector.Error as e:
+        # Không đoán map khi chưa từng tải được: định tuyến sai còn tệ hơn trả lỗi
+        if shard_map is None and e.errno != ER_NO_SUCH_TABLE:
+            raise
+        logger.error(f"Could not reload shard map, keeping the {'cached' if shard_map else 'default'} map: {e}")
+        shard_map = shard_map or default_shard_map()
+    shard_map_loaded_at = now
+    return shard_map
+
+
+def shard_slot(stored_customer_id):
+    """Slot of a customer; matches MOD(CRC32(...), SHARD_SLOTS) on the stored column in reshard-orders."""
+    if isinstance(stored_customer_id, (bytes, bytearray)):
+        return zlib.crc32(bytes(stored_customer_id)) % SHARD_SLOTS
+    return zlib.crc32(stored_customer_id.lower().encode('utf-8')) % SHARD_SLOTS
+
+
+def shard_for_customer(stored_customer_id):
+    if len(SHARD_BACKENDS) == 1:
+        return 0
+    return get_shard_map()[shard_slot(stored_customer_id)]
+
+
+def all_shards():
+    return range(len(SHARD_BACKENDS))
+
+
+# Truy vấn nhiều shard chạy song song, mỗi shard dùng kết nối pooled riêng
+shard_executor = ThreadPoolExecutor(max_workers=len(SHARD_BACKENDS)) if len(SHARD_BACKENDS) > 1 else None
+
+
+def scatter(func, shards=None):
+    """Run func(shard) on each shard (all by default) and return the results in shard order."""
+    shards = list(all_shards() if shards is None else shards)
+    if len(shards) == 1:
+        return [func(shards[0])]
+    return list(shard_executor.map(func, shards))
+
+# Ghi lại các câu lệnh chậm hơn SLOW_QUERY_MS vào ring buffer trong Valkey (dùng chung cho crud và query).
+# Một phần (SLOW_QUERY_EXPLAIN_RATE) được chạy thêm EXPLAIN FORMAT=JSON để lưu kế hoạch thực thi.
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', 200))
+SLOW_QUERY_EXPLAIN_RATE = float(os.environ.get('SLOW_QUERY_EXPLAIN_RATE', 0.1))
+SLOW_QUERY_RING_SIZE = int(os.environ.get('SLOW_QUERY_RING_SIZE', 500))
+SLOW_QUERY_KEY = '{slowlog:orders}'
+SQL_LITERAL_PATTERN = re.compile(r"'(?:[^'\\]|\\.|'')*'|\b\d+(?:\.\d+)?\b|%s")
+
+
+def normalize_sql(sql):
+    """Replace literals and placeholders with '?' and collapse whitespace."""
+    return ' '.join(SQL_LITERAL_PATTERN.sub('?', sql).split())
+
+
+def parameter_shape(params):
+    """Describe parameters by type only, e.g. ['bytes(16)', 'str', 'int']."""
+    return [
+        f"bytes({len(param)})" if isinstance(param, (bytes, bytearray)) else type(param).__name__
+        for param in params
+    ]
+
+
+def record_slow_query(conn, operation, sql, params, row_count, duration_ms):
+    """Record a statement in the slow-query ring buffer when it exceeded SLOW_QUERY_MS."""
+    if duration_ms < SLOW_QUERY_MS:
+        return
+    normalized = normalize_sql(sql)
+    entry = {
+        'fingerprint': hashlib.sha1(normalized.encode('utf-8')).hexdigest()[:12],
+        'operation': operation,
+        'sql': normalized,
+        'param_shape': parameter_shape(params),
+        'rows': row_count,
+        'duration_ms': round(duration_ms, 2),
+        'recorded_at': datetime.now(timezone.utc).isoformat(),
+    }
+    logger.warning(f"Slow query {entry['fingerprint']} in {operation}: {duration_ms:.2f} ms, {row_count} rows: {normalized}")
+
+    if conn is not None and random.random() < SLOW_QUERY_EXPLAIN_RATE:
+        try:
+            cursor = conn.cursor()
+            cursor.execute(f"EXPLAIN FORMAT=JSON {sql}", params)
+            entry['plan'] = json.loads(cursor.fetchone()[0])
+            cursor.close()
+        except mysql.connector.Error as e:
+            entry['plan_error'] = str(e)
+
+    try:
+        pipe = primary_cache.pipeline(transaction=False)
+        pipe.lpush(SLOW_QUERY_KEY, json.dumps(entry))
+        pipe.ltrim(SLOW_QUERY_KEY, 0, SLOW_QUERY_RING_SIZE - 1)
+        pipe.execute()
+    except redis.RedisError as e:
+        logger.error(f"Valkey error (slow query log): {e}")
+
+# Chỉ mục địa chỉ giao hàng: FULLTEXT không dùng được trên bảng partition, nên mỗi từ của
+# shipping_address được lưu vào order_address_tokens (tạo bởi create-table) trong cùng transaction với đơn hàng.
+ADDRESS_TOKEN_MAX_LENGTH = 32
+ADDRESS_TOKEN_PATTERN = re.compile(r'[^\W_]+')
+INSERT_ADDRESS_TOKENS_SQL = "INSERT IGNORE INTO order_address_tokens (token, order_id, order_date) VALUES (%s, %s, %s)"
+DELETE_ADDRESS_TOKENS_SQL = "DELETE FROM order_address_tokens WHERE order_id = %s AND order_date = %s"
+
+
+def address_tokens(address):
+    """Split a shipping address into distinct lowercase word tokens of at least 2 characters."""
+    return sorted({
+        token[:ADDRESS_TOKEN_MAX_LENGTH] for token in ADDRESS_TOKEN_PATTERN.findall(str(address).lower()) if len(token) >= 2
+    })
+
+
+def write_address_tokens(conn, orders, replace=False):
+    """Index (stored_order_id, order_date, shipping_address) tuples in conn's open transaction.
+
+    replace=True first drops the orders' existing tokens (pass an empty address to only delete).
+    A missing token table only logs a warning so writes keep working before create-table has run.
+    """
+    cursor = conn.cursor()
+    try:
+        if replace:
+            cursor.executemany(DELETE_ADDRESS_TOKENS_SQL, [(order_id, order_date) for order_id, order_date, _ in orders])
+        rows = [
+            (token, order_id, order_date)
+            for order_id, order_date, address in orders for token in address_tokens(address)
+        ]
+        if rows:
+            cursor.executemany(INSERT_ADDRESS_TOKENS_SQL, rows)
+    except mysql.connector.Error as e:
+        if e.errno != ER_NO_SUCH_TABLE:
+            raise
+        logger.warning("Table order_address_tokens is missing, run create-table to enable address search")
+    finally:
+        cursor.close()
+
+# Định dạng lưu order_id/customer_id: 'uuid' (VARCHAR(36)) hoặc 'binary' (BINARY(16))
+ORDER_ID_FORMAT = os.environ.get('ORDER_ID_FORMAT', 'uuid')
+
+
+def uuid7():
+    """Generate a time-ordered (version 7) UUID so new keys append to the end of the index."""
+    timestamp_ms = time.time_ns() // 1000000
+    tail = bytearray(os.urandom(10))
+    tail[0] = (tail[0] & 0x0F) | 0x70
+    tail[2] = (tail[2] & 0x3F) | 0x80
+    return uuid.UUID(bytes=timestamp_ms.to_bytes(6, 'big') + bytes(tail))
+
+
+def encode_id(value):
+    """Convert an API string ID to its storage form; raises ValueError for malformed IDs in binary mode."""
+    if ORDER_ID_FORMAT == 'binary':
+        return uuid.UUID(value).bytes
+    return value
+
+
+def decode_id(value):
+    """Convert a stored ID back to its canonical string form."""
+    if isinstance(value, (bytes, bytearray)):
+        return str(uuid.UUID(bytes=bytes(value)))
+    return value
+
+# Bộ chuyển đổi theo cột cho các giá trị json.dumps không tự mã hóa được (Decimal, datetime)
+COLUMN_CONVERTERS = {
+    'order_date': str,
+    'total_amount': str,
+    'created_at': str,
+    'updated_at': str,
+}
+if ORDER_ID_FORMAT == 'binary':
+    COLUMN_CONVERTERS.update({'order_id': decode_id, 'customer_id': decode_id})
+
+
+def convert_columns(column_names, rows):
+    """Apply the per-column converters to tuple rows, one column at a time."""
+    if not rows:
+        return []
+    columns = list(zip(*rows))
+    for i, name in enumerate(column_names):
+        converter = COLUMN_CONVERTERS.get(name)
+        if converter:
+            columns[i] = map(converter, columns[i])
+    return list(zip(*columns))
+
+
+def encode_rows(column_names, rows, columnar=False):
+    """Encode tuple rows as a JSON list of objects, or as {columns, rows} when columnar."""
+    converted = convert_columns(column_names, rows)
+    if columnar:
+        return json.dumps({'columns': list(column_names), 'rows': converted})
+    return json.dumps([dict(zip(column_names, row)) for row in converted])
+
+
+def encode_row(column_names, row):
+    """Encode a single tuple row as a JSON object."""
+    return json.dumps(dict(zip(column_names, convert_columns(column_names, [row])[0])))
+
+# Bloom filter (bitmap trong Valkey) dùng bởi get_order để loại nhanh order_id chưa từng được tạo
+ORDER_BLOOM_FILTER = os.environ.get('ORDER_BLOOM_FILTER', 'off') == 'on'
+ORDER_BLOOM_BITS = int(os.environ.get('ORDER_BLOOM_BITS', 1 << 24))
+ORDER_BLOOM_HASHES = 7
+ORDER_BLOOM_KEY = '{orders:bloom}'
+
+
+def bloom_offsets(order_id):
+    """Bit offsets of order_id in the Bloom filter (double hashing over one blake2b digest)."""
+    digest = hashlib.blake2b(order_id.lower().encode('utf-8'), digest_size=16).digest()
+    h1 = int.from_bytes(digest[:8], 'big')
+    h2 = int.from_bytes(digest[8:], 'big') | 1
+    return [(h1 + i * h2) % ORDER_BLOOM_BITS for i in range(ORDER_BLOOM_HASHES)]
+
+
+def bloom_add(order_ids):
+    """Set the Bloom filter bits for newly created order IDs (before they are written to MySQL)."""
+    if not ORDER_BLOOM_FILTER:
+        return
+    try:
+        pipe = primary_cache.pipeline(transaction=False)
+        for order_id in order_ids:
+            for offset in bloom_offsets(order_id):
+                pipe.setbit(ORDER_BLOOM_KEY, offset, 1)
+        pipe.execute()
+    except redis.RedisError as e:
+        logger.error(f"Valkey error (bloom): {e}")
+
+# Chỉ mục đơn hàng gần đây theo khách hàng trong Valkey: sorted set (score = order_date) + hash bản ghi.
+# Khóa floor đánh dấu chỉ mục đã được dựng: chỉ mục đầy đủ với mọi đơn có score > floor ('-inf' = đầy đủ).
+# Khóa version tăng sau mỗi lần ghi để query-operations không dựng chỉ mục từ dữ liệu DB đã cũ.
+CUSTOMER_INDEX = os.environ.get('CUSTOMER_INDEX', 'on') == 'on'
+CUSTOMER_INDEX_MAX = int(os.environ.get('CUSTOMER_INDEX_MAX', 500))
+CUSTOMER_INDEX_TTL = int(os.environ.get('CUSTOMER_INDEX_TTL', 86400))
+
+CUSTOMER_INDEX_UPSERT_LUA = """
+redis.call('INCR', KEYS[4])
+redis.call('EXPIRE', KEYS[4], ARGV[5])
+local floor = redis.call('GET', KEYS[3])
+if not floor then return 0 end
+if floor ~= '-inf' and tonumber(ARGV[2]) <= tonumber(floor) then
+    redis.call('ZREM', KEYS[1], ARGV[1])
+    redis.call('HDEL', KEYS[2], ARGV[1])
+    return 0
+end
+redis.call('ZADD', KEYS[1], ARGV[2], ARGV[1])
+redis.call('HSET', KEYS[2], ARGV[1], ARGV[3])
+local excess = redis.call('ZCARD', KEYS[1]) - tonumber(ARGV[4])
+if excess > 0 then
+    local dropped = redis.call('ZRANGE', KEYS[1], 0, excess - 1, 'WITHSCORES')
+    for i = 1, #dropped, 2 do
+        redis.call('HDEL', KEYS[2], dropped[i])
+    end
+    redis.call('ZREMRANGEBYRANK', KEYS[1], 0, excess - 1)
+    redis.call('SET', KEYS[3], dropped[#dropped])
+end
+for i = 1, 3 do
+    redis.call('EXPIRE', KEYS[i], ARGV[5])
+end
+return 1
+"""
+
+CUSTOMER_INDEX_REMOVE_LUA = """
+redis.call('INCR', KEYS[4])
+redis.call('EXPIRE', KEYS[4], ARGV[2])
+redis.call('ZREM', KEYS[1], ARGV[1])
+redis.call('HDEL', KEYS[2], ARGV[1])
+return 1
+"""
+
+customer_index_upsert = primary_cache.register_script(CUSTOMER_INDEX_UPSERT_LUA)
+customer_index_remove = primary_cache.register_script(CUSTOMER_INDEX_REMOVE_LUA)
+
+
+def customer_index_keys(customer_id):
+    """Keys of a customer's index; the hash tag keeps them in one slot for the Lua scripts."""
+    base = f"{{orders:customer:{customer_id.lower()}}}"
+    return [base, f"{base}:records", f"{base}:floor", f"{base}:version"]
+
+
+def customer_index_record(order_id, order_date, customer_id, total_amount, status):
+    """Return (score, compact JSON record) for an order, using the same strings as filter_orders."""
+    order_datetime = datetime.fromisoformat(str(order_date))
+    score = int(order_datetime.replace(tzinfo=timezone.utc).timestamp())
+    amount = str(Decimal(str(total_amount)).quantize(Decimal('0.01')))
+    record = json.dumps([order_id, str(order_datetime), customer_id, amount, status])
+    return score, record
+
+
+def customer_index_apply(orders, client=None):
+    """Add or refresh orders (tuples of API string values) in already-built customer indexes."""
+    if not CUSTOMER_INDEX:
+        return
+    try:
+        for order_id, customer_id, order_date, total_amount, status in orders:
+            keys = customer_index_keys(customer_id)
+            try:
+                score, record = customer_index_record(order_id, order_date, customer_id, total_amount, status)
+            except (ValueError, ArithmeticError):
+                customer_index_remove(keys=keys, args=[order_id, CUSTOMER_INDEX_TTL], client=client)
+                continue
+            customer_index_upsert(
+                keys=keys, args=[order_id, score, record, CUSTOMER_INDEX_MAX, CUSTOMER_INDEX_TTL], client=client
+            )
+        if client is not None:
+            client.execute()
+    except redis.RedisError as e:
+        logger.error(f"Valkey error (customer index): {e}")
+        # DB đã commit: chỉ mục không được cập nhật sẽ trả dữ liệu cũ tới CUSTOMER_INDEX_TTL, nên bỏ nó để dựng lại
+        customer_index_invalidate({customer_id for _, customer_id, *_ in orders})
+
+
+def customer_index_invalidate(customer_ids):
+    """Best-effort drop of customer indexes so the next read rebuilds them from MySQL.
+
+    The version bump makes a build that is already running discard its result.
+    """
+    try:
+        pipe = primary_cache.pipeline(transaction=False)
+        for customer_id in customer_ids:
+            keys = customer_index_keys(customer_id)
+            pipe.delete(*keys[:3])
+            pipe.incr(keys[3])
+            pipe.expire(keys[3], CUSTOMER_INDEX_TTL)
+        pipe.execute()
+    except redis.RedisError as e:
+        logger.error(f"Valkey error (customer index invalidation): {e}")
+
+
+def customer_index_delete(order_id, customer_id):
+    """Remove a deleted order from its customer's index."""
+    if not CUSTOMER_INDEX:
+        return
+    try:
+        customer_index_remove(keys=customer_index_keys(customer_id), args=[order_id, CUSTOMER_INDEX_TTL])
+    except redis.RedisError as e:
+        logger.error(f"Valkey error (customer index): {e}")
+        customer_index_invalidate([customer_id])
+
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'ServerlessDB')
+
+
+def emit_metric(name, value, unit='Count', **dimensions):
+    """Write a CloudWatch Embedded Metric Format record to stdout."""
+    print(json.dumps({
+        '_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': METRICS_NAMESPACE,
+                'Dimensions': [list(dimensions)],
+                'Metrics': [{'Name': name, 'Unit': unit}]
+            }]
+        },
+        name: value,
+        **dimensions
+    }))
+
+# Chính sách TTL theo loại khóa và tuổi dữ liệu: danh sách "tuổi_tối_thiểu_ngày:ttl_giây".
+# Dữ liệu càng cũ càng ít thay đổi nên được cache lâu hơn; tier đầu tiên áp dụng cho dữ liệu mới nhất.
+# Trang danh sách sắp theo order_date giảm dần nên mọi đơn mới đều làm dịch trang: chỉ dùng tier đầu tiên.
+CACHE_TTL_POLICY = {
+    'page': os.environ.get('CACHE_TTL_PAGE', '0:60'),
+}
+
+
+def parse_ttl_tiers(spec):
+    """Parse "0:60,7:600" into [(0.0, 60), (7.0, 600)] sorted by minimum age."""
+    return sorted((float(age), int(ttl)) for age, ttl in (item.split(':') for item in spec.split(',')))
+
+
+CACHE_TTL_TIERS = {key_class: parse_ttl_tiers(spec) for key_class, spec in CACHE_TTL_POLICY.items()}
+
+
+def cache_ttl(key_class, data_date=None):
+    """Return (ttl_seconds, ttl_class) for a cache entry whose newest covered data is from data_date.
+
+    Without a data_date (open-ended ranges) the data counts as current.
+    """
+    age_days = 0
+    if data_date:
+        try:
+            data_datetime = datetime.fromisoformat(str(data_date)).replace(tzinfo=timezone.utc)
+            age_days = (datetime.now(timezone.utc) - data_datetime).total_seconds() / 86400
+        except ValueError:
+            pass
+    tiers = CACHE_TTL_TIERS[key_class]
+    min_age, ttl = tiers[0]
+    for tier_age, tier_ttl in tiers:
+        if age_days >= tier_age:
+            min_age, ttl = tier_age, tier_ttl
+    return ttl, f"{key_class}:{min_age:g}d"
+
+# Nén response theo Accept-Encoding của client. API Gateway chỉ trả body nhị phân khi body được mã hóa
+# base64 (isBase64Encoded) và BinaryMediaTypes khớp; brotli là tùy chọn, thiếu thư viện thì chỉ dùng gzip.
+RESPONSE_COMPRESSION_MIN_BYTES = int(os.environ.get('RESPONSE_COMPRESSION_MIN_BYTES', 1024))
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+
+def negotiate_encoding(headers):
+    """Pick 'br' (when brotli is installed) or 'gzip' from the request's Accept-Encoding, or None."""
+    accept = next((value or '' for name, value in (headers or {}).items() if name.lower() == 'accept-encoding'), '')
+    weights = {}
+    for token in accept.split(','):
+        name, _, params = token.partition(';')
+        weight = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                weight = float(params[2:])
+            except ValueError:
+                weight = 0.0
+        weights[name.strip().lower()] = weight
+    best, best_weight = None, 0.0
+    for encoding in (['br'] if brotli else []) + ['gzip']:
+        weight = weights.get(encoding, weights.get('*', 0.0))
+        if weight > best_weight:
+            best, best_weight = encoding, weight
+    return best
+
+
+def compress_body(body, encoding):
+    """Compress a response body and return it base64-encoded."""
+    data = body.encode('utf-8')
+    if encoding == 'br':
+        data = brotli.compress(data, quality=BROTLI_QUALITY)
+    else:
+        data = gzip.compress(data, compresslevel=GZIP_LEVEL)
+    return base64.b64encode(data).decode('ascii')
+
+
+def body_etag(body):
+    """Strong ETag of a cached body, computed once when the cache entry is filled."""
+    return '"' + hashlib.sha256(body.encode('utf-8')).hexdigest()[:32] + '"'
+
+
+def encoded_etag(etag, encoding):
+    """ETag of the compressed representation; it must differ from the uncompressed one."""
+    return f'{etag[:-1]}-{encoding}"'
+
+
+def matched_etag(if_none_match, etag):
+    """Return the If-None-Match tag matching etag or one of its compressed representations, or None."""
+    if if_none_match.strip() == '*':
+        return etag
+    accepted = {etag} | {encoded_etag(etag, encoding) for encoding in ('br', 'gzip')}
+    for tag in if_none_match.split(','):
+        tag = tag.strip().removeprefix('W/')
+        if tag in accepted:
+            return tag
+    return None
+
+
+def json_response(body, encoding=None, compressed_body=None, etag=None):
+    """Build a 200 response, compressed when the client accepts an encoding and the body is large enough."""
+    headers = {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*', 'Vary': 'Accept-Encoding'}
+    if encoding and compressed_body is None and len(body) >= RESPONSE_COMPRESSION_MIN_BYTES:
+        compressed_body = compress_body(body, encoding)
+    if compressed_body is None:
+        if etag:
+            headers['ETag'] = etag
+        return {'headers': headers, 'statusCode': 200, 'body': body}
+    headers['Content-Encoding'] = encoding
+    if etag:
+        headers['ETag'] = encoded_etag(etag, encoding)
+    return {'headers': headers, 'statusCode': 200, 'body': compressed_body, 'isBase64Encoded': True}
 
-def view_orders(page, page_size):
+
+def not_modified_response(etag):
+    return {
+        'headers': {'Access-Control-Allow-Origin': '*', 'Vary': 'Accept-Encoding', 'ETag': etag},
+        'statusCode': 304,
+        'body': ''
+    }
+
+
+def fill_cache(cache_key, ttl, body):
+    """Cache a body together with its ETag under the same TTL and drop compressed variants of the old body."""
+    pipe = primary_cache.pipeline(transaction=False)
+    pipe.setex(cache_key, ttl, body)
+    pipe.setex(f"{cache_key}:etag", ttl, body_etag(body))
+    pipe.delete(*(f"{cache_key}:{encoding}" for encoding in ('br', 'gzip')))
+    pipe.execute()
+
+
+def check_not_modified(cache_key, if_none_match):
+    """Return the matching ETag when the cached entry is unchanged for the client, without reading the body.
+
+    The entry must still exist: an ETag left behind by an invalidated entry never matches.
+    """
+    pipe = primary_cache.pipeline(transaction=False)
+    pipe.get(f"{cache_key}:etag")
+    pipe.exists(cache_key)
+    etag, exists = pipe.execute()
+    if not (etag and exists):
+        return None
+    return matched_etag(if_none_match, etag)
+
+
+def get_cached_body(cache_key, encoding=None):
+    """Return (body, compressed_body, etag) for a cache entry.
+
+    The compressed variant is stored next to the entry with the entry's remaining TTL the first
+    time an encoding is requested, so each cache fill is compressed at most once per encoding.
+    The variant, body and ETag are read in one round trip, so bodies below
+    RESPONSE_COMPRESSION_MIN_BYTES (which never get a variant) cost a single pipeline.
+    Variants are stored as '<etag>:<compressed body>' and ignored when the ETag no longer
+    matches, in case a fill raced with the compression of the previous body.
+    """
+    pipe = primary_cache.pipeline(transaction=False)
+    if not encoding:
+        pipe.get(cache_key)
+        pipe.get(f"{cache_key}:etag")
+        body, etag = pipe.execute()
+        return body, None, etag
+    variant_key = f"{cache_key}:{encoding}"
+    pipe.get(variant_key)
+    pipe.get(f"{cache_key}:etag")
+    pipe.get(cache_key)
+    pipe.ttl(cache_key)
+    variant, etag, body, ttl = pipe.execute()
+    if variant is not None:
+        variant_etag, _, compressed_body = variant.partition(':')
+        if variant_etag == etag:
+            return None, compressed_body, etag
+    if body is None or len(body) < RESPONSE_COMPRESSION_MIN_BYTES:
+        return body, None, etag
+    compressed_body = compress_body(body, encoding)
+    if ttl > 0 and etag:
+        primary_cache.setex(variant_key, ttl, f"{etag}:{compressed_body}")
+    return body, compressed_body, etag
+
+
+def request_header(event, name):
+    """Case-insensitive lookup of a request header."""
+    return next((value for key, value in (event.get('headers') or {}).items() if key.lower() == name), None)
+
+
+def request_body(event):
+    """Decode the API Gateway request body, which arrives base64-encoded because of BinaryMediaTypes."""
+    body = event.get('body')
+    if isinstance(body, str) and event.get('isBase64Encoded'):
+        body = base64.b64decode(body).decode('utf-8')
+    return body
+
+
+# Phát hiện hot key: một phần (HOT_KEY_SAMPLE_RATE) lượt đọc được đếm bằng ZINCRBY vào sorted set của cửa sổ
+# HOT_KEY_WINDOW_SECONDS hiện tại. Top-K của cửa sổ trước (ước lượng từ HOT_KEY_MIN_HITS lượt đọc trở lên) là hot key:
+# chúng được giữ trong bộ nhớ của container warm (HOT_KEY_LOCAL_TTL giây), được cache trong Valkey với TTL dài hơn
+# (HOT_KEY_TTL) và được dựng lại ở luồng nền khi bản trong Valkey đã cũ hơn TTL thường, nên không bao giờ hết hạn
+# giữa chừng. Lambda đóng băng luồng nền khi handler trả về; việc refresh dở dang được tiếp tục ở lần gọi sau.
+HOT_KEYS = os.environ.get('HOT_KEYS', 'on') == 'on'
+HOT_KEY_SAMPLE_RATE = float(os.environ.get('HOT_KEY_SAMPLE_RATE', 0.05))
+HOT_KEY_WINDOW_SECONDS = int(os.environ.get('HOT_KEY_WINDOW_SECONDS', 60))
+HOT_KEY_TOP_K = int(os.environ.get('HOT_KEY_TOP_K', 20))
+HOT_KEY_MIN_HITS = int(os.environ.get('HOT_KEY_MIN_HITS', 60))
+HOT_KEY_TTL = int(os.environ.get('HOT_KEY_TTL', 600))
+HOT_KEY_LOCAL_TTL = float(os.environ.get('HOT_KEY_LOCAL_TTL', 5))
+HOT_KEY_LIST_REFRESH_SECONDS = 30
+HOT_KEY_REFRESH_LOCK_SECONDS = 30
+HOT_KEY_PREFIX = '{hotkeys}'
+
+hot_keys = set()
+hot_keys_loaded_at = 0
+local_cache = {}
+refreshing_keys = set()
+refresh_executor = ThreadPoolExecutor(max_workers=2)
+# local_cache, refreshing_keys và hot_keys được sửa từ cả luồng handler lẫn luồng của refresh_executor
+hot_keys_lock = threading.Lock()
+
+
+def hot_key_window(windows_ago=0):
+    return f"{HOT_KEY_PREFIX}:{int(time.time() // HOT_KEY_WINDOW_SECONDS) - windows_ago}"
+
+
+def track_key_access(cache_key):
+    """Count a sampled read of cache_key in the current window."""
+    if not HOT_KEYS or random.random() >= HOT_KEY_SAMPLE_RATE:
+        return
+    window_key = hot_key_window()
+    try:
+        pipe = primary_cache.pipeline(transaction=False)
+        pipe.zincrby(window_key, 1, cache_key)
+        pipe.expire(window_key, HOT_KEY_WINDOW_SECONDS * 3)
+        pipe.execute()
+    except redis.RedisError as e:
+        logger.error(f"Valkey error (hot key tracking): {e}")
+
+
+def load_hot_keys(windows_ago=1):
+    """Return [(cache_key, estimated_reads)] of a window's top keys above HOT_KEY_MIN_HITS."""
+    entries = primary_cache.zrevrangebyscore(
+        hot_key_window(windows_ago), '+inf', HOT_KEY_MIN_HITS * HOT_KEY_SAMPLE_RATE,
+        start=0, num=HOT_KEY_TOP_K, withscores=True
+    )
+    return [(cache_key, round(score / HOT_KEY_SAMPLE_RATE)) for cache_key, score in entries]
+
+
+def is_hot_key(cache_key):
+    """Whether cache_key was hot in the last complete window; the list is reloaded every HOT_KEY_LIST_REFRESH_SECONDS."""
+    global hot_keys, hot_keys_loaded_at
+    if not HOT_KEYS:
+        return False
+    now = time.time()
+    if now - hot_keys_loaded_at >= HOT_KEY_LIST_REFRESH_SECONDS:
+        hot_keys_loaded_at = now
+        try:
+            loaded = {key for key, _ in load_hot_keys()}
+        except redis.RedisError as e:
+            logger.error(f"Valkey error (hot keys): {e}")
+            loaded = hot_keys
+        with hot_keys_lock:
+            hot_keys = loaded
+            # Key không còn hot thì bỏ khỏi bộ nhớ của container
+            for key in list(local_cache):
+                if key not in hot_keys:
+                    del local_cache[key]
+    with hot_keys_lock:
+        return cache_key in hot_keys
+
+
+def local_cache_get(cache_key, encoding=None):
+    """Return (body, compressed_body, etag) of a hot key kept in this container, or None when absent or expired."""
+    with hot_keys_lock:
+        entry = local_cache.get(cache_key)
+        if entry is None or time.time() >= entry['expires_at']:
+            return None
+        compressed_body = entry['variants'].get(encoding) if encoding else None
+    if encoding and compressed_body is None and len(entry['body']) >= RESPONSE_COMPRESSION_MIN_BYTES:
+        # Nén ngoài lock; entry thay thế bởi refresh là dict mới nên không nhận nhầm bản nén cũ
+        compressed_body = compress_body(entry['body'], encoding)
+        with hot_keys_lock:
+            entry['variants'][encoding] = compressed_body
+    return entry['body'], compressed_body, entry['etag']
+
+
+def local_cache_put(cache_key, body, etag):
+    with hot_keys_lock:
+        local_cache[cache_key] = {'body': body, 'etag': etag, 'variants': {}, 'expires_at': time.time() + HOT_KEY_LOCAL_TTL}
+
+
+def refresh_hot_key(cache_key, ttl, loader, key_class):
+    """Rebuild a hot key with loader() on a background thread and store it in Valkey and this container.
+
+    A short NX lock in Valkey lets a single container rebuild each key.
+    """
+    try:
+        if not primary_cache.set(f"{cache_key}:refresh", 1, nx=True, ex=HOT_KEY_REFRESH_LOCK_SECONDS):
+            return
+        body = loader()
+        fill_cache(cache_key, ttl, body)
+        local_cache_put(cache_key, body, body_etag(body))
+        emit_metric('HotKeyRefresh', 1, KeyClass=key_class)
+    except (redis.RedisError, mysql.connector.Error) as e:
+        logger.error(f"Error refreshing hot key {cache_key}: {e}")
+    except Exception as e:
+        logger.error(f"Unexpected error refreshing hot key {cache_key}: {e}", exc_info=True)
+    finally:
+        with hot_keys_lock:
+            refreshing_keys.discard(cache_key)
+
+
+def pin_hot_key(cache_key, body, etag, ttl, base_ttl, loader, key_class):
+    """Keep a hot key read from Valkey in this container and schedule a rebuild once it is older than base_ttl.
+
+    loader runs on another thread, so it must not use the pooled connections of the request.
+    """
+    local_cache_put(cache_key, body, etag)
+    with hot_keys_lock:
+        if cache_key in refreshing_keys:
+            return
+    try:
+        remaining = primary_cache.ttl(cache_key)
+    except redis.RedisError as e:
+        logger.error(f"Valkey error (hot key TTL): {e}")
+        return
+    if 0 <= remaining <= ttl - base_ttl:
+        with hot_keys_lock:
+            if cache_key in refreshing_keys:
+                return
+            refreshing_keys.add(cache_key)
+        refresh_executor.submit(refresh_hot_key, cache_key, ttl, loader, key_class)
+
+
+# Chế độ ghi: 'direct' (INSERT ngay) hoặc 'buffered' (ghi vào Valkey stream, drain-orders ghi vào MySQL theo lô)
+INGEST_MODE = os.environ.get('INGEST_MODE', 'direct')
+ORDER_STREAM_KEY = '{orders:ingest}'
+ORDER_STATUSES = ('pending', 'processing', 'shipped', 'delivered', 'cancelled')
+
+
+def validate_order(order_date, total_amount, status, shipping_address):
+    """Check an order against the table constraints; returns an error message or None.
+
+    Buffered orders are written asynchronously, so anything MySQL would reject must be caught here.
+    """
+    try:
+        datetime.fromisoformat(str(order_date))
+    except ValueError:
+        return 'Invalid order_date'
+    try:
+        amount = Decimal(str(total_amount))
+    except ArithmeticError:
+        return 'Invalid total_amount'
+    if not amount.is_finite() or amount < 0 or amount >= Decimal('1e8'):
+        return 'Invalid total_amount'
+    if status not in ORDER_STATUSES:
+        return f"Invalid status, expected one of {list(ORDER_STATUSES)}"
+    if len(str(shipping_address)) > 255:
+        return 'shipping_address is too long'
+    return None
+
+
+def enqueue_order(order_id, customer_id, order_date, total_amount, status, shipping_address):
+    """Append an order to the ingest stream; drain-orders writes it to MySQL."""
+    primary_cache.xadd(ORDER_STREAM_KEY, {
+        'order_id': order_id,
+        'customer_id': customer_id,
+        'order_date': str(order_date),
+        'total_amount': str(total_amount),
+        'status': status,
+        'shipping_address': shipping_address,
+        'enqueued_ms': int(time.time() * 1000),
+    })
+
+# Các câu lệnh nóng chạy qua execute_statement (prepared statement)
+SELECT_ORDERS_PAGE_SQL = (
+    "SELECT order_id, order_date, customer_id, total_amount, status, shipping_address "
+    "FROM orders ORDER BY order_date DESC LIMIT %s OFFSET %s"
+)
+INSERT_ORDER_SQL = (
+    "INSERT INTO orders (order_id, customer_id, order_date, total_amount, status, shipping_address) "
+    "VALUES (%s, %s, %s, %s, %s, %s)"
+)
+DELETE_ORDER_SQL = "DELETE FROM orders WHERE order_id = %s AND order_date = %s"
+SELECT_ORDER_CUSTOMER_SQL = "SELECT customer_id FROM orders WHERE order_id = %s AND order_date = %s"
+
+# Partition cũ được create-table (action 'archive') chuyển sang orders_archive: update/delete/tìm shard
+# thử lại trên bảng archive khi bảng nóng không có đơn hàng
+ARCHIVE_TABLE = 'orders_archive'
+DELETE_ARCHIVE_ORDER_SQL = "DELETE FROM orders_archive WHERE order_id = %s AND order_date = %s"
+SELECT_ARCHIVE_ORDER_CUSTOMER_SQL = "SELECT customer_id FROM orders_archive WHERE order_id = %s AND order_date = %s"
+
+
+def archive_statement(sql, params, shard=0):
+    """Run one of the *_ARCHIVE_*_SQL statements; None when the shard has no orders_archive table."""
+    try:
+        return execute_statement(sql, params, shard)
+    except mysql.connector.Error as e:
+        if e.errno != ER_NO_SUCH_TABLE:
+            raise
+        return None
+
+def fetch_orders_page(page_size, offset, pooled=True):
+    """Fetch one page of the newest orders across all shards.
+
+    With several shards, each shard returns its first offset + page_size rows and the
+    results are merge-sorted by order_date, so deep pages cost more than on one shard.
+    pooled=False uses short-lived connections, for callers on a background thread.
+    """
+    if len(SHARD_BACKENDS) == 1:
+        shard_params = [(page_size, offset)]
+    else:
+        shard_params = [(offset + page_size, 0)] * len(SHARD_BACKENDS)
+
+    def fetch(shard):
+        query_start = time.time()
+        if pooled:
+            cursor = execute_statement(SELECT_ORDERS_PAGE_SQL, shard_params[shard], shard)
+            conn = pooled_conns.get(shard)
+        else:
+            conn = get_db_connection(shard)
+            cursor = conn.cursor()
+            cursor.execute(SELECT_ORDERS_PAGE_SQL, shard_params[shard])
+        try:
+            rows = cursor.fetchall()
+            record_slow_query(
+                conn, 'view_orders', SELECT_ORDERS_PAGE_SQL, shard_params[shard],
+                len(rows), (time.time() - query_start) * 1000
+            )
+            return cursor.column_names, rows
+        finally:
+            if not pooled:
+                conn.close()
+
+    results = scatter(fetch)
+    column_names = results[0][0]
+    if len(results) == 1:
+        return column_names, results[0][1]
+    merged = heapq.merge(*(rows for _, rows in results), key=lambda row: row[1], reverse=True)
+    return column_names, list(itertools.islice(merged, offset, offset + page_size))
+
+
+def find_order_shard(stored_order_id, order_date):
+    """Return (shard, stored customer_id) of an order, or (None, None) when no shard has it.
+
+    Orders are placed by customer_id, so a caller that only knows the order key probes every shard,
+    including its archive table.
+    """
+    def find(shard):
+        rows = execute_statement(SELECT_ORDER_CUSTOMER_SQL, (stored_order_id, order_date), shard).fetchall()
+        if not rows:
+            cursor = archive_statement(SELECT_ARCHIVE_ORDER_CUSTOMER_SQL, (stored_order_id, order_date), shard)
+            rows = cursor.fetchall() if cursor else []
+        return rows
+
+    results = scatter(find)
+    for shard, rows in enumerate(results):
+        if rows:
+            return shard, rows[0][0]
+    return None, None
+
+
+def view_orders(page, page_size, columnar=False, encoding=None, if_none_match=None):
     start_time = time.time()
     if page < 1 or page_size < 1:
         return {
@@ -86,61 +1213,78 @@ def view_orders(page, page_size):
 
     offset = (page - 1) * page_size
     cache_key = f"orders:all:page_{page}:size_{page_size}"
+    if columnar:
+        cache_key += ":columnar"
+
+    ttl, ttl_class = cache_ttl('page')
+    track_key_access(cache_key)
+    hot = is_hot_key(cache_key)
+    base_ttl, ttl = ttl, max(ttl, HOT_KEY_TTL) if hot else ttl
+    if hot:
+        pinned = local_cache_get(cache_key, encoding)
+        if pinned:
+            emit_metric('LocalCacheHit', 1, KeyClass='page')
+            etag = if_none_match and matched_etag(if_none_match, pinned[2])
+            if etag:
+                emit_metric('NotModified', 1, KeyClass='page')
+                return not_modified_response(etag)
+            return json_response(pinned[0], encoding, pinned[1], pinned[2])
 
     try:
-        cached_orders = primary_cache.get(cache_key)
-        if cached_orders:
+        if if_none_match:
+            etag = check_not_modified(cache_key, if_none_match)
+            if etag:
+                emit_metric('CacheHit', 1, KeyClass='page', TtlClass=ttl_class)
+                emit_metric('NotModified', 1, KeyClass='page')
+                logger.info(f"Not modified, latency: {(time.time() - start_time) * 1000:.2f} ms")
+                return not_modified_response(etag)
+        # Hot key được nén trong bộ nhớ container nên chỉ đọc bản gốc
+        cached_orders, compressed_orders, etag = get_cached_body(cache_key, None if hot else encoding)
+        emit_metric('CacheHit', int(cached_orders is not None or compressed_orders is not None), KeyClass='page', TtlClass=ttl_class)
+        if hot and cached_orders:
+            pin_hot_key(
+                cache_key, cached_orders, etag, ttl, base_ttl,
+                lambda: encode_rows(*fetch_orders_page(page_size, offset, pooled=False), columnar), 'page'
+            )
+            pinned = local_cache_get(cache_key, encoding)
+            compressed_orders = pinned[1] if pinned else None
+        if cached_orders or compressed_orders:
             latency_ms = (time.time() - start_time) * 1000
             logger.info(f"Cache hit, latency: {latency_ms:.2f} ms")
-            return {
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'statusCode': 200,
-                'body': cached_orders
-            }
+            return json_response(cached_orders, encoding, compressed_orders, etag)
     except redis.RedisError as e:
         logger.error(f"Valkey error (reader): {e}")
 
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor(dictionary=True)
-        cursor.execute(
-            "SELECT order_id, order_date, customer_id, total_amount, status, shipping_address "
-            "FROM orders ORDER BY order_date DESC LIMIT %s OFFSET %s",
-            (page_size, offset)
-        )
-        orders = cursor.fetchall()
+        column_names, rows = fetch_orders_page(page_size, offset)
+        orders_json = encode_rows(column_names, rows, columnar)
 
         try:
-            primary_cache.setex(cache_key, 60, json.dumps(orders, default=str))
+            fill_cache(cache_key, ttl, orders_json)
         except redis.RedisError as e:
             logger.error(f"Valkey error (primary): {e}")
+        if hot:
+            local_cache_put(cache_key, orders_json, body_etag(orders_json))
 
         latency_ms = (time.time() - start_time) * 1000
         logger.info(f"Cache miss, query latency: {latency_ms:.2f} ms")
 
-        cursor.close()
-        conn.close()
-
-        return {
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'statusCode': 200,
-            'body': json.dumps({'orders': orders, 'page': page, 'page_size': page_size, 'latency_ms': latency_ms}, default=str)
-        }
+        return json_response(
+            f'{{"orders": {orders_json}, "page": {page}, "page_size": {page_size}, "latency_ms": {json.dumps(latency_ms)}}}',
+            encoding
+        )
     except mysql.connector.Error as e:
         logger.error(f"Database error: {e}")
+        close_pooled_connection()
         return {
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
             'statusCode': 500,
             'body': json.dumps({'error': f'Database error: {e}'})
         }
-    finally:
-        if conn and conn.is_connected():
-            conn.close()
-            logger.info("Database connection closed")
 
 def insert_order(customer_id, order_date, total_amount, status, shipping_address):
     start_time = time.time()
-    order_id = str(uuid.uuid4())
+    order_id = uuid7()
 
     if not all([customer_id, order_date, total_amount, status, shipping_address]):
         return {
@@ -150,21 +1294,61 @@ def insert_order(customer_id, order_date, total_amount, status, shipping_address
         }
 
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute(
-            "INSERT INTO orders (order_id, customer_id, order_date, total_amount, status, shipping_address) "
-            "VALUES (%s, %s, %s, %s, %s, %s)",
-            (order_id, customer_id, order_date, total_amount, status, shipping_address)
+        stored_customer_id = encode_id(customer_id)
+    except ValueError:
+        return {
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'statusCode': 400,
+            'body': json.dumps({'error': 'Invalid customer_id'})
+        }
+    stored_order_id = order_id.bytes if ORDER_ID_FORMAT == 'binary' else str(order_id)
+    order_id = str(order_id)
+
+    bloom_add([order_id])
+
+    if INGEST_MODE == 'buffered':
+        error = validate_order(order_date, total_amount, status, shipping_address)
+        if error:
+            return {
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'statusCode': 400,
+                'body': json.dumps({'error': error})
+            }
+        try:
+            enqueue_order(order_id, decode_id(stored_customer_id), order_date, total_amount, status, shipping_address)
+            latency_ms = (time.time() - start_time) * 1000
+            logger.info(f"Buffered insert latency: {latency_ms:.2f} ms")
+            return {
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'statusCode': 202,
+                'body': json.dumps({'order_id': order_id, 'order_date': order_date, 'message': 'Order accepted'})
+            }
+        except redis.RedisError as e:
+            # Không ghi được vào stream thì ghi thẳng vào MySQL như chế độ direct
+            logger.error(f"Valkey error (ingest stream), falling back to direct insert: {e}")
+
+    try:
+        shard = shard_for_customer(stored_customer_id)
+        conn = begin_transaction(shard)
+        execute_statement(
+            INSERT_ORDER_SQL,
+            (stored_order_id, stored_customer_id, order_date, total_amount, status, shipping_address),
+            shard
         )
+        write_address_tokens(conn, [(stored_order_id, order_date, shipping_address)])
         conn.commit()
 
+        # Xóa tombstone (negative cache) để đơn hàng mới hiển thị ngay
+        cache_key = f"order:{order_id}:{order_date}"
+        try:
+            primary_cache.delete(cache_key)
+        except redis.RedisError as e:
+            logger.error(f"Valkey error (primary): {e}")
+        customer_index_apply([(order_id, decode_id(stored_customer_id), order_date, total_amount, status)])
+
         latency_ms = (time.time() - start_time) * 1000
         logger.info(f"Insert latency: {latency_ms:.2f} ms")
 
-        cursor.close()
-        conn.close()
-
         return {
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
             'statusCode': 201,
@@ -172,17 +1356,14 @@ def insert_order(customer_id, order_date, total_amount, status, shipping_address
         }
     except mysql.connector.Error as e:
         logger.error(f"Database error: {e}")
+        close_pooled_connection()
         return {
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
             'statusCode': 500,
             'body': json.dumps({'error': f'Database error: {e}'})
         }
-    finally:
-        if conn and conn.is_connected():
-            conn.close()
-            logger.info("Database connection closed")
 
-def update_order(order_id, order_date, total_amount, status, shipping_address):
+def update_order(order_id, order_date, total_amount, status, shipping_address, customer_id=None):
     start_time = time.time()
     if not all([order_id, order_date]):
         return {
@@ -191,7 +1372,7 @@ def update_order(order_id, order_date, total_amount, status, shipping_address):
             'body': json.dumps({'error': 'Missing order_id or order_date'})
         }
 
-    sql = "UPDATE orders SET"
+    sql = "UPDATE {table} SET"
     params = []
     updates = []
 
@@ -212,16 +1393,51 @@ def update_order(order_id, order_date, total_amount, status, shipping_address):
             'body': json.dumps({'error': 'No fields to update'})
         }
 
+    try:
+        stored_order_id = encode_id(order_id)
+    except ValueError:
+        return {
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'statusCode': 400,
+            'body': json.dumps({'error': 'Invalid order_id'})
+        }
+
     sql += ",".join(updates) + " WHERE order_id = %s AND order_date = %s"
-    params.extend([order_id, order_date])
+    params.extend([stored_order_id, order_date])
 
+    conn = None
     try:
-        conn = get_db_connection()
+        if customer_id:
+            shard = shard_for_customer(encode_id(customer_id))
+        elif len(SHARD_BACKENDS) == 1:
+            shard = 0
+        else:
+            shard, _ = find_order_shard(stored_order_id, order_date)
+            if shard is None:
+                return {
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'statusCode': 404,
+                    'body': json.dumps({'error': 'Order not found'})
+                }
+        conn = get_db_connection(shard)
         cursor = conn.cursor()
-        cursor.execute(sql, params)
+        table = 'orders'
+        cursor.execute(sql.format(table=table), params)
+        updated = cursor.rowcount
+        if updated and shipping_address:
+            write_address_tokens(conn, [(stored_order_id, order_date, shipping_address)], replace=True)
+        elif not updated:
+            # Đơn đã lưu trữ: cập nhật trong orders_archive (bảng archive không có token địa chỉ)
+            table = ARCHIVE_TABLE
+            try:
+                cursor.execute(sql.format(table=table), params)
+                updated = cursor.rowcount
+            except mysql.connector.Error as e:
+                if e.errno != ER_NO_SUCH_TABLE:
+                    raise
         conn.commit()
 
-        if cursor.rowcount == 0:
+        if updated == 0:
             cursor.close()
             conn.close()
             return {
@@ -237,6 +1453,16 @@ def update_order(order_id, order_date, total_amount, status, shipping_address):
         except redis.RedisError as e:
             logger.error(f"Valkey error (primary): {e}")
 
+        if CUSTOMER_INDEX:
+            cursor.execute(
+                "SELECT order_id, customer_id, order_date, total_amount, status "
+                f"FROM {table} WHERE order_id = %s AND order_date = %s",
+                (stored_order_id, order_date)
+            )
+            customer_index_apply([
+                (decode_id(row[0]), decode_id(row[1]), row[2], row[3], row[4]) for row in cursor.fetchall()
+            ])
+
         latency_ms = (time.time() - start_time) * 1000
         logger.info(f"Update latency: {latency_ms:.2f} ms")
 
@@ -248,6 +1474,12 @@ def update_order(order_id, order_date, total_amount, status, shipping_address):
             'statusCode': 200,
             'body': json.dumps({'message': 'Order updated'})
         }
+    except ValueError:
+        return {
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'statusCode': 400,
+            'body': json.dumps({'error': 'Invalid customer_id'})
+        }
     except mysql.connector.Error as e:
         logger.error(f"Database error: {e}")
         return {
@@ -260,7 +1492,7 @@ def update_order(order_id, order_date, total_amount, status, shipping_address):
             conn.close()
             logger.info("Database connection closed")
 
-def delete_order(order_id, order_date):
+def delete_order(order_id, order_date, customer_id=None):
     start_time = time.time()
     if not order_id or not order_date:
         return {
@@ -270,17 +1502,47 @@ def delete_order(order_id, order_date):
         }
 
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute(
-            "DELETE FROM orders WHERE order_id = %s AND order_date = %s",
-            (order_id, order_date)
-        )
+        stored_order_id = encode_id(order_id)
+    except ValueError:
+        return {
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'statusCode': 400,
+            'body': json.dumps({'error': 'Invalid order_id'})
+        }
+
+    try:
+        stored_customer_id = encode_id(customer_id) if customer_id else None
+    except ValueError:
+        return {
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'statusCode': 400,
+            'body': json.dumps({'error': 'Invalid customer_id'})
+        }
+
+    try:
+        if stored_customer_id is not None:
+            shard = shard_for_customer(stored_customer_id)
+        elif len(SHARD_BACKENDS) == 1 and not CUSTOMER_INDEX:
+            shard = 0
+        else:
+            shard, stored_customer_id = find_order_shard(stored_order_id, order_date)
+            if shard is None:
+                return {
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'statusCode': 404,
+                    'body': json.dumps({'error': 'Order not found'})
+                }
+        conn = begin_transaction(shard)
+        deleted = execute_statement(DELETE_ORDER_SQL, (stored_order_id, order_date), shard).rowcount
+        if deleted:
+            write_address_tokens(conn, [(stored_order_id, order_date, '')], replace=True)
+        else:
+            # Đơn đã lưu trữ: xóa trong orders_archive (bảng archive không có token địa chỉ)
+            cursor = archive_statement(DELETE_ARCHIVE_ORDER_SQL, (stored_order_id, order_date), shard)
+            deleted = cursor.rowcount if cursor else 0
         conn.commit()
 
-        if cursor.rowcount == 0:
-            cursor.close()
-            conn.close()
+        if deleted == 0:
             return {
                 'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
                 'statusCode': 404,
@@ -293,13 +1555,12 @@ def delete_order(order_id, order_date):
             logger.info(f"Cache invalidated: {cache_key}")
         except redis.RedisError as e:
             logger.error(f"Valkey error (primary): {e}")
+        if stored_customer_id is not None:
+            customer_index_delete(order_id, decode_id(stored_customer_id))
 
         latency_ms = (time.time() - start_time) * 1000
         logger.info(f"Delete latency: {latency_ms:.2f} ms")
 
-        cursor.close()
-        conn.close()
-
         return {
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
             'statusCode': 200,
@@ -307,15 +1568,12 @@ def delete_order(order_id, order_date):
         }
     except mysql.connector.Error as e:
         logger.error(f"Database error: {e}")
+        close_pooled_connection()
         return {
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
             'statusCode': 500,
             'body': json.dumps({'error': f'Database error: {e}'})
         }
-    finally:
-        if conn and conn.is_connected():
-            conn.close()
-            logger.info("Database connection closed")
 
 def lambda_handler(event, context):
     logger.info(f"Received event: {json.dumps(event, default=str)}")
@@ -323,7 +1581,8 @@ def lambda_handler(event, context):
         http_method = event.get('httpMethod', '')
         path_params = event.get('pathParameters', {}) or {}
         query_params = event.get('queryStringParameters', {}) or {}
-        body = {} if event.get('body') is None else json.loads(event.get('body', '{}'))
+        raw_body = request_body(event)
+        body = {} if raw_body is None else json.loads(raw_body)
 
         if http_method == 'GET':
             try:
@@ -335,7 +1594,10 @@ def lambda_handler(event, context):
                     'statusCode': 400,
                     'body': json.dumps({'error': 'page and page_size must be integers'})
                 }
-            return view_orders(page, page_size)
+            return view_orders(
+                page, page_size, query_params.get('format') == 'columnar',
+                negotiate_encoding(event.get('headers')), request_header(event, 'if-none-match')
+            )
         elif http_method == 'POST':
             customer_id = body.get('customer_id')
             order_date = body.get('order_date')
@@ -352,7 +1614,8 @@ def lambda_handler(event, context):
                     'statusCode': 400,
                     'body': json.dumps({'error': 'Missing order_id or order_date'})
                 }
-            return delete_order(order_id, order_date)
+            customer_id = path_params.get('customer_id') or query_params.get('customer_id') or body.get('customer_id')
+            return delete_order(order_id, order_date, customer_id)
         else:
             return {
                 'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
@@ -0,0 +1,489 @@
+import json
+import mysql.connector
+import redis
+import os
+import logging
+import time
+import re
+import zlib
+import uuid
+from datetime import datetime, timezone
+from decimal import Decimal
+import boto3
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger()
+
+try:
+    primary_cache = redis.Redis(
+        host=os.environ['VALKEY_PRIMARY_ENDPOINT'],
+        port=6379,
+        decode_responses=True,
+        ssl=True,
+        username=os.environ['VALKEY_USER_NAME'],
+        password=os.environ['VALKEY_PASSWORD']
+    )
+except redis.RedisError as e:
+    logger.error(f"Failed to initialize Valkey connection: {e}")
+    raise
+
+# Sharding theo customer_id: SHARD_BACKENDS (JSON) liệt kê các backend MySQL, mỗi phần tử gồm
+# host, port, database, user và password (bỏ trống password để dùng IAM token qua RDS Proxy).
+# Không đặt biến này thì chỉ có một backend là PROXY_ENDPOINT như trước.
+SHARD_SLOTS = int(os.environ.get('SHARD_SLOTS', 1024))
+
+
+def load_shard_backends():
+    spec = os.environ.get('SHARD_BACKENDS')
+    if spec:
+        return json.loads(spec)
+    return [{
+        'host': os.environ.get('PROXY_ENDPOINT'),
+        'port': 3306,
+        'database': os.environ.get('DB_NAME'),
+        'user': os.environ.get('DB_USER'),
+    }]
+
+
+SHARD_BACKENDS = load_shard_backends()
+
+# Token IAM được cache theo từng host
+cached_tokens = {}
+
+def get_db_token(backend):
+    current_time = time.time()
+
+    # Kiểm tra nếu token còn hợp lệ (giả sử TTL là 840 giây để có buffer 60 giây trước khi hết hạn)
+    cached_token, token_expiry = cached_tokens.get(backend['host'], (None, 0))
+    if cached_token and current_time < token_expiry:
+        return cached_token
+
+    # Tạo token mới
+    rds_client = boto3.client('rds')
+    cached_token = rds_client.generate_db_auth_token(
+        DBHostname=backend['host'],
+        Port=backend.get('port', 3306),
+        DBUsername=backend['user'],
+        Region=os.environ['AWS_REGION']
+    )
+    # Cập nhật thời gian hết hạn (15 phút = 900 giây, trừ 60 giây để an toàn)
+    cached_tokens[backend['host']] = (cached_token, current_time + 840)
+    return cached_token
+
+
+def get_db_connection(shard=0):
+    """Establish a MySQL database connection to one shard backend (RDS Proxy by default)."""
+    try:
+        backend = SHARD_BACKENDS[shard]
+        return mysql.connector.connect(
+            host=backend['host'],
+            port=backend.get('port', 3306),
+            user=backend['user'],
+            password=backend.get('password') or get_db_token(backend),
+            database=backend['database'],
+            connection_timeout=10
+        )
+    except mysql.connector.Error as e:
+        logger.error(f"Database connection error (shard {shard}): {e}")
+        raise
+    except Exception as e:
+        logger.error(f"Error creating database connection (shard {shard}): {str(e)}")
+        raise
+
+# Bảng shard_map trên shard 0 ghi lại các khoảng slot đã được chuyển bằng reshard-orders (bản ghi
+# sau ghi đè bản ghi trước); slot không có trong bảng thuộc về shard theo cách chia đều mặc định.
+SELECT_SHARD_MAP_SQL = "SELECT slot_start, slot_end, shard FROM shard_map ORDER BY id"
+ER_NO_SUCH_TABLE = 1146
+
+
+def default_shard_map():
+    return [slot * len(SHARD_BACKENDS) // SHARD_SLOTS for slot in range(SHARD_SLOTS)]
+
+
+def load_shard_map(conn):
+    """Read the slot -> shard list from the shard_map table on shard 0."""
+    slots = default_shard_map()
+    cursor = conn.cursor()
+    try:
+        cursor.execute(SELECT_SHARD_MAP_SQL)
+        for slot_start, slot_end, shard in cursor.fetchall():
+            slots[slot_start:slot_end + 1] = [shard] * (slot_end - slot_start + 1)
+        # Kết thúc snapshot đọc: nếu không, lần tải sau trên cùng kết nối vẫn thấy map cũ
+        conn.commit()
+    except mysql.connector.Error as e:
+        if e.errno != ER_NO_SUCH_TABLE:
+            raise
+    finally:
+        cursor.close()
+    return slots
+
+
+def shard_slot(stored_customer_id):
+    """Slot of a customer; matches MOD(CRC32(...), SHARD_SLOTS) on the stored column in reshard-orders."""
+    if isinstance(stored_customer_id, (bytes, bytearray)):
+        return zlib.crc32(bytes(stored_customer_id)) % SHARD_SLOTS
+    return zlib.crc32(stored_customer_id.lower().encode('utf-8')) % SHARD_SLOTS
+
+# Chỉ mục địa chỉ giao hàng: FULLTEXT không dùng được trên bảng partition, nên mỗi từ của
+# shipping_address được lưu vào order_address_tokens (tạo bởi create-table) trong cùng transaction với đơn hàng.
+ADDRESS_TOKEN_MAX_LENGTH = 32
+ADDRESS_TOKEN_PATTERN = re.compile(r'[^\W_]+')
+INSERT_ADDRESS_TOKENS_SQL = "INSERT IGNORE INTO order_address_tokens (token, order_id, order_date) VALUES (%s, %s, %s)"
+DELETE_ADDRESS_TOKENS_SQL = "DELETE FROM order_address_tokens WHERE order_id = %s AND order_date = %s"
+
+
+def address_tokens(address):
+    """Split a shipping address into distinct lowercase word tokens of at least 2 characters."""
+    return sorted({
+        token[:ADDRESS_TOKEN_MAX_LENGTH] for token in ADDRESS_TOKEN_PATTERN.findall(str(address).lower()) if len(token) >= 2
+    })
+
+
+def write_address_tokens(conn, orders, replace=False):
+    """Index (stored_order_id, order_date, shipping_address) tuples in conn's open transaction.
+
+    replace=True first drops the orders' existing tokens (pass an empty address to only delete).
+    A missing token table only logs a warning so writes keep working before create-table has run.
+    """
+    cursor = conn.cursor()
+    try:
+        if replace:
+            cursor.executemany(DELETE_ADDRESS_TOKENS_SQL, [(order_id, order_date) for order_id, order_date, _ in orders])
+        rows = [
+            (token, order_id, order_date)
+            for order_id, order_date, address in orders for token in address_tokens(address)
+        ]
+        if rows:
+            cursor.executemany(INSERT_ADDRESS_TOKENS_SQL, rows)
+    except mysql.connector.Error as e:
+        if e.errno != ER_NO_SUCH_TABLE:
+            raise
+        logger.warning("Table order_address_tokens is missing, run create-table to enable address search")
+    finally:
+        cursor.close()
+
+# Định dạng lưu order_id/customer_id: 'uuid' (VARCHAR(36)) hoặc 'binary' (BINARY(16))
+ORDER_ID_FORMAT = os.environ.get('ORDER_ID_FORMAT', 'uuid')
+
+
+def encode_id(value):
+    """Convert an API string ID to its storage form; raises ValueError for malformed IDs in binary mode."""
+    if ORDER_ID_FORMAT == 'binary':
+        return uuid.UUID(value).bytes
+    return value
+
+
+
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'ServerlessDB')
+
+
+def emit_metric(name, value, unit='Count', **dimensions):
+    """Write a CloudWatch Embedded Metric Format record to stdout."""
+    print(json.dumps({
+        '_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': METRICS_NAMESPACE,
+                'Dimensions': [list(dimensions)],
+                'Metrics': [{'Name': name, 'Unit': unit}]
+            }]
+        },
+        name: value,
+        **dimensions
+    }))
+
+# Chỉ mục đơn hàng gần đây theo khách hàng trong Valkey: sorted set (score = order_date) + hash bản ghi.
+# Khóa floor đánh dấu chỉ mục đã được dựng: chỉ mục đầy đủ với mọi đơn có score > floor ('-inf' = đầy đủ).
+# Khóa version tăng sau mỗi lần ghi để query-operations không dựng chỉ mục từ dữ liệu DB đã cũ.
+CUSTOMER_INDEX = os.environ.get('CUSTOMER_INDEX', 'on') == 'on'
+CUSTOMER_INDEX_MAX = int(os.environ.get('CUSTOMER_INDEX_MAX', 500))
+CUSTOMER_INDEX_TTL = int(os.environ.get('CUSTOMER_INDEX_TTL', 86400))
+
+CUSTOMER_INDEX_UPSERT_LUA = """
+redis.call('INCR', KEYS[4])
+redis.call('EXPIRE', KEYS[4], ARGV[5])
+local floor = redis.call('GET', KEYS[3])
+if not floor then return 0 end
+if floor ~= '-inf' and tonumber(ARGV[2]) <= tonumber(floor) then
+    redis.call('ZREM', KEYS[1], ARGV[1])
+    redis.call('HDEL', KEYS[2], ARGV[1])
+    return 0
+end
+redis.call('ZADD', KEYS[1], ARGV[2], ARGV[1])
+redis.call('HSET', KEYS[2], ARGV[1], ARGV[3])
+local excess = redis.call('ZCARD', KEYS[1]) - tonumber(ARGV[4])
+if excess > 0 then
+    local dropped = redis.call('ZRANGE', KEYS[1], 0, excess - 1, 'WITHSCORES')
+    for i = 1, #dropped, 2 do
+        redis.call('HDEL', KEYS[2], dropped[i])
+    end
+    redis.call('ZREMRANGEBYRANK', KEYS[1], 0, excess - 1)
+    redis.call('SET', KEYS[3], dropped[#dropped])
+end
+for i = 1, 3 do
+    redis.call('EXPIRE', KEYS[i], ARGV[5])
+end
+return 1
+"""
+
+CUSTOMER_INDEX_REMOVE_LUA = """
+redis.call('INCR', KEYS[4])
+redis.call('EXPIRE', KEYS[4], ARGV[2])
+redis.call('ZREM', KEYS[1], ARGV[1])
+redis.call('HDEL', KEYS[2], ARGV[1])
+return 1
+"""
+
+customer_index_upsert = primary_cache.register_script(CUSTOMER_INDEX_UPSERT_LUA)
+customer_index_remove = primary_cache.register_script(CUSTOMER_INDEX_REMOVE_LUA)
+
+
+def customer_index_keys(customer_id):
+    """Keys of a customer's index; the hash tag keeps them in one slot for the Lua scripts."""
+    base = f"{{orders:customer:{customer_id.lower()}}}"
+    return [base, f"{base}:records", f"{base}:floor", f"{base}:version"]
+
+
+def customer_index_record(order_id, order_date, customer_id, total_amount, status):
+    """Return (score, compact JSON record) for an order, using the same strings as filter_orders."""
+    order_datetime = datetime.fromisoformat(str(order_date))
+    score = int(order_datetime.replace(tzinfo=timezone.utc).timestamp())
+    amount = str(Decimal(str(total_amount)).quantize(Decimal('0.01')))
+    record = json.dumps([order_id, str(order_datetime), customer_id, amount, status])
+    return score, record
+
+
+def customer_index_apply(orders, client=None):
+    """Add or refresh orders (tuples of API string values) in already-built customer indexes."""
+    if not CUSTOMER_INDEX:
+        return
+    try:
+        for order_id, customer_id, order_date, total_amount, status in orders:
+            keys = customer_index_keys(customer_id)
+            try:
+                score, record = customer_index_record(order_id, order_date, customer_id, total_amount, status)
+            except (ValueError, ArithmeticError):
+                customer_index_remove(keys=keys, args=[order_id, CUSTOMER_INDEX_TTL], client=client)
+                continue
+            customer_index_upsert(
+                keys=keys, args=[order_id, score, record, CUSTOMER_INDEX_MAX, CUSTOMER_INDEX_TTL], client=client
+            )
+        if client is not None:
+            client.execute()
+    except redis.RedisError as e:
+        logger.error(f"Valkey error (customer index): {e}")
+        # DB đã commit: chỉ mục không được cập nhật sẽ trả dữ liệu cũ tới CUSTOMER_INDEX_TTL, nên bỏ nó để dựng lại
+        customer_index_invalidate({customer_id for _, customer_id, *_ in orders})
+
+
+def customer_index_invalidate(customer_ids):
+    """Best-effort drop of customer indexes so the next read rebuilds them from MySQL.
+
+    The version bump makes a build that is already running discard its result.
+    """
+    try:
+        pipe = primary_cache.pipeline(transaction=False)
+        for customer_id in customer_ids:
+            keys = customer_index_keys(customer_id)
+            pipe.delete(*keys[:3])
+            pipe.incr(keys[3])
+            pipe.expire(keys[3], CUSTOMER_INDEX_TTL)
+        pipe.execute()
+    except redis.RedisError as e:
+        logger.error(f"Valkey error (customer index invalidation): {e}")
+
+
+# Valkey stream do crud-operations ghi vào khi INGEST_MODE=buffered
+ORDER_STREAM_KEY = '{orders:ingest}'
+ORDER_DEAD_LETTER_KEY = '{orders:ingest}:dead'
+DRAIN_GROUP = os.environ.get('DRAIN_GROUP', 'order-writers')
+DRAIN_BATCH_SIZE = int(os.environ.get('DRAIN_BATCH_SIZE', 500))
+DRAIN_BLOCK_MS = int(os.environ.get('DRAIN_BLOCK_MS', 1000))
+# Entry đã giao cho consumer nhưng chưa ack sau khoảng này được nhận lại (replay) bằng XAUTOCLAIM
+DRAIN_CLAIM_IDLE_MS = int(os.environ.get('DRAIN_CLAIM_IDLE_MS', 60000))
+DRAIN_TIME_MARGIN_MS = int(os.environ.get('DRAIN_TIME_MARGIN_MS', 10000))
+
+# ON DUPLICATE KEY: một lô được replay sau khi đã commit (ack thất bại) không gây lỗi trùng khóa
+INSERT_ORDERS_SQL = (
+    "INSERT INTO orders (order_id, customer_id, order_date, total_amount, status, shipping_address) "
+    "VALUES (%s, %s, %s, %s, %s, %s) ON DUPLICATE KEY UPDATE order_id = order_id"
+)
+# Lỗi do dữ liệu của từng đơn; các lỗi khác (mất kết nối, timeout, và ProgrammingError như thiếu bảng,
+# sai schema hay thiếu quyền) làm hỏng cả lô và để lại lô trong stream để replay sau khi sửa
+ROW_ERRORS = (mysql.connector.DataError, mysql.connector.IntegrityError)
+
+
+def ensure_consumer_group():
+    try:
+        primary_cache.xgroup_create(ORDER_STREAM_KEY, DRAIN_GROUP, id='0', mkstream=True)
+    except redis.ResponseError as e:
+        if 'BUSYGROUP' not in str(e):
+            raise
+
+
+def order_row(fields):
+    return (
+        encode_id(fields['order_id']),
+        encode_id(fields['customer_id']),
+        fields['order_date'],
+        fields['total_amount'],
+        fields['status'],
+        fields['shipping_address'],
+    )
+
+
+def write_batch(conn, entries):
+    """Insert a batch of stream entries in one transaction.
+
+    If the multi-row insert is rejected because of bad data, the batch is retried row by row
+    and the offending entries are returned for dead-lettering. Returns (written, dead).
+    """
+    cursor = conn.cursor()
+    try:
+        try:
+            rows = [order_row(fields) for _, fields in entries]
+            cursor.executemany(INSERT_ORDERS_SQL, rows)
+            write_address_tokens(conn, [(row[0], row[2], row[5]) for row in rows])
+            conn.commit()
+            return entries, []
+        except (ValueError, KeyError, *ROW_ERRORS) as e:
+            conn.rollback()
+            logger.warning(f"Batch insert failed ({e}), retrying {len(entries)} orders one by one")
+
+        written, dead, written_rows = [], [], []
+        for entry in entries:
+            try:
+                row = order_row(entry[1])
+                cursor.execute(INSERT_ORDERS_SQL, row)
+                written.append(entry)
+                written_rows.append(row)
+            except (ValueError, KeyError, *ROW_ERRORS) as e:
+                dead.append((entry, str(e)))
+        write_address_tokens(conn, [(row[0], row[2], row[5]) for row in written_rows])
+        conn.commit()
+        return written, dead
+    finally:
+        cursor.close()
+
+
+def finish_batch(written, dead):
+    """Ack and delete processed entries, then refresh the caches that depend on new orders."""
+    pipe = primary_cache.pipeline(transaction=False)
+    for (_, fields), error in dead:
+        pipe.xadd(ORDER_DEAD_LETTER_KEY, {**fields, 'error': error})
+    entry_ids = [entry_id for entry_id, _ in written] + [entry_id for (entry_id, _), _ in dead]
+    pipe.xack(ORDER_STREAM_KEY, DRAIN_GROUP, *entry_ids)
+    pipe.xdel(ORDER_STREAM_KEY, *entry_ids)
+    # Xóa tombstone (negative cache) để đơn hàng vừa ghi hiển thị ngay
+    for _, fields in written:
+        pipe.delete(f"order:{fields['order_id']}:{fields['order_date']}")
+    pipe.execute()
+
+    customer_index_apply(
+        [(f['order_id'], f['customer_id'], f['order_date'], f['total_amount'], f['status']) for _, f in written],
+        primary_cache.pipeline(transaction=False)
+    )
+
+
+def read_entries(consumer, claim_start):
+    """Return (entries, next claim cursor): stale pending entries first, then new ones."""
+    if claim_start is not None:
+        claim_start, entries = primary_cache.xautoclaim(
+            ORDER_STREAM_KEY, DRAIN_GROUP, consumer, DRAIN_CLAIM_IDLE_MS,
+            start_id=claim_start, count=DRAIN_BATCH_SIZE
+        )[:2]
+        if claim_start == '0-0':
+            claim_start = None
+        if entries:
+            logger.info(f"Replaying {len(entries)} unacknowledged orders")
+            return entries, claim_start
+    response = primary_cache.xreadgroup(
+        DRAIN_GROUP, consumer, {ORDER_STREAM_KEY: '>'}, count=DRAIN_BATCH_SIZE, block=DRAIN_BLOCK_MS
+    )
+    return (response[0][1] if response else []), claim_start
+
+
+def group_entries_by_shard(entries, shard_map):
+    """Split stream entries by the shard owning each customer; malformed ids go to shard 0 and are dead-lettered there."""
+    if shard_map is None:
+        return {0: entries}
+    groups = {}
+    for entry in entries:
+        try:
+            shard = shard_map[shard_slot(encode_id(entry[1]['customer_id']))]
+        except (ValueError, KeyError):
+            shard = 0
+        groups.setdefault(shard, []).append(entry)
+    return groups
+
+
+def drain_orders(context=None):
+    start_time = time.time()
+    consumer = os.environ.get('AWS_LAMBDA_LOG_STREAM_NAME', 'local')
+    stats = {'written': 0, 'dead_lettered': 0, 'batches': 0}
+    conns = {}
+    try:
+        ensure_consumer_group()
+        conns[0] = get_db_connection(0)
+        claim_start = '0-0'
+        while context is None or context.get_remaining_time_in_millis() > DRAIN_TIME_MARGIN_MS:
+            entries, claim_start = read_entries(consumer, claim_start)
+            if not entries:
+                break
+            # Entry đã bị xóa khỏi stream trả về không có dữ liệu
+            entries = [(entry_id, fields) for entry_id, fields in entries if fields]
+            if not entries:
+                continue
+
+            # Đọc lại shard map mỗi lô để không ghi vào shard cũ sau khi reshard-orders chuyển slot
+            shard_map = load_shard_map(conns[0]) if len(SHARD_BACKENDS) > 1 else None
+            written, dead = [], []
+            for shard, shard_entries in group_entries_by_shard(entries, shard_map).items():
+                if shard not in conns:
+                    conns[shard] = get_db_connection(shard)
+                shard_written, shard_dead = write_batch(conns[shard], shard_entries)
+                written += shard_written
+                dead += shard_dead
+            finish_batch(written, dead)
+            now_ms = int(time.time() * 1000)
+            lags = [now_ms - int(fields['enqueued_ms']) for _, fields in entries]
+            stats['written'] += len(written)
+            stats['dead_lettered'] += len(dead)
+            stats['batches'] += 1
+            emit_metric('IngestRowsWritten', len(written), Operation='drain_orders')
+            emit_metric('IngestLag', max(lags), 'Milliseconds', Operation='drain_orders')
+            if dead:
+                emit_metric('IngestDeadLettered', len(dead), Operation='drain_orders')
+                logger.error(f"Moved {len(dead)} orders to {ORDER_DEAD_LETTER_KEY}")
+        status = 'completed'
+        reason = None
+    except mysql.connector.Error as e:
+        logger.error(f"Database error while draining, batch left for replay: {e}")
+        status, reason = 'failed', f'Database error: {e}'
+    except redis.RedisError as e:
+        logger.error(f"Valkey error while draining: {e}")
+        status, reason = 'failed', f'Valkey error: {e}'
+    finally:
+        for conn in conns.values():
+            if conn.is_connected():
+                conn.close()
+                logger.info("Database connection closed")
+
+    try:
+        stats['buffer_depth'] = primary_cache.xlen(ORDER_STREAM_KEY)
+        emit_metric('IngestBufferDepth', stats['buffer_depth'], Operation='drain_orders')
+    except redis.RedisError as e:
+        logger.error(f"Valkey error (buffer depth): {e}")
+
+    logger.info(f"Drained {stats['written']} orders in {stats['batches']} batch(es), latency: {(time.time() - start_time) * 1000:.2f} ms")
+    result = {'status': status, **stats}
+    if reason:
+        result['reason'] = reason
+    return result
+
+def lambda_handler(event, context):
+    logger.info(f"Received event: {json.dumps(event, default=str)}")
+    try:
+        return drain_orders(context)
+    except Exception as e:
+        logger.error(f"Unexpected error in lambda_handler: {str(e)}", exc_info=True)
+        return {'status': 'failed', 'reason': f'Internal server error: {str(e)}'}
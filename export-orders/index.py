@@ -0,0 +1,393 @@
+import json
+import mysql.connector
+import os
+import logging
+import time
+import uuid
+import csv
+import io
+import zlib
+from datetime import datetime, timezone
+import boto3
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger()
+
+# Kích thước mỗi part khi upload multipart lên S3 (tối thiểu 5 MiB, trừ part cuối)
+S3_PART_SIZE = int(os.environ.get('EXPORT_S3_PART_SIZE', 8 * 1024 * 1024))
+EXPORT_FETCH_SIZE = int(os.environ.get('EXPORT_FETCH_SIZE', 5000))
+EXPORT_ROWS_PER_PART = int(os.environ.get('EXPORT_ROWS_PER_PART', 1000000))
+EXPORT_FORMATS = {'ndjson': 'ndjson.gz', 'csv': 'csv.gz'}
+# Partition cũ được create-table chuyển sang orders_archive; export đọc cả hai bảng
+ARCHIVE_TABLE = 'orders_archive'
+ER_NO_SUCH_TABLE = 1146
+
+s3_client = boto3.client('s3')
+
+# Sharding theo customer_id: SHARD_BACKENDS (JSON) liệt kê các backend MySQL, mỗi phần tử gồm
+# host, port, database, user và password (bỏ trống password để dùng IAM token qua RDS Proxy).
+# Không đặt biến này thì chỉ có một backend là PROXY_ENDPOINT như trước.
+SHARD_SLOTS = int(os.environ.get('SHARD_SLOTS', 1024))
+
+
+def load_shard_backends():
+    spec = os.environ.get('SHARD_BACKENDS')
+    if spec:
+        return json.loads(spec)
+    return [{
+        'host': os.environ.get('PROXY_ENDPOINT'),
+        'port': 3306,
+        'database': os.environ.get('DB_NAME'),
+        'user': os.environ.get('DB_USER'),
+    }]
+
+
+SHARD_BACKENDS = load_shard_backends()
+
+# Token IAM được cache theo từng host
+cached_tokens = {}
+
+def get_db_token(backend):
+    current_time = time.time()
+
+    # Kiểm tra nếu token còn hợp lệ (giả sử TTL là 840 giây để có buffer 60 giây trước khi hết hạn)
+    cached_token, token_expiry = cached_tokens.get(backend['host'], (None, 0))
+    if cached_token and current_time < token_expiry:
+        return cached_token
+
+    # Tạo token mới
+    rds_client = boto3.client('rds')
+    cached_token = rds_client.generate_db_auth_token(
+        DBHostname=backend['host'],
+        Port=backend.get('port', 3306),
+        DBUsername=backend['user'],
+        Region=os.environ['AWS_REGION']
+    )
+    # Cập nhật thời gian hết hạn (15 phút = 900 giây, trừ 60 giây để an toàn)
+    cached_tokens[backend['host']] = (cached_token, current_time + 840)
+    return cached_token
+
+
+def get_db_connection(shard=0):
+    """Establish a MySQL database connection to one shard backend (RDS Proxy by default)."""
+    try:
+        backend = SHARD_BACKENDS[shard]
+        return mysql.connector.connect(
+            host=backend['host'],
+            port=backend.get('port', 3306),
+            user=backend['user'],
+            password=backend.get('password') or get_db_token(backend),
+            database=backend['database'],
+            connection_timeout=10
+        )
+    except mysql.connector.Error as e:
+        logger.error(f"Database connection error (shard {shard}): {e}")
+        raise
+    except Exception as e:
+        logger.error(f"Error creating database connection (shard {shard}): {str(e)}")
+        raise
+
+# Định dạng lưu order_id/customer_id: 'uuid' (VARCHAR(36)) hoặc 'binary' (BINARY(16))
+ORDER_ID_FORMAT = os.environ.get('ORDER_ID_FORMAT', 'uuid')
+
+
+def encode_id(value):
+    """Convert an API string ID to its storage form; raises ValueError for malformed IDs in binary mode."""
+    if ORDER_ID_FORMAT == 'binary':
+        return uuid.UUID(value).bytes
+    return value
+
+
+def decode_id(value):
+    """Convert a stored ID back to its canonical string form."""
+    if isinstance(value, (bytes, bytearray)):
+        return str(uuid.UUID(bytes=bytes(value)))
+    return value
+
+# Bộ chuyển đổi theo cột cho các giá trị json.dumps không tự mã hóa được (Decimal, datetime)
+COLUMN_CONVERTERS = {
+    'order_date': str,
+    'total_amount': str,
+    'created_at': str,
+    'updated_at': str,
+}
+if ORDER_ID_FORMAT == 'binary':
+    COLUMN_CONVERTERS.update({'order_id': decode_id, 'customer_id': decode_id})
+
+
+def convert_columns(column_names, rows):
+    """Apply the per-column converters to tuple rows, one column at a time."""
+    if not rows:
+        return []
+    columns = list(zip(*rows))
+    for i, name in enumerate(column_names):
+        converter = COLUMN_CONVERTERS.get(name)
+        if converter:
+            columns[i] = map(converter, columns[i])
+    return list(zip(*columns))
+
+
+def encode_ndjson(column_names, rows):
+    """Encode a chunk of tuple rows as newline-delimited JSON objects."""
+    return ''.join(
+        json.dumps(dict(zip(column_names, row))) + '\n' for row in convert_columns(column_names, rows)
+    ).encode('utf-8')
+
+
+def encode_csv(column_names, rows):
+    """Encode a chunk of tuple rows as CSV lines (without header)."""
+    buffer = io.StringIO()
+    csv.writer(buffer, lineterminator='\n').writerows(convert_columns(column_names, rows))
+    return buffer.getvalue().encode('utf-8')
+
+
+def encode_csv_header(column_names):
+    buffer = io.StringIO()
+    csv.writer(buffer, lineterminator='\n').writerow(column_names)
+    return buffer.getvalue().encode('utf-8')
+
+
+class S3MultipartWriter:
+    """Write a stream of bytes to one S3 object through multipart upload.
+
+    Only one part (S3_PART_SIZE) is buffered in memory at a time.
+    """
+
+    def __init__(self, bucket, key, content_type):
+        self.bucket = bucket
+        self.key = key
+        self.location = f"s3://{bucket}/{key}"
+        self.buffer = bytearray()
+        self.parts = []
+        self.bytes_written = 0
+        self.upload_id = s3_client.create_multipart_upload(
+            Bucket=bucket, Key=key, ContentType=content_type
+        )['UploadId']
+
+    def write(self, data):
+        self.buffer += data
+        self.bytes_written += len(data)
+        if len(self.buffer) >= S3_PART_SIZE:
+            self._upload_part()
+
+    def _upload_part(self):
+        part_number = len(self.parts) + 1
+        response = s3_client.upload_part(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+            PartNumber=part_number, Body=bytes(self.buffer)
+        )
+        self.parts.append({'ETag': response['ETag'], 'PartNumber': part_number})
+        self.buffer = bytearray()
+
+    def close(self):
+        if self.buffer or not self.parts:
+            self._upload_part()
+        s3_client.complete_multipart_upload(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+            MultipartUpload={'Parts': self.parts}
+        )
+
+    def abort(self):
+        try:
+            s3_client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+        except Exception as e:
+            logger.error(f"Failed to abort multipart upload for {self.location}: {e}")
+
+
+class LocalFileWriter:
+    """Write a stream of bytes to a local file, used for testing exports without S3."""
+
+    def __init__(self, directory, key):
+        self.path = os.path.join(directory, key)
+        self.location = self.path
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.file = open(self.path, 'wb')
+        self.bytes_written = 0
+
+    def write(self, data):
+        self.file.write(data)
+        self.bytes_written += len(data)
+
+    def close(self):
+        self.file.close()
+
+    def abort(self):
+        self.file.close()
+        os.remove(self.path)
+
+
+def open_writer(target, key, content_type='application/gzip'):
+    if target == 's3':
+        return S3MultipartWriter(os.environ['EXPORT_BUCKET'], key, content_type)
+    return LocalFileWriter(os.environ.get('EXPORT_LOCAL_DIR', '/tmp/exports'), key)
+
+
+def delete_export_parts(target, keys):
+    """Delete the completed parts of a failed export; returns the keys that could not be deleted."""
+    remaining = []
+    for key in keys:
+        try:
+            if target == 's3':
+                s3_client.delete_object(Bucket=os.environ['EXPORT_BUCKET'], Key=key)
+            else:
+                os.remove(os.path.join(os.environ.get('EXPORT_LOCAL_DIR', '/tmp/exports'), key))
+        except Exception as e:
+            logger.error(f"Failed to delete export part {key}: {e}")
+            remaining.append(key)
+    return remaining
+
+
+class GzipPartWriter:
+    """Compress encoded chunks with gzip and stream them to an export part."""
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        self.rows = 0
+
+    def write(self, data, rows=0):
+        self.rows += rows
+        compressed = self.compressor.compress(data)
+        if compressed:
+            self.writer.write(compressed)
+
+    def close(self):
+        self.writer.write(self.compressor.flush())
+        self.writer.close()
+        return {'location': self.writer.location, 'rows': self.rows, 'bytes': self.writer.bytes_written}
+
+
+def build_export_query(customer_id, status, start_date, end_date, table='orders'):
+    sql = ("SELECT order_id, order_date, customer_id, total_amount, status, shipping_address "
+           f"FROM {table} a WHERE 1=1")
+    params = []
+    if table == ARCHIVE_TABLE:
+        # Partition đang được lưu trữ có thể nằm ở cả hai bảng: chỉ lấy bản trong orders
+        sql += (" AND NOT EXISTS (SELECT 1 FROM orders o "
+                "WHERE o.order_id = a.order_id AND o.order_date = a.order_date)")
+
+    if customer_id:
+        sql += " AND customer_id = %s"
+        params.append(encode_id(customer_id))
+    if status:
+        sql += " AND status = %s"
+        params.append(status)
+    if start_date and end_date:
+        sql += " AND order_date BETWEEN %s AND %s"
+        params.extend([start_date, end_date])
+    return sql, params
+
+
+def export_orders(customer_id, status, start_date, end_date, export_format='ndjson', target='s3'):
+    start_time = time.time()
+    if export_format not in EXPORT_FORMATS:
+        return {'status': 'failed', 'reason': f"Unsupported format '{export_format}', expected one of {sorted(EXPORT_FORMATS)}"}
+    if target not in ('s3', 'local'):
+        return {'status': 'failed', 'reason': f"Unsupported target '{target}', expected 's3' or 'local'"}
+
+    export_id = f"{datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ')}-{uuid.uuid4().hex[:8]}"
+    prefix = f"{os.environ.get('EXPORT_PREFIX', 'exports').rstrip('/')}/{export_id}"
+    encode = encode_ndjson if export_format == 'ndjson' else encode_csv
+
+    conn = None
+    part = None
+    parts = []
+    part_keys = []
+    row_count = 0
+    archived_count = 0
+    try:
+        # Các shard (bảng nóng rồi bảng archive) được đọc lần lượt và ghi nối tiếp vào cùng chuỗi part
+        for shard in range(len(SHARD_BACKENDS)):
+            conn = get_db_connection(shard)
+            for table in ('orders', ARCHIVE_TABLE):
+                sql, params = build_export_query(customer_id, status, start_date, end_date, table)
+                # Cursor không buffer: đọc từng khối fetchmany thay vì tải toàn bộ kết quả vào bộ nhớ
+                cursor = conn.cursor(buffered=False)
+                try:
+                    cursor.execute(sql, params)
+                except mysql.connector.Error as e:
+                    # Shard chưa từng lưu trữ partition nào
+                    if e.errno != ER_NO_SUCH_TABLE:
+                        raise
+                    cursor.close()
+                    continue
+                column_names = cursor.column_names
+
+                while True:
+                    rows = cursor.fetchmany(EXPORT_FETCH_SIZE)
+                    if not rows:
+                        break
+                    if table == ARCHIVE_TABLE:
+                        archived_count += len(rows)
+                    while rows:
+                        if part is None:
+                            key = f"{prefix}/part-{len(parts):05d}.{EXPORT_FORMATS[export_format]}"
+                            part = GzipPartWriter(open_writer(target, key))
+                            part_keys.append(key)
+                            if export_format == 'csv':
+                                part.write(encode_csv_header(column_names))
+                        chunk = rows[:EXPORT_ROWS_PER_PART - part.rows]
+                        rows = rows[len(chunk):]
+                        part.write(encode(column_names, chunk), len(chunk))
+                        row_count += len(chunk)
+                        if part.rows >= EXPORT_ROWS_PER_PART:
+                            parts.append(part.close())
+                            part = None
+                cursor.close()
+            conn.close()
+
+        if part is not None:
+            parts.append(part.close())
+            part = None
+
+        manifest = {
+            'export_id': export_id,
+            'format': export_format,
+            'compression': 'gzip',
+            'columns': list(column_names),
+            'filters': {'customer_id': customer_id, 'status': status, 'start_date': start_date, 'end_date': end_date},
+            'row_count': row_count,
+            'archived_row_count': archived_count,
+            'parts': parts,
+            'created_at': datetime.now(timezone.utc).isoformat(),
+        }
+        manifest_writer = open_writer(target, f"{prefix}/manifest.json", 'application/json')
+        manifest_writer.write(json.dumps(manifest, indent=2).encode('utf-8'))
+        manifest_writer.close()
+        manifest['manifest_location'] = manifest_writer.location
+
+        logger.info(f"Exported {row_count} orders in {len(parts)} part(s), latency: {(time.time() - start_time) * 1000:.2f} ms")
+        return {'status': 'completed', 'manifest': manifest}
+    except Exception as e:
+        if isinstance(e, mysql.connector.Error):
+            logger.error(f"Database error during export: {e}")
+            result = {'status': 'failed', 'reason': f'Database error: {e}', 'export_id': export_id}
+        else:
+            logger.error(f"Unexpected error during export: {e}")
+            result = {'status': 'failed', 'reason': f'Unexpected error: {e}', 'export_id': export_id}
+        # Part đang ghi dở được abort; các part đã hoàn tất bị xóa để không để lại object không có manifest
+        if part is not None:
+            part.writer.abort()
+            part_keys.pop()
+        orphaned = delete_export_parts(target, part_keys)
+        if orphaned:
+            result['orphaned_parts'] = orphaned
+        return result
+    finally:
+        if conn and conn.is_connected():
+            conn.close()
+            logger.info("Database connection closed")
+
+def lambda_handler(event, context):
+    logger.info(f"Received event: {json.dumps(event, default=str)}")
+    try:
+        return export_orders(
+            event.get('customer_id'),
+            event.get('status'),
+            event.get('start_date'),
+            event.get('end_date'),
+            event.get('format', 'ndjson'),
+            event.get('target', os.environ.get('EXPORT_TARGET', 's3'))
+        )
+    except Exception as e:
+        logger.error(f"Unexpected error in lambda_handler: {str(e)}", exc_info=True)
+        return {'status': 'failed', 'reason': f'Internal server error: {str(e)}'}
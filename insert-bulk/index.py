@@ -1,14 +1,19 @@
 import json
+import base64
 import mysql.connector
 import redis
 import requests
 import os
 import logging
-import uuid
-from datetime import datetime, timedelta
-import random
 import time
+import re
+import zlib
+import uuid
+import hashlib
+from datetime import datetime, timezone
+from decimal import Decimal
 import boto3
+import numpy as np
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger()
 
@@ -25,91 +30,547 @@ except redis.RedisError as e:
     logger.error(f"Failed to initialize Valkey connection: {e}")
     raise
 
-# Biến toàn cục để lưu token và thời gian hết hạn
-cached_token = None
-token_expiry = 0
+# Sharding theo customer_id: SHARD_BACKENDS (JSON) liệt kê các backend MySQL, mỗi phần tử gồm
+# host, port, database, user và password (bỏ trống password để dùng IAM token qua RDS Proxy).
+# Không đặt biến này thì chỉ có một backend là PROXY_ENDPOINT như trước.
+SHARD_SLOTS = int(os.environ.get('SHARD_SLOTS', 1024))
+
+
+def load_shard_backends():
+    spec = os.environ.get('SHARD_BACKENDS')
+    if spec:
+        return json.loads(spec)
+    return [{
+        'host': os.environ.get('PROXY_ENDPOINT'),
+        'port': 3306,
+        'database': os.environ.get('DB_NAME'),
+        'user': os.environ.get('DB_USER'),
+    }]
+
+
+SHARD_BACKENDS = load_shard_backends()
+
+# Token IAM được cache theo từng host
+cached_tokens = {}
 
-def get_db_token():
-    global cached_token, token_expiry
+def get_db_token(backend):
     current_time = time.time()
 
     # Kiểm tra nếu token còn hợp lệ (giả sử TTL là 840 giây để có buffer 60 giây trước khi hết hạn)
+    cached_token, token_expiry = cached_tokens.get(backend['host'], (None, 0))
     if cached_token and current_time < token_expiry:
         return cached_token
 
     # Tạo token mới
     rds_client = boto3.client('rds')
     cached_token = rds_client.generate_db_auth_token(
-        DBHostname=os.environ['PROXY_ENDPOINT'],
-        Port=3306,
-        DBUsername=os.environ['DB_USER'],
+        DBHostname=backend['host'],
+        Port=backend.get('port', 3306),
+        DBUsername=backend['user'],
         Region=os.environ['AWS_REGION']
     )
     # Cập nhật thời gian hết hạn (15 phút = 900 giây, trừ 60 giây để an toàn)
-    token_expiry = current_time + 840
+    cached_tokens[backend['host']] = (cached_token, current_time + 840)
     return cached_token
 
 
-def get_db_connection():
-    """Establish a MySQL database connection via RDS Proxy."""
+def get_db_connection(shard=0):
+    """Establish a MySQL database connection to one shard backend (RDS Proxy by default)."""
     try:
-        db_token = get_db_token()
-        # secret_dict = get_secret()
+        backend = SHARD_BACKENDS[shard]
         return mysql.connector.connect(
-            # host=os.environ.get('PROXY_ENDPOINT'),
-            # user=secret_dict['username'],
-            # password=secret_dict['password'],
-            # database=secret_dict['dbname'],
-            # port=int(secret_dict['port']),
-            # connection_timeout=10
-            host=os.environ['PROXY_ENDPOINT'],
-            port=3306,
-            user=os.environ['DB_USER'],
-            password=db_token,
-            database=os.environ['DB_NAME'],
+            host=backend['host'],
+            port=backend.get('port', 3306),
+            user=backend['user'],
+            password=backend.get('password') or get_db_token(backend),
+            database=backend['database'],
             connection_timeout=10
         )
     except mysql.connector.Error as e:
-        logger.error(f"Database connection error: {e}")
+        logger.error(f"Database connection error (shard {shard}): {e}")
         raise
     except Exception as e:
-        logger.error(f"Error creating database connection: {str(e)}")
+        logger.error(f"Error creating database connection (shard {shard}): {str(e)}")
         raise
 
-def insert_bulk_orders():
-    conn = None
+# Bảng shard_map trên shard 0 ghi lại các khoảng slot đã được chuyển bằng reshard-orders (bản ghi
+# sau ghi đè bản ghi trước); slot không có trong bảng thuộc về shard theo cách chia đều mặc định.
+SELECT_SHARD_MAP_SQL = "SELECT slot_start, slot_end, shard FROM shard_map ORDER BY id"
+ER_NO_SUCH_TABLE = 1146
+
+
+def default_shard_map():
+    return [slot * len(SHARD_BACKENDS) // SHARD_SLOTS for slot in range(SHARD_SLOTS)]
+
+
+def load_shard_map(conn):
+    """Read the slot -> shard list from the shard_map table on shard 0."""
+    slots = default_shard_map()
+    cursor = conn.cursor()
+    try:
+        cursor.execute(SELECT_SHARD_MAP_SQL)
+        for slot_start, slot_end, shard in cursor.fetchall():
+            slots[slot_start:slot_end + 1] = [shard] * (slot_end - slot_start + 1)
+        # Kết thúc snapshot đọc: nếu không, lần tải sau trên cùng kết nối vẫn thấy map cũ
+        conn.commit()
+    except mysql.connector.Error as e:
+        if e.errno != ER_NO_SUCH_TABLE:
+            raise
+    finally:
+        cursor.close()
+    return slots
+
+
+def shard_slot(stored_customer_id):
+    """Slot of a customer; matches MOD(CRC32(...), SHARD_SLOTS) on the stored column in reshard-orders."""
+    if isinstance(stored_customer_id, (bytes, bytearray)):
+        return zlib.crc32(bytes(stored_customer_id)) % SHARD_SLOTS
+    return zlib.crc32(stored_customer_id.lower().encode('utf-8')) % SHARD_SLOTS
+
+# Cấu hình mặc định cho bộ sinh dữ liệu, có thể ghi đè qua biến môi trường hoặc body của request
+ORDER_STATUSES = ['pending', 'processing', 'shipped', 'delivered', 'cancelled']
+DEFAULT_GENERATOR_CONFIG = {
+    'total_orders': int(os.environ.get('BULK_TOTAL_ORDERS', 10000)),
+    'batch_size': int(os.environ.get('BULK_BATCH_SIZE', 1000)),
+    'seed': None,
+    'start_date': os.environ.get('BULK_START_DATE', '2023-01-01'),
+    'days': int(os.environ.get('BULK_DAYS', 730)),
+    'customer_count': int(os.environ.get('BULK_CUSTOMER_COUNT', 10000)),
+    'zipf_exponent': float(os.environ.get('BULK_ZIPF_EXPONENT', 1.1)),
+    'seasonal_amplitude': float(os.environ.get('BULK_SEASONAL_AMPLITUDE', 0.5)),
+    'seasonal_peak_day': int(os.environ.get('BULK_SEASONAL_PEAK_DAY', 340)),
+    'status_weights': [0.1, 0.15, 0.2, 0.5, 0.05],
+    'amount_min': float(os.environ.get('BULK_AMOUNT_MIN', 10.0)),
+    'amount_max': float(os.environ.get('BULK_AMOUNT_MAX', 1000.0)),
+    'amount_sigma': float(os.environ.get('BULK_AMOUNT_SIGMA', 0.8)),
+}
+
+HEX_DIGITS = np.frombuffer(b'0123456789abcdef', dtype=np.uint8)
+
+# Chỉ mục địa chỉ giao hàng: FULLTEXT không dùng được trên bảng partition, nên mỗi từ của
+# shipping_address được lưu vào order_address_tokens (tạo bởi create-table) trong cùng transaction với đơn hàng.
+ADDRESS_TOKEN_MAX_LENGTH = 32
+ADDRESS_TOKEN_PATTERN = re.compile(r'[^\W_]+')
+INSERT_ADDRESS_TOKENS_SQL = "INSERT IGNORE INTO order_address_tokens (token, order_id, order_date) VALUES (%s, %s, %s)"
+DELETE_ADDRESS_TOKENS_SQL = "DELETE FROM order_address_tokens WHERE order_id = %s AND order_date = %s"
+
+
+def address_tokens(address):
+    """Split a shipping address into distinct lowercase word tokens of at least 2 characters."""
+    return sorted({
+        token[:ADDRESS_TOKEN_MAX_LENGTH] for token in ADDRESS_TOKEN_PATTERN.findall(str(address).lower()) if len(token) >= 2
+    })
+
+
+def write_address_tokens(conn, orders, replace=False):
+    """Index (stored_order_id, order_date, shipping_address) tuples in conn's open transaction.
+
+    replace=True first drops the orders' existing tokens (pass an empty address to only delete).
+    A missing token table only logs a warning so writes keep working before create-table has run.
+    """
+    cursor = conn.cursor()
+    try:
+        if replace:
+            cursor.executemany(DELETE_ADDRESS_TOKENS_SQL, [(order_id, order_date) for order_id, order_date, _ in orders])
+        rows = [
+            (token, order_id, order_date)
+            for order_id, order_date, address in orders for token in address_tokens(address)
+        ]
+        if rows:
+            cursor.executemany(INSERT_ADDRESS_TOKENS_SQL, rows)
+    except mysql.connector.Error as e:
+        if e.errno != ER_NO_SUCH_TABLE:
+            raise
+        logger.warning("Table order_address_tokens is missing, run create-table to enable address search")
+    finally:
+        cursor.close()
+
+# Định dạng lưu order_id/customer_id: 'uuid' (VARCHAR(36)) hoặc 'binary' (BINARY(16))
+ORDER_ID_FORMAT = os.environ.get('ORDER_ID_FORMAT', 'uuid')
+UUID7_COUNTER_BITS = 18
+
+
+def build_generator_config(overrides):
+    """Merge request overrides into the default generator configuration; raises ValueError on invalid options."""
+    if overrides is not None and not isinstance(overrides, dict):
+        raise ValueError('request body must be a JSON object')
+    config = dict(DEFAULT_GENERATOR_CONFIG)
+    for key, value in (overrides or {}).items():
+        if key not in config:
+            raise ValueError(f"Unknown generator option '{key}'")
+        config[key] = value
+
+    # seed, start_date và days được truyền thẳng vào numpy, nơi giá trị sai chỉ lỗi trong OrderGenerator
+    seed = config['seed']
+    if seed is not None and (not isinstance(seed, int) or isinstance(seed, bool) or seed < 0):
+        raise ValueError('seed must be a non-negative integer')
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        orders = []
-        start_date = datetime(2023, 1, 1)
-        statuses = ['pending', 'processing', 'shipped', 'delivered', 'cancelled']
-        batch_size = 1000
-        total_orders = 10000
-
-        for i in range(total_orders):
-            order_id = str(uuid.uuid4())
-            customer_id = str(uuid.uuid4())
-            order_date = (start_date + timedelta(days=random.randint(0, 730))).strftime('%Y-%m-%d %H:%M:%S')
-            total_amount = round(random.uniform(10.0, 1000.0), 2)
-            status = random.choice(statuses)
-            shipping_address = f"Address {i}, Sample City, Country"
-            orders.append((order_id, customer_id, order_date, total_amount, status, shipping_address))
-
-            if len(orders) == batch_size or i == total_orders - 1:
-                sql = """
-                INSERT INTO orders (order_id, customer_id, order_date, total_amount, status, shipping_address)
-                VALUES (%s, %s, %s, %s, %s, %s)
-                """
-                cursor.executemany(sql, orders)
-                conn.commit()
-                logger.info(f"Inserted {len(orders)} orders")
-                orders = []
+        datetime.strptime(str(config['start_date']), '%Y-%m-%d')
+    except ValueError:
+        raise ValueError('start_date must be an ISO date (YYYY-MM-DD)')
+    if not isinstance(config['days'], int) or isinstance(config['days'], bool):
+        raise ValueError('days must be an integer')
+    if config['total_orders'] < 1 or config['batch_size'] < 1:
+        raise ValueError('total_orders and batch_size must be positive')
+    if config['customer_count'] < 1 or config['days'] < 1:
+        raise ValueError('customer_count and days must be positive')
+    if not isinstance(config['status_weights'], list) or len(config['status_weights']) != len(ORDER_STATUSES):
+        raise ValueError(f"status_weights must have {len(ORDER_STATUSES)} entries")
+    # Trọng số âm hoặc tổng bằng 0 làm CDF sai/NaN và sinh dữ liệu sai mà không báo lỗi
+    weights = np.asarray(config['status_weights'], dtype=np.float64)
+    if not np.all(np.isfinite(weights)) or (weights < 0).any() or weights.sum() <= 0:
+        raise ValueError('status_weights must be non-negative numbers with a positive sum')
+    if not 0 < config['amount_min'] <= config['amount_max']:
+        raise ValueError('amount_min must be positive and not greater than amount_max')
+    return config
+
+
+def split_fixed_width(chars):
+    """Turn an (n, width) array of ASCII codes into a list of n strings."""
+    width = chars.shape[1]
+    text = chars.tobytes().decode('ascii')
+    return [text[i:i + width] for i in range(0, len(text), width)]
+
+
+def format_uuids(raw):
+    """Format an (n, 16) uint8 array as canonical UUID strings in bulk."""
+    hex_chars = np.empty((raw.shape[0], 32), dtype=np.uint8)
+    hex_chars[:, 0::2] = HEX_DIGITS[raw >> 4]
+    hex_chars[:, 1::2] = HEX_DIGITS[raw & 0x0F]
+    chars = np.empty((raw.shape[0], 36), dtype=np.uint8)
+    chars[:, [8, 13, 18, 23]] = ord('-')
+    chars[:, 0:8] = hex_chars[:, 0:8]
+    chars[:, 9:13] = hex_chars[:, 8:12]
+    chars[:, 14:18] = hex_chars[:, 12:16]
+    chars[:, 19:23] = hex_chars[:, 16:20]
+    chars[:, 24:36] = hex_chars[:, 20:32]
+    return split_fixed_width(chars)
+
+
+def split_binary_ids(raw):
+    """Turn an (n, 16) uint8 array into a list of n 16-byte values for BINARY(16) columns."""
+    data = raw.tobytes()
+    return [data[i:i + 16] for i in range(0, len(data), 16)]
+
+
+def encode_uuids(raw):
+    """Encode raw UUID bytes in the storage form selected by ORDER_ID_FORMAT."""
+    if ORDER_ID_FORMAT == 'binary':
+        return split_binary_ids(raw)
+    return format_uuids(raw)
+
+
+def random_uuid4s(rng, n):
+    """Generate n random (version 4) UUIDs."""
+    raw = np.frombuffer(rng.bytes(16 * n), dtype=np.uint8).reshape(n, 16).copy()
+    raw[:, 6] = (raw[:, 6] & 0x0F) | 0x40
+    raw[:, 8] = (raw[:, 8] & 0x3F) | 0x80
+    return encode_uuids(raw)
+
+
+def sequential_uuid7s(rng, n, timestamp_ms):
+    """Generate n strictly increasing (version 7) UUIDs starting at timestamp_ms.
+
+    An 18-bit counter in rand_a/rand_b orders IDs within the same millisecond
+    (RFC 9562, method 1), so a batch appends to the right edge of the primary key.
+    """
+    raw = np.frombuffer(rng.bytes(16 * n), dtype=np.uint8).reshape(n, 16).copy()
+    index = np.arange(n, dtype=np.int64)
+    timestamps = timestamp_ms + (index >> UUID7_COUNTER_BITS)
+    counter = index & ((1 << UUID7_COUNTER_BITS) - 1)
+    raw[:, 0:6] = (timestamps[:, None] >> np.array([40, 32, 24, 16, 8, 0])) & 0xFF
+    raw[:, 6] = 0x70 | ((counter >> 14) & 0x0F)
+    raw[:, 7] = (counter >> 6) & 0xFF
+    raw[:, 8] = 0x80 | (counter & 0x3F)
+    return encode_uuids(raw)
+
+
+def ascii_table(strings):
+    """Encode equal-length strings as an (n, width) uint8 lookup table."""
+    return np.frombuffer(''.join(strings).encode('ascii'), dtype=np.uint8).reshape(len(strings), -1)
+
+
+# Bảng tra cứu 'HH:MM:SS' cho mọi giây trong ngày, dùng chung cho mọi batch
+TIME_OF_DAY_TABLE = ascii_table([f"{s // 3600:02d}:{s // 60 % 60:02d}:{s % 60:02d}" for s in range(86400)])
+
+
+class OrderGenerator:
+    """Column-oriented synthetic order generator.
+
+    Customers follow a Zipf distribution over a fixed pool so a few hot customers
+    own most orders, order dates follow a yearly seasonal curve, statuses follow a
+    configurable mix and amounts are log-normal clipped to [amount_min, amount_max].
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.rng = np.random.default_rng(config['seed'])
+        self.next_timestamp_ms = 0
+
+        # Pool khách hàng cố định, xác suất giảm dần theo hạng (Zipf)
+        self.customer_ids = np.array(random_uuid4s(self.rng, config['customer_count']), dtype=object)
+        ranks = np.arange(1, config['customer_count'] + 1, dtype=np.float64)
+        customer_weights = ranks ** -config['zipf_exponent']
+        self.customer_cdf = np.cumsum(customer_weights / customer_weights.sum())
+
+        # Phân phối ngày theo mùa: đỉnh tại seasonal_peak_day trong năm
+        start = np.datetime64(config['start_date'], 'D')
+        days = start + np.arange(config['days'])
+        self.day_table = ascii_table([str(day) for day in days])
+        day_of_year = (days - days.astype('datetime64[Y]')).astype(np.int64)
+        day_weights = 1.0 + config['seasonal_amplitude'] * np.cos(
+            2 * np.pi * (day_of_year - config['seasonal_peak_day']) / 365.25
+        )
+        day_weights = np.clip(day_weights, 0.0, None)
+        self.day_cdf = np.cumsum(day_weights / day_weights.sum())
+
+        status_weights = np.asarray(config['status_weights'], dtype=np.float64)
+        self.status_cdf = np.cumsum(status_weights / status_weights.sum())
+        self.statuses = np.array(ORDER_STATUSES, dtype=object)
+
+        # Trung vị log-normal nằm ở trung bình hình học của khoảng giá trị
+        self.amount_mu = np.log(np.sqrt(config['amount_min'] * config['amount_max']))
+
+    def _sample(self, cdf, n):
+        return np.minimum(np.searchsorted(cdf, self.rng.random(n), side='right'), len(cdf) - 1)
+
+    def generate_batch(self, start_index, n):
+        """Return a list of n order tuples ready for executemany."""
+        config = self.config
+        timestamp_ms = max(time.time_ns() // 1000000, self.next_timestamp_ms)
+        self.next_timestamp_ms = timestamp_ms + (n >> UUID7_COUNTER_BITS) + 1
+        order_ids = sequential_uuid7s(self.rng, n, timestamp_ms)
+        customer_ids = self.customer_ids[self._sample(self.customer_cdf, n)].tolist()
+        date_chars = np.empty((n, 19), dtype=np.uint8)
+        date_chars[:, 0:10] = self.day_table[self._sample(self.day_cdf, n)]
+        date_chars[:, 10] = ord(' ')
+        date_chars[:, 11:19] = TIME_OF_DAY_TABLE[self.rng.integers(0, 86400, size=n)]
+        order_dates = split_fixed_width(date_chars)
+        amounts = np.round(np.clip(
+            self.rng.lognormal(self.amount_mu, config['amount_sigma'], size=n),
+            config['amount_min'], config['amount_max']
+        ), 2).tolist()
+        statuses = self.statuses[self._sample(self.status_cdf, n)].tolist()
+        addresses = [f"Address {i}, Sample City, Country" for i in range(start_index, start_index + n)]
+        return list(zip(order_ids, customer_ids, order_dates, amounts, statuses, addresses))
+
+    def batches(self):
+        """Yield batches of order tuples until total_orders have been generated."""
+        total = self.config['total_orders']
+        batch_size = self.config['batch_size']
+        for start_index in range(0, total, batch_size):
+            yield self.generate_batch(start_index, min(batch_size, total - start_index))
+
+
+# Bloom filter (bitmap trong Valkey) dùng bởi get_order để loại nhanh order_id chưa từng được tạo
+ORDER_BLOOM_FILTER = os.environ.get('ORDER_BLOOM_FILTER', 'off') == 'on'
+ORDER_BLOOM_BITS = int(os.environ.get('ORDER_BLOOM_BITS', 1 << 24))
+ORDER_BLOOM_HASHES = 7
+ORDER_BLOOM_KEY = '{orders:bloom}'
+
+
+def decode_id(value):
+    """Convert a stored ID back to its canonical string form."""
+    if isinstance(value, (bytes, bytearray)):
+        return str(uuid.UUID(bytes=bytes(value)))
+    return value
+
+
+def bloom_offsets(order_id):
+    """Bit offsets of order_id in the Bloom filter (double hashing over one blake2b digest)."""
+    digest = hashlib.blake2b(order_id.lower().encode('utf-8'), digest_size=16).digest()
+    h1 = int.from_bytes(digest[:8], 'big')
+    h2 = int.from_bytes(digest[8:], 'big') | 1
+    return [(h1 + i * h2) % ORDER_BLOOM_BITS for i in range(ORDER_BLOOM_HASHES)]
+
+
+def bloom_add(order_ids):
+    """Set the Bloom filter bits for newly created order IDs (before they are written to MySQL)."""
+    if not ORDER_BLOOM_FILTER:
+        return
+    try:
+        pipe = primary_cache.pipeline(transaction=False)
+        for order_id in order_ids:
+            for offset in bloom_offsets(decode_id(order_id)):
+                pipe.setbit(ORDER_BLOOM_KEY, offset, 1)
+        pipe.execute()
+    except redis.RedisError as e:
+        logger.error(f"Valkey error (bloom): {e}")
+
+
+# Chỉ mục đơn hàng gần đây theo khách hàng trong Valkey: sorted set (score = order_date) + hash bản ghi.
+# Khóa floor đánh dấu chỉ mục đã được dựng: chỉ mục đầy đủ với mọi đơn có score > floor ('-inf' = đầy đủ).
+# Khóa version tăng sau mỗi lần ghi để query-operations không dựng chỉ mục từ dữ liệu DB đã cũ.
+CUSTOMER_INDEX = os.environ.get('CUSTOMER_INDEX', 'on') == 'on'
+CUSTOMER_INDEX_MAX = int(os.environ.get('CUSTOMER_INDEX_MAX', 500))
+CUSTOMER_INDEX_TTL = int(os.environ.get('CUSTOMER_INDEX_TTL', 86400))
+
+CUSTOMER_INDEX_UPSERT_LUA = """
+redis.call('INCR', KEYS[4])
+redis.call('EXPIRE', KEYS[4], ARGV[5])
+local floor = redis.call('GET', KEYS[3])
+if not floor then return 0 end
+if floor ~= '-inf' and tonumber(ARGV[2]) <= tonumber(floor) then
+    redis.call('ZREM', KEYS[1], ARGV[1])
+    redis.call('HDEL', KEYS[2], ARGV[1])
+    return 0
+end
+redis.call('ZADD', KEYS[1], ARGV[2], ARGV[1])
+redis.call('HSET', KEYS[2], ARGV[1], ARGV[3])
+local excess = redis.call('ZCARD', KEYS[1]) - tonumber(ARGV[4])
+if excess > 0 then
+    local dropped = redis.call('ZRANGE', KEYS[1], 0, excess - 1, 'WITHSCORES')
+    for i = 1, #dropped, 2 do
+        redis.call('HDEL', KEYS[2], dropped[i])
+    end
+    redis.call('ZREMRANGEBYRANK', KEYS[1], 0, excess - 1)
+    redis.call('SET', KEYS[3], dropped[#dropped])
+end
+for i = 1, 3 do
+    redis.call('EXPIRE', KEYS[i], ARGV[5])
+end
+return 1
+"""
+
+CUSTOMER_INDEX_REMOVE_LUA = """
+redis.call('INCR', KEYS[4])
+redis.call('EXPIRE', KEYS[4], ARGV[2])
+redis.call('ZREM', KEYS[1], ARGV[1])
+redis.call('HDEL', KEYS[2], ARGV[1])
+return 1
+"""
+
+customer_index_upsert = primary_cache.register_script(CUSTOMER_INDEX_UPSERT_LUA)
+customer_index_remove = primary_cache.register_script(CUSTOMER_INDEX_REMOVE_LUA)
+
+
+def customer_index_keys(customer_id):
+    """Keys of a customer's index; the hash tag keeps them in one slot for the Lua scripts."""
+    base = f"{{orders:customer:{customer_id.lower()}}}"
+    return [base, f"{base}:records", f"{base}:floor", f"{base}:version"]
+
+
+def customer_index_record(order_id, order_date, customer_id, total_amount, status):
+    """Return (score, compact JSON record) for an order, using the same strings as filter_orders."""
+    order_datetime = datetime.fromisoformat(str(order_date))
+    score = int(order_datetime.replace(tzinfo=timezone.utc).timestamp())
+    amount = str(Decimal(str(total_amount)).quantize(Decimal('0.01')))
+    record = json.dumps([order_id, str(order_datetime), customer_id, amount, status])
+    return score, record
+
+
+def customer_index_apply(orders, client=None):
+    """Add or refresh orders (tuples of API string values) in already-built customer indexes."""
+    if not CUSTOMER_INDEX:
+        return
+    try:
+        for order_id, customer_id, order_date, total_amount, status in orders:
+            keys = customer_index_keys(customer_id)
+            try:
+                score, record = customer_index_record(order_id, order_date, customer_id, total_amount, status)
+            except (ValueError, ArithmeticError):
+                customer_index_remove(keys=keys, args=[order_id, CUSTOMER_INDEX_TTL], client=client)
+                continue
+            customer_index_upsert(
+                keys=keys, args=[order_id, score, record, CUSTOMER_INDEX_MAX, CUSTOMER_INDEX_TTL], client=client
+            )
+        if client is not None:
+            client.execute()
+    except redis.RedisError as e:
+        logger.error(f"Valkey error (customer index): {e}")
+        # DB đã commit: chỉ mục không được cập nhật sẽ trả dữ liệu cũ tới CUSTOMER_INDEX_TTL, nên bỏ nó để dựng lại
+        customer_index_invalidate({customer_id for _, customer_id, *_ in orders})
+
+
+def customer_index_invalidate(customer_ids):
+    """Best-effort drop of customer indexes so the next read rebuilds them from MySQL.
+
+    The version bump makes a build that is already running discard its result.
+    """
+    try:
+        pipe = primary_cache.pipeline(transaction=False)
+        for customer_id in customer_ids:
+            keys = customer_index_keys(customer_id)
+            pipe.delete(*keys[:3])
+            pipe.incr(keys[3])
+            pipe.expire(keys[3], CUSTOMER_INDEX_TTL)
+        pipe.execute()
+    except redis.RedisError as e:
+        logger.error(f"Valkey error (customer index invalidation): {e}")
+
+
+def group_orders_by_shard(orders, shard_map):
+    """Split a batch of order tuples by the shard owning each customer."""
+    if shard_map is None:
+        return {0: orders}
+    groups = {}
+    customer_shards = {}
+    for order in orders:
+        shard = customer_shards.get(order[1])
+        if shard is None:
+            shard = customer_shards[order[1]] = shard_map[shard_slot(order[1])]
+        groups.setdefault(shard, []).append(order)
+    return groups
+
+
+def insert_bulk_orders(options=None):
+    conns = {}
+    try:
+        config = build_generator_config(options)
+    except (TypeError, ValueError) as e:
+        return {
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'statusCode': 400,
+            'body': json.dumps({'error': f'Invalid generator options: {e}'})
+        }
+
+    try:
+        conns[0] = get_db_connection(0)
+        shard_map = load_shard_map(conns[0]) if len(SHARD_BACKENDS) > 1 else None
+        sql = """
+        INSERT INTO orders (order_id, customer_id, order_date, total_amount, status, shipping_address)
+        VALUES (%s, %s, %s, %s, %s, %s)
+        """
+        generator = OrderGenerator(config)
+        generate_seconds = 0.0
+        insert_start = time.time()
+
+        batch_start = time.time()
+        for orders in generator.batches():
+            generate_seconds += time.time() - batch_start
+            bloom_add(order[0] for order in orders)
+            for shard, shard_orders in group_orders_by_shard(orders, shard_map).items():
+                if shard not in conns:
+                    conns[shard] = get_db_connection(shard)
+                cursor = conns[shard].cursor()
+                cursor.executemany(sql, shard_orders)
+                write_address_tokens(conns[shard], [(o[0], o[2], o[5]) for o in shard_orders])
+                conns[shard].commit()
+                cursor.close()
+            if CUSTOMER_INDEX:
+                customer_index_apply(
+                    ((decode_id(o[0]), decode_id(o[1]), o[2], o[3], o[4]) for o in orders),
+                    primary_cache.pipeline(transaction=False)
+                )
+            logger.info(f"Inserted {len(orders)} orders")
+            batch_start = time.time()
+
+        total_seconds = time.time() - insert_start
+        total_orders = config['total_orders']
+        logger.info(
+            f"Generated {total_orders} orders in {generate_seconds:.2f} s, "
+            f"total {total_seconds:.2f} s ({total_orders / max(total_seconds, 1e-9):.0f} rows/s)"
+        )
 
         return {
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
             'statusCode': 201,
-            'body': json.dumps({'message': f'Inserted {total_orders} orders successfully'})
+            'body': json.dumps({
+                'message': f'Inserted {total_orders} orders successfully',
+                'generate_seconds': round(generate_seconds, 3),
+                'total_seconds': round(total_seconds, 3),
+                'rows_per_second': round(total_orders / max(total_seconds, 1e-9))
+            })
         }
     except mysql.connector.Error as e:
         logger.error(f"Database error during bulk insert: {e}")
@@ -126,14 +587,31 @@ def insert_bulk_orders():
             'body': json.dumps({'error': f'Unexpected error: {e}'})
         }
     finally:
-        if conn and conn.is_connected():
-            conn.close()
-            logger.info("Database connection closed")
+        for conn in conns.values():
+            if conn.is_connected():
+                conn.close()
+                logger.info("Database connection closed")
+
+def request_body(event):
+    """Decode the API Gateway request body, which arrives base64-encoded because of BinaryMediaTypes."""
+    body = event.get('body')
+    if isinstance(body, str) and event.get('isBase64Encoded'):
+        body = base64.b64decode(body).decode('utf-8')
+    return body
 
 def lambda_handler(event, context):
     logger.info(f"Received event: {json.dumps(event, default=str)}")
     try:
-        return insert_bulk_orders()
+        body = request_body(event)
+        try:
+            options = json.loads(body) if isinstance(body, str) and body else (body or {})
+        except json.JSONDecodeError as e:
+            return {
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'statusCode': 400,
+                'body': json.dumps({'error': f'Invalid JSON body: {e}'})
+            }
+        return insert_bulk_orders(options)
     except Exception as e:
         logger.error(f"Unexpected error in lambda_handler: {str(e)}", exc_info=True)
         return {
@@ -1,20 +1,168 @@
 import json
 import mysql.connector
 import redis
+from redis.backoff import NoBackoff
+from redis.retry import Retry
 import requests
 import os
 import logging
 import time
+import uuid
+import hashlib
+import zlib
+import gzip
+import base64
+from concurrent.futures import ThreadPoolExecutor
+import heapq
+from itertools import islice
+import random
+import threading
+import re
+from datetime import date, datetime, timezone
 import time
 import boto3
+try:
+    import brotli
+except ImportError:
+    brotli = None
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger()
 
+# Circuit breaker theo từng dependency, giữ trong module state giữa các lần gọi (warm container).
+# Khi Valkey/MySQL lỗi liên tiếp, request bỏ qua dependency đó ngay thay vì chờ hết timeout.
+BREAKER_FAILURE_THRESHOLD = int(os.environ.get('BREAKER_FAILURE_THRESHOLD', 3))
+BREAKER_RESET_SECONDS = float(os.environ.get('BREAKER_RESET_SECONDS', 10))
+VALKEY_SOCKET_TIMEOUT = float(os.environ.get('VALKEY_SOCKET_TIMEOUT', 0.25))
+VALKEY_CONNECT_TIMEOUT = float(os.environ.get('VALKEY_CONNECT_TIMEOUT', 0.5))
+DB_CONNECT_TIMEOUT = int(os.environ.get('DB_CONNECT_TIMEOUT', 3))
+# Timeout đọc/ghi socket cho từng câu lệnh, tách khỏi timeout kết nối để truy vấn dài hợp lệ không bị cắt
+DB_READ_TIMEOUT = int(os.environ.get('DB_READ_TIMEOUT', 20))
+BREAKER_STATE_VALUES = {'closed': 0, 'half_open': 1, 'open': 2}
+
+
+class CircuitBreaker:
+    """Fail fast on a dependency after repeated connection failures.
+
+    closed -> open after `failure_threshold` consecutive failures. Once `reset_seconds`
+    have passed, a single call is let through as a half-open probe: success closes the
+    breaker, failure opens it again, and other calls are rejected while it runs. Calls
+    rejected while open raise `open_error`, a subclass of the dependency's own error type
+    so existing fallbacks handle it. `ignored_errors` (e.g. a slow statement hitting its
+    read timeout) count neither as a failure nor as a success.
+    The breaker is shared by request and scatter threads, so its state is kept under a lock.
+    """
+
+    def __init__(self, name, failure_errors, open_error, failure_threshold, reset_seconds, ignored_errors=()):
+        self.name = name
+        self.failure_errors = failure_errors
+        self.ignored_errors = ignored_errors
+        self.open_error = open_error
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0
+        self.lock = threading.Lock()
+
+    def call(self, func, *args, **kwargs):
+        probe = False
+        with self.lock:
+            if self.state == 'half_open' or (self.state == 'open' and time.time() - self.opened_at < self.reset_seconds):
+                emit_metric('CircuitBreakerRejected', 1, Dependency=self.name)
+                raise self.open_error(f"Circuit breaker '{self.name}' is {self.state.replace('_', '-')}")
+            if self.state == 'open':
+                self._transition('half_open')
+                probe = True
+        try:
+            result = func(*args, **kwargs)
+        except self.ignored_errors:
+            # Probe nhận được phản hồi chậm: dependency vẫn kết nối được nên không giữ breaker ở half-open
+            if probe:
+                with self.lock:
+                    self._record_success()
+            raise
+        except self.failure_errors:
+            with self.lock:
+                self._record_failure()
+            raise
+        except Exception:
+            # Dependency đã phản hồi (ví dụ lỗi cú pháp), nên vẫn tính là còn sống
+            with self.lock:
+                self._record_success()
+            raise
+        with self.lock:
+            self._record_success()
+        return result
+
+    def _record_success(self):
+        self.failures = 0
+        if self.state != 'closed':
+            self._transition('closed')
+
+    def _record_failure(self):
+        self.failures += 1
+        if self.state == 'half_open' or self.failures >= self.failure_threshold:
+            self.opened_at = time.time()
+            if self.state != 'open':
+                self._transition('open')
+
+    def _transition(self, state):
+        logger.warning(f"Circuit breaker '{self.name}': {self.state} -> {state} after {self.failures} failure(s)")
+        self.state = state
+        emit_metric('CircuitBreakerState', BREAKER_STATE_VALUES[state], 'None', Dependency=self.name)
+
+
+class ValkeyCircuitOpenError(redis.ConnectionError):
+    pass
+
+
+class DatabaseCircuitOpenError(mysql.connector.errors.OperationalError):
+    pass
+
+
+valkey_breaker = CircuitBreaker(
+    'valkey', (redis.ConnectionError, redis.TimeoutError), ValkeyCircuitOpenError,
+    BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_SECONDS
+)
+db_breakers = {}
+
+
+def db_breaker(shard=0):
+    """Breaker of one MySQL backend, so a failing shard does not cut off the others."""
+    if shard not in db_breakers:
+        db_breakers[shard] = CircuitBreaker(
+            'mysql' if len(SHARD_BACKENDS) == 1 else f"mysql-{shard}",
+            (mysql.connector.errors.InterfaceError, mysql.connector.errors.OperationalError,
+             mysql.connector.errors.ConnectionTimeoutError),
+            DatabaseCircuitOpenError, BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_SECONDS,
+            ignored_errors=(mysql.connector.errors.ReadTimeoutError, mysql.connector.errors.WriteTimeoutError)
+        )
+    return db_breakers[shard]
+
+
+class GuardedPipeline(redis.client.Pipeline):
+    def execute(self, raise_on_error=True):
+        return valkey_breaker.call(super().execute, raise_on_error)
+
+
+class GuardedRedis(redis.Redis):
+    """Valkey client whose commands, scripts and pipelines go through valkey_breaker."""
+
+    def execute_command(self, *args, **options):
+        return valkey_breaker.call(super().execute_command, *args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return GuardedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
 try:
-    primary_cache = redis.Redis(
+    primary_cache = GuardedRedis(
         host=os.environ['VALKEY_PRIMARY_ENDPOINT'],
         port=6379,
         decode_responses=True,
+        socket_timeout=VALKEY_SOCKET_TIMEOUT,
+        socket_connect_timeout=VALKEY_CONNECT_TIMEOUT,
+        # Không retry trong client: circuit breaker quyết định khi nào thử lại
+        retry=Retry(NoBackoff(), 0),
         ssl=True,
         username=os.environ['VALKEY_USER_NAME'],
         password=os.environ['VALKEY_PASSWORD']
@@ -23,80 +171,480 @@ except redis.RedisError as e:
     logger.error(f"Failed to initialize Valkey connection: {e}")
     raise
 
-# Biến toàn cục để lưu token và thời gian hết hạn
-cached_token = None
-token_expiry = 0
+# Sharding theo customer_id: SHARD_BACKENDS (JSON) liệt kê các backend MySQL, mỗi phần tử gồm
+# host, port, database, user và password (bỏ trống password để dùng IAM token qua RDS Proxy).
+# Không đặt biến này thì chỉ có một backend là PROXY_ENDPOINT như trước.
+SHARD_SLOTS = int(os.environ.get('SHARD_SLOTS', 1024))
+SHARD_MAP_REFRESH_SECONDS = int(os.environ.get('SHARD_MAP_REFRESH_SECONDS', 30))
+
+
+def load_shard_backends():
+    spec = os.environ.get('SHARD_BACKENDS')
+    if spec:
+        return json.loads(spec)
+    return [{
+        'host': os.environ.get('PROXY_ENDPOINT'),
+        'port': 3306,
+        'database': os.environ.get('DB_NAME'),
+        'user': os.environ.get('DB_USER'),
+    }]
+
+
+SHARD_BACKENDS = load_shard_backends()
 
-def get_db_token():
-    global cached_token, token_expiry
+# Token IAM được cache theo từng host
+cached_tokens = {}
+
+def get_db_token(backend):
     current_time = time.time()
 
     # Kiểm tra nếu token còn hợp lệ (giả sử TTL là 840 giây để có buffer 60 giây trước khi hết hạn)
+    cached_token, token_expiry = cached_tokens.get(backend['host'], (None, 0))
     if cached_token and current_time < token_expiry:
         return cached_token
 
     # Tạo token mới
     rds_client = boto3.client('rds')
     cached_token = rds_client.generate_db_auth_token(
-        DBHostname=os.environ['PROXY_ENDPOINT'],
-        Port=3306,
-        DBUsername=os.environ['DB_USER'],
+        DBHostname=backend['host'],
+        Port=backend.get('port', 3306),
+        DBUsername=backend['user'],
         Region=os.environ['AWS_REGION']
     )
     # Cập nhật thời gian hết hạn (15 phút = 900 giây, trừ 60 giây để an toàn)
-    token_expiry = current_time + 840
+    cached_tokens[backend['host']] = (cached_token, current_time + 840)
     return cached_token
 
 
-def get_db_connection():
-    """Establish a MySQL database connection via RDS Proxy."""
-    try:
-        db_token = get_db_token()
-        # secret_dict = get_secret()
-        return mysql.connector.connect(
-            # host=os.environ.get('PROXY_ENDPOINT'),
-            # user=secret_dict['username'],
-            # password=secret_dict['password'],
-            # database=secret_dict['dbname'],
-            # port=int(secret_dict['port']),
-            # connection_timeout=10
-            host=os.environ['PROXY_ENDPOINT'],
-            port=3306,
-            user=os.environ['DB_USER'],
-            password=db_token,
-            database=os.environ['DB_NAME'],
-            connection_timeout=10
+def get_db_connection(shard=0, autocommit=False):
+    """Establish a MySQL database connection to one shard backend (RDS Proxy by default)."""
+    try:
+        backend = SHARD_BACKENDS[shard]
+        return db_breaker(shard).call(
+            mysql.connector.connect,
+            host=backend['host'],
+            port=backend.get('port', 3306),
+            user=backend['user'],
+            password=backend.get('password') or get_db_token(backend),
+            database=backend['database'],
+            # connection_timeout chỉ áp dụng khi kết nối; câu lệnh dùng read/write timeout riêng
+            connection_timeout=DB_CONNECT_TIMEOUT,
+            read_timeout=DB_READ_TIMEOUT,
+            write_timeout=DB_READ_TIMEOUT,
+            autocommit=autocommit
         )
     except mysql.connector.Error as e:
-        logger.error(f"Database connection error: {e}")
+        logger.error(f"Database connection error (shard {shard}): {e}")
         raise
     except Exception as e:
-        logger.error(f"Error creating database connection: {str(e)}")
+        logger.error(f"Error creating database connection (shard {shard}): {str(e)}")
         raise
 
-def filter_orders(customer_id, status, start_date, end_date):
+# Kết nối được giữ lại giữa các lần gọi (warm container) để tái sử dụng prepared statement.
+# RDS Proxy ghim (pin) session khi client dùng prepared statement, vì vậy kết nối được đóng khi
+# rảnh quá PREPARED_IDLE_SECONDS (nhỏ hơn IdleClientTimeout của proxy) và có thể tắt hẳn bằng
+# PREPARED_STATEMENTS=off để quay về text protocol (không bị ghim).
+PREPARED_STATEMENTS = os.environ.get('PREPARED_STATEMENTS', 'on') == 'on'
+PREPARED_IDLE_SECONDS = int(os.environ.get('PREPARED_IDLE_SECONDS', 45))
+# ER_UNSUPPORTED_PS, ER_MAX_PREPARED_STMT_COUNT_REACHED: chuyển sang text protocol cho container này
+PREPARED_FALLBACK_ERRNOS = {1295, 1461}
+# CR_SERVER_GONE_ERROR, CR_SERVER_LOST, CR_SERVER_LOST_EXTENDED: kết nối giữ lại đã bị đóng phía server/proxy
+CONNECTION_LOST_ERRNOS = {2006, 2013, 2055}
+
+pooled_conns = {}
+pooled_conn_last_used = {}
+statement_caches = {}
+prepared_enabled = PREPARED_STATEMENTS
+# scatter chạy execute_statement trên nhiều luồng (mỗi shard một luồng): các dict dùng chung và cờ
+# prepared_enabled chỉ được sửa khi giữ lock; kết nối được mở và đóng ngoài lock
+pool_lock = threading.Lock()
+
+
+def get_pooled_connection(shard=0):
+    """Return the shard's connection kept across warm invocations, reconnecting after PREPARED_IDLE_SECONDS.
+
+    The connection runs in autocommit mode so every read sees current data instead of a
+    REPEATABLE READ snapshot held across invocations; writes open an explicit transaction.
+    It is not pinged before use: execute_statement reconnects when a statement finds it closed.
+    """
+    now = time.time()
+    with pool_lock:
+        conn = pooled_conns.get(shard)
+        expired = conn is not None and now - pooled_conn_last_used[shard] > PREPARED_IDLE_SECONDS
+    if expired:
+        close_pooled_connection(shard)
+        conn = None
+    if conn is None:
+        conn = get_db_connection(shard, autocommit=True)
+        with pool_lock:
+            pooled_conns[shard] = conn
+            statement_caches[shard] = {}
+    with pool_lock:
+        pooled_conn_last_used[shard] = now
+    return conn
+
+
+def close_pooled_connection(shard=None):
+    """Close the pooled connection of one shard (all shards by default) and drop its prepared statements."""
+    with pool_lock:
+        closing = [shard] if shard is not None else list(pooled_conns)
+        conns = [pooled_conns.pop(closing_shard, None) for closing_shard in closing]
+        for closing_shard in closing:
+            statement_caches.pop(closing_shard, None)
+    for conn in conns:
+        if conn is not None:
+            try:
+                conn.close()
+                logger.info("Database connection closed")
+            except mysql.connector.Error as e:
+                logger.error(f"Error closing database connection: {e}")
+
+
+def execute_statement(sql, params, shard=0):
+    """Execute a hot statement on a shard's pooled connection, prepared server-side when enabled.
+
+    sql must be one of the module-level *_SQL constants: a prepared cursor only skips
+    re-preparing when it is given the same string object again.
+    """
+    in_transaction = shard in pooled_conns and pooled_conns[shard].in_transaction
+    try:
+        return run_statement(sql, params, shard)
+    except (mysql.connector.errors.ReadTimeoutError, mysql.connector.errors.WriteTimeoutError):
+        # Connector đã đóng kết nối sau timeout; bỏ nó khỏi pool để lần sau mở kết nối mới
+        close_pooled_connection(shard)
+        raise
+    except mysql.connector.Error as e:
+        # Kết nối đã đóng (proxy hết idle timeout, failover): mở lại và chạy lại một lần.
+        # Không chạy lại bên trong transaction vì các câu lệnh trước đó đã mất cùng kết nối
+        if e.errno not in CONNECTION_LOST_ERRNOS or in_transaction:
+            raise
+        logger.warning(f"Pooled connection to shard {shard} was lost ({e}), reconnecting")
+        close_pooled_connection(shard)
+        return run_statement(sql, params, shard)
+
+
+def run_statement(sql, params, shard=0):
+    global prepared_enabled
+    conn = get_pooled_connection(shard)
+    if prepared_enabled:
+        try:
+            with pool_lock:
+                cache = statement_caches.setdefault(shard, {})
+                cursor = cache.get(sql)
+            if cursor is None:
+                cursor = conn.cursor(prepared=True)
+                with pool_lock:
+                    cache[sql] = cursor
+            db_breaker(shard).call(cursor.execute, sql, params)
+            return cursor
+        except mysql.connector.Error as e:
+            if e.errno not in PREPARED_FALLBACK_ERRNOS or conn.in_transaction:
+                raise
+            logger.warning(f"Prepared statements unavailable ({e}), falling back to text protocol")
+            with pool_lock:
+                prepared_enabled = False
+            # Chỉ đóng kết nối của shard này: kết nối của shard khác có thể đang chạy truy vấn ở luồng khác
+            close_pooled_connection(shard)
+            conn = get_pooled_connection(shard)
+    cursor = conn.cursor()
+    db_breaker(shard).call(cursor.execute, sql, params)
+    return cursor
+
+# Bảng shard_map trên shard 0 ghi lại các khoảng slot đã được chuyển bằng reshard-orders (bản ghi
+# sau ghi đè bản ghi trước); slot không có trong bảng thuộc về shard theo cách chia đều mặc định.
+SELECT_SHARD_MAP_SQL = "SELECT slot_start, slot_end, shard FROM shard_map ORDER BY id"
+ER_NO_SUCH_TABLE = 1146
+
+shard_map = None
+shard_map_loaded_at = 0
+
+
+def default_shard_map():
+    return [slot * len(SHARD_BACKENDS) // SHARD_SLOTS for slot in range(SHARD_SLOTS)]
+
+
+def get_shard_map():
+    """Return the slot -> shard list, reloaded from shard 0 every SHARD_MAP_REFRESH_SECONDS."""
+    global shard_map, shard_map_loaded_at
+    now = time.time()
+    if shard_map is not None and now - shard_map_loaded_at < SHARD_MAP_REFRESH_SECONDS:
+        return shard_map
+    try:
+        slots = default_shard_map()
+        for slot_start, slot_end, shard in execute_statement(SELECT_SHARD_MAP_SQL, (), 0).fetchall():
+            slots[slot_start:slot_end + 1] = [shard] * (slot_end - slot_start + 1)
+        shard_map = slots
+    except mysql.connector.Error as e:
+        # Không đoán map khi chưa từng tải được: định tuyến sai còn tệ hơn trả lỗi
+        if shard_map is None and e.errno != ER_NO_SUCH_TABLE:
+            raise
+        logger.error(f"Could not reload shard map, keeping the {'cached' if shard_map else 'default'} map: {e}")
+        shard_map = shard_map or default_shard_map()
+    shard_map_loaded_at = now
+    return shard_map
+
+
+def shard_slot(stored_customer_id):
+    """Slot of a customer; matches MOD(CRC32(...), SHARD_SLOTS) on the stored column in reshard-orders."""
+    if isinstance(stored_customer_id, (bytes, bytearray)):
+        return zlib.crc32(bytes(stored_customer_id)) % SHARD_SLOTS
+    return zlib.crc32(stored_customer_id.lower().encode('utf-8')) % SHARD_SLOTS
+
+
+def shard_for_customer(stored_customer_id):
+    if len(SHARD_BACKENDS) == 1:
+        return 0
+    return get_shard_map()[shard_slot(stored_customer_id)]
+
+
+def all_shards():
+    return range(len(SHARD_BACKENDS))
+
+
+# Truy vấn nhiều shard chạy song song, mỗi shard dùng kết nối pooled riêng
+shard_executor = ThreadPoolExecutor(max_workers=len(SHARD_BACKENDS)) if len(SHARD_BACKENDS) > 1 else None
+
+
+def scatter(func, shards=None):
+    """Run func(shard) on each shard (all by default) and return the results in shard order."""
+    shards = list(all_shards() if shards is None else shards)
+    if len(shards) == 1:
+        return [func(shards[0])]
+    return list(shard_executor.map(func, shards))
+
+# Ghi lại các câu lệnh chậm hơn SLOW_QUERY_MS vào ring buffer trong Valkey (dùng chung cho crud và query).
+# Một phần (SLOW_QUERY_EXPLAIN_RATE) được chạy thêm EXPLAIN FORMAT=JSON để lưu kế hoạch thực thi.
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', 200))
+SLOW_QUERY_EXPLAIN_RATE = float(os.environ.get('SLOW_QUERY_EXPLAIN_RATE', 0.1))
+SLOW_QUERY_RING_SIZE = int(os.environ.get('SLOW_QUERY_RING_SIZE', 500))
+SLOW_QUERY_KEY = '{slowlog:orders}'
+SQL_LITERAL_PATTERN = re.compile(r"'(?:[^'\\]|\\.|'')*'|\b\d+(?:\.\d+)?\b|%s")
+
+
+def normalize_sql(sql):
+    """Replace literals and placeholders with '?' and collapse whitespace."""
+    return ' '.join(SQL_LITERAL_PATTERN.sub('?', sql).split())
+
+
+def parameter_shape(params):
+    """Describe parameters by type only, e.g. ['bytes(16)', 'str', 'int']."""
+    return [
+        f"bytes({len(param)})" if isinstance(param, (bytes, bytearray)) else type(param).__name__
+        for param in params
+    ]
+
+
+def record_slow_query(conn, operation, sql, params, row_count, duration_ms):
+    """Record a statement in the slow-query ring buffer when it exceeded SLOW_QUERY_MS."""
+    if duration_ms < SLOW_QUERY_MS:
+        return
+    normalized = normalize_sql(sql)
+    entry = {
+        'fingerprint': hashlib.sha1(normalized.encode('utf-8')).hexdigest()[:12],
+        'operation': operation,
+        'sql': normalized,
+        'param_shape': parameter_shape(params),
+        'rows': row_count,
+        'duration_ms': round(duration_ms, 2),
+        'recorded_at': datetime.now(timezone.utc).isoformat(),
+    }
+    logger.warning(f"Slow query {entry['fingerprint']} in {operation}: {duration_ms:.2f} ms, {row_count} rows: {normalized}")
+
+    if conn is not None and random.random() < SLOW_QUERY_EXPLAIN_RATE:
+        try:
+            cursor = conn.cursor()
+            cursor.execute(f"EXPLAIN FORMAT=JSON {sql}", params)
+            entry['plan'] = json.loads(cursor.fetchone()[0])
+            cursor.close()
+        except mysql.connector.Error as e:
+            entry['plan_error'] = str(e)
+
+    try:
+        pipe = primary_cache.pipeline(transaction=False)
+        pipe.lpush(SLOW_QUERY_KEY, json.dumps(entry))
+        pipe.ltrim(SLOW_QUERY_KEY, 0, SLOW_QUERY_RING_SIZE - 1)
+        pipe.execute()
+    except redis.RedisError as e:
+        logger.error(f"Valkey error (slow query log): {e}")
+
+# Định dạng lưu order_id/customer_id: 'uuid' (VARCHAR(36)) hoặc 'binary' (BINARY(16))
+ORDER_ID_FORMAT = os.environ.get('ORDER_ID_FORMAT', 'uuid')
+
+
+def encode_id(value):
+    """Convert an API string ID to its storage form; raises ValueError for malformed IDs in binary mode."""
+    if ORDER_ID_FORMAT == 'binary':
+        return uuid.UUID(value).bytes
+    return value
+
+
+def decode_id(value):
+    """Convert a stored ID back to its canonical string form."""
+    if isinstance(value, (bytes, bytearray)):
+        return str(uuid.UUID(bytes=bytes(value)))
+    return value
+
+# Bộ chuyển đổi theo cột cho các giá trị json.dumps không tự mã hóa được (Decimal, datetime)
+COLUMN_CONVERTERS = {
+    'order_date': str,
+    'total_amount': str,
+    'created_at': str,
+    'updated_at': str,
+}
+if ORDER_ID_FORMAT == 'binary':
+    COLUMN_CONVERTERS.update({'order_id': decode_id, 'customer_id': decode_id})
+
+
+def convert_columns(column_names, rows):
+    """Apply the per-column converters to tuple rows, one column at a time."""
+    if not rows:
+        return []
+    columns = list(zip(*rows))
+    for i, name in enumerate(column_names):
+        converter = COLUMN_CONVERTERS.get(name)
+        if converter:
+            columns[i] = map(converter, columns[i])
+    return list(zip(*columns))
+
+
+def encode_rows(column_names, rows, columnar=False):
+    """Encode tuple rows as a JSON list of objects, or as {columns, rows} when columnar."""
+    converted = convert_columns(column_names, rows)
+    if columnar:
+        return json.dumps({'columns': list(column_names), 'rows': converted})
+    return json.dumps([dict(zip(column_names, row)) for row in converted])
+
+
+def encode_row(column_names, row):
+    """Encode a single tuple row as a JSON object."""
+    return json.dumps(dict(zip(column_names, convert_columns(column_names, [row])[0])))
+
+# Partition cũ được create-table (action 'archive') chuyển sang bảng nén orders_archive; các khoảng
+# ngày đã lưu trữ nằm trong orders_archive_ranges của từng shard và được đọc lại sau ARCHIVE_RANGES_REFRESH_SECONDS.
+ARCHIVE_RANGES_REFRESH_SECONDS = int(os.environ.get('ARCHIVE_RANGES_REFRESH_SECONDS', 300))
+SELECT_ARCHIVE_RANGES_SQL = "SELECT range_start, range_end FROM orders_archive_ranges"
+
+archive_ranges = {}
+archive_ranges_loaded_at = {}
+
+
+def get_archive_ranges(shard=0):
+    """Return the shard's archived [range_start, range_end) date ranges, empty before the first archive run."""
+    now = time.time()
+    if shard in archive_ranges and now - archive_ranges_loaded_at[shard] < ARCHIVE_RANGES_REFRESH_SECONDS:
+        return archive_ranges[shard]
+    try:
+        archive_ranges[shard] = [tuple(row) for row in execute_statement(SELECT_ARCHIVE_RANGES_SQL, (), shard).fetchall()]
+    except mysql.connector.Error as e:
+        if e.errno != ER_NO_SUCH_TABLE:
+            raise
+        archive_ranges[shard] = []
+    archive_ranges_loaded_at[shard] = now
+    return archive_ranges[shard]
+
+
+def archive_overlaps(ranges, start_date=None, end_date=None):
+    """Whether [start_date, end_date] can contain archived orders; an open range overlaps any archive."""
+    if not ranges:
+        return False
+    if not (start_date and end_date):
+        return True
+    try:
+        start = date.fromisoformat(str(start_date)[:10])
+        end = date.fromisoformat(str(end_date)[:10])
+    except ValueError:
+        return True
+    return any(range_start <= end and start < range_end for range_start, range_end in ranges)
+
+
+def filter_shard(shard, sql, params, start_date=None, end_date=None, ranges=None):
+    """Run a filter query on one shard over a short-lived text-protocol connection.
+
+    sql has a {table} placeholder; the archive table is only queried when the hot table
+    returned fewer than FILTER_LIMIT rows and the date range overlaps archived data.
+    Callers on a background thread pass the shard's archive ranges, loaded beforehand.
+    """
+    conn = get_db_connection(shard)
+    try:
+        cursor = conn.cursor()
+        hot_sql = sql.format(table='orders')
+        query_start = time.time()
+        cursor.execute(hot_sql, params)
+        rows = cursor.fetchall()
+        record_slow_query(conn, 'filter_orders', hot_sql, params, len(rows), (time.time() - query_start) * 1000)
+        if ranges is None:
+            ranges = get_archive_ranges(shard)
+        if len(rows) < FILTER_LIMIT and archive_overlaps(ranges, start_date, end_date):
+            archive_sql = sql.format(table='orders_archive')
+            query_start = time.time()
+            cursor.execute(archive_sql, params)
+            # Trong lúc đang lưu trữ một partition, đơn hàng có thể nằm ở cả hai bảng
+            seen = {row[0] for row in rows}
+            archived_rows = [row for row in cursor.fetchall() if row[0] not in seen]
+            record_slow_query(conn, 'filter_orders', archive_sql, params, len(archived_rows), (time.time() - query_start) * 1000)
+            emit_metric('ArchiveQuery', 1, Operation='filter_orders')
+            rows += archived_rows
+        cursor.close()
+        return cursor.column_names, rows
+    finally:
+        conn.close()
+        logger.info("Database connection closed")
+
+
+def filter_orders(customer_id, status, start_date, end_date, columnar=False, encoding=None, if_none_match=None):
     start_time = time.time()
     cache_key = f"orders:filter:{customer_id or ''}:{status or ''}:{start_date or ''}:{end_date or ''}"
+    if columnar:
+        cache_key += ":columnar"
 
-    try:
-        cached_orders = primary_cache.get(cache_key)
-        if cached_orders:
-            latency_ms = (time.time() - start_time) * 1000
-            logger.info(f"Cache hit, latency: {latency_ms:.2f} ms")
+    if customer_id:
+        try:
+            stored_customer_id = encode_id(customer_id)
+        except ValueError:
             return {
                 'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'statusCode': 200,
-                'body': cached_orders
+                'statusCode': 400,
+                'body': json.dumps({'error': 'Invalid customer_id'})
             }
-    except redis.RedisError as e:
-        logger.error(f"Valkey error (reader): {e}")
 
-    sql = "SELECT order_id, order_date, customer_id, total_amount, status FROM orders WHERE 1=1"
+    if customer_id and CUSTOMER_INDEX:
+        try:
+            # Chỉ mục chỉ được dựng từ bảng nóng nên không đủ khi khoảng ngày có dữ liệu đã lưu trữ
+            archived = archive_overlaps(get_archive_ranges(shard_for_customer(stored_customer_id)), start_date, end_date)
+            rows = customer_index_lookup(decode_id(stored_customer_id), stored_customer_id, status, start_date, end_date, archived)
+            emit_metric('CustomerIndexHit', int(rows is not None), Operation='filter_orders')
+            if rows is not None:
+                orders_json = encode_rows(FILTER_COLUMNS, rows, columnar)
+                latency_ms = (time.time() - start_time) * 1000
+                logger.info(f"Customer index hit, latency: {latency_ms:.2f} ms")
+                return json_response(f'{{"orders": {orders_json}, "latency_ms": {json.dumps(latency_ms)}}}', encoding)
+        except redis.RedisError as e:
+            logger.error(f"Valkey error (customer index): {e}")
+        except mysql.connector.Error as e:
+            logger.error(f"Database error (customer index build): {e}")
+            close_pooled_connection()
+
+    # Khoảng ngày mở (không có end_date) luôn gồm cả đơn hàng mới nhất
+    ttl, ttl_class = cache_ttl('filter', end_date if start_date and end_date else None)
+    track_key_access(cache_key)
+    hot = is_hot_key(cache_key)
+    base_ttl, ttl = ttl, max(ttl, HOT_KEY_TTL) if hot else ttl
+    if hot:
+        pinned = local_cache_get(cache_key, encoding)
+        if pinned:
+            emit_metric('LocalCacheHit', 1, KeyClass='filter')
+            etag = if_none_match and matched_etag(if_none_match, pinned[2])
+            if etag:
+                emit_metric('NotModified', 1, KeyClass='filter')
+                return not_modified_response(etag)
+            return json_response(pinned[0], encoding, pinned[1], pinned[2])
+
+    sql = "SELECT order_id, order_date, customer_id, total_amount, status FROM {table} WHERE 1=1"
     params = []
 
     if customer_id:
         sql += " AND customer_id = %s"
-        params.append(customer_id)
+        params.append(stored_customer_id)
     if status:
         sql += " AND status = %s"
         params.append(status)
@@ -106,117 +654,958 @@ def filter_orders(customer_id, status, start_date, end_date):
 
     sql += " LIMIT 100"
 
+    def target_shards():
+        return [shard_for_customer(stored_customer_id)] if customer_id else all_shards()
+
+    def load(shards, ranges=None):
+        results = scatter(
+            lambda shard: filter_shard(shard, sql, params, start_date, end_date, ranges and ranges[shard]), shards
+        )
+        # Câu SQL không có ORDER BY nên ghép kết quả các shard rồi cắt còn 100 dòng vẫn hợp lệ
+        rows = [row for _, shard_rows in results for row in shard_rows][:FILTER_LIMIT]
+        return encode_rows(results[0][0], rows, columnar)
+
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor(dictionary=True)
-        cursor.execute(sql, params)
-        orders = cursor.fetchall()
+        if if_none_match:
+            etag = check_not_modified(cache_key, if_none_match)
+            if etag:
+                emit_metric('CacheHit', 1, KeyClass='filter', TtlClass=ttl_class)
+                emit_metric('NotModified', 1, KeyClass='filter')
+                logger.info(f"Not modified, latency: {(time.time() - start_time) * 1000:.2f} ms")
+                return not_modified_response(etag)
+        # Hot key được nén trong bộ nhớ container nên chỉ đọc bản gốc
+        cached_orders, compressed_orders, etag = get_cached_body(cache_key, None if hot else encoding)
+        emit_metric('CacheHit', int(cached_orders is not None or compressed_orders is not None), KeyClass='filter', TtlClass=ttl_class)
+        if hot and cached_orders:
+            # filter_shard mở kết nối riêng; riêng khoảng ngày lưu trữ đọc qua kết nối pooled nên được nạp trước ở đây
+            try:
+                shards = target_shards()
+                ranges = {shard: get_archive_ranges(shard) for shard in shards}
+                pin_hot_key(cache_key, cached_orders, etag, ttl, base_ttl, lambda: load(shards, ranges), 'filter')
+            except mysql.connector.Error as e:
+                logger.error(f"Database error (hot key refresh): {e}")
+            pinned = local_cache_get(cache_key, encoding)
+            compressed_orders = pinned[1] if pinned else None
+        if cached_orders or compressed_orders:
+            latency_ms = (time.time() - start_time) * 1000
+            logger.info(f"Cache hit, latency: {latency_ms:.2f} ms")
+            return json_response(cached_orders, encoding, compressed_orders, etag)
+    except redis.RedisError as e:
+        logger.error(f"Valkey error (reader): {e}")
+
+    try:
+        orders_json = load(target_shards())
 
         try:
-            primary_cache.setex(cache_key, 60, json.dumps(orders, default=str))
+            fill_cache(cache_key, ttl, orders_json)
         except redis.RedisError as e:
             logger.error(f"Valkey error (primary): {e}")
+        if hot:
+            local_cache_put(cache_key, orders_json, body_etag(orders_json))
 
         latency_ms = (time.time() - start_time) * 1000
         logger.info(f"Cache miss, query latency: {latency_ms:.2f} ms")
 
-        cursor.close()
-        conn.close()
+        return json_response(f'{{"orders": {orders_json}, "latency_ms": {json.dumps(latency_ms)}}}', encoding)
+    except mysql.connector.Error as e:
+        logger.error(f"Database error: {e}")
+        return {
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'statusCode': 500,
+            'body': json.dumps({'error': f'Database error: {e}'})
+        }
+
+# Tìm kiếm theo địa chỉ giao hàng qua bảng order_address_tokens (create-table tạo và backfill, các luồng ghi
+# duy trì). Mỗi từ trong chuỗi tìm kiếm được khớp theo tiền tố; từ dài nhất dẫn truy vấn, các từ còn lại lọc bằng EXISTS.
+ADDRESS_TOKEN_MAX_LENGTH = 32
+ADDRESS_TOKEN_PATTERN = re.compile(r'[^\W_]+')
+SEARCH_MAX_TOKENS = 5
+# Từ dẫn truy vấn quá ngắn khớp tiền tố với rất nhiều dòng, và JOIN + DISTINCT ... ORDER BY phải sắp xếp toàn bộ
+SEARCH_MIN_TOKEN_LENGTH = int(os.environ.get('SEARCH_MIN_TOKEN_LENGTH', 3))
+SEARCH_MAX_PAGE_SIZE = 100
+SEARCH_MAX_RESULTS = int(os.environ.get('SEARCH_MAX_RESULTS', 1000))
+SEARCH_COLUMNS = ('order_id', 'order_date', 'customer_id', 'total_amount', 'status', 'shipping_address')
 
+
+def address_tokens(address):
+    """Split a shipping address into distinct lowercase word tokens of at least 2 characters."""
+    return sorted({
+        token[:ADDRESS_TOKEN_MAX_LENGTH] for token in ADDRESS_TOKEN_PATTERN.findall(str(address).lower()) if len(token) >= 2
+    })
+
+
+def build_search_sql(token_count):
+    sql = (
+        "SELECT DISTINCT o.order_id, o.order_date, o.customer_id, o.total_amount, o.status, o.shipping_address "
+        "FROM order_address_tokens t0 JOIN orders o ON o.order_id = t0.order_id AND o.order_date = t0.order_date "
+        "WHERE t0.token LIKE %s"
+    )
+    for index in range(1, token_count):
+        sql += (
+            f" AND EXISTS (SELECT 1 FROM order_address_tokens t{index} WHERE t{index}.order_id = o.order_id"
+            f" AND t{index}.order_date = o.order_date AND t{index}.token LIKE %s)"
+        )
+    return sql + " ORDER BY o.order_date DESC, o.order_id LIMIT %s"
+
+
+# Một câu SQL cố định cho mỗi số lượng từ để execute_statement dùng lại prepared statement
+SEARCH_SQL = {token_count: build_search_sql(token_count) for token_count in range(1, SEARCH_MAX_TOKENS + 1)}
+
+
+def search_shard(shard, tokens, limit):
+    sql = SEARCH_SQL[len(tokens)]
+    params = tuple(f"{token}%" for token in tokens) + (limit,)
+    query_start = time.time()
+    rows = execute_statement(sql, params, shard).fetchall()
+    record_slow_query(pooled_conns.get(shard), 'search_orders', sql, params, len(rows), (time.time() - query_start) * 1000)
+    return rows
+
+
+def search_orders(address, page=1, page_size=20, encoding=None, if_none_match=None):
+    """Search orders by shipping address words, newest first, across all shards.
+
+    Only orders still in the hot table are searched; archived partitions are not indexed.
+    """
+    start_time = time.time()
+    # Từ dài nhất thường chọn lọc nhất nên đứng đầu để dẫn truy vấn
+    tokens = sorted(address_tokens(address or ''), key=len, reverse=True)[:SEARCH_MAX_TOKENS]
+    if not tokens or len(tokens[0]) < SEARCH_MIN_TOKEN_LENGTH or page < 1 or not 1 <= page_size <= SEARCH_MAX_PAGE_SIZE:
         return {
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'statusCode': 200,
-            'body': json.dumps({'orders': orders, 'latency_ms': latency_ms}, default=str)
+            'statusCode': 400,
+            'body': json.dumps({
+                'error': f'address needs a word of at least {SEARCH_MIN_TOKEN_LENGTH} characters, page >= 1 '
+                         f'and page_size between 1 and {SEARCH_MAX_PAGE_SIZE}'
+            })
         }
+    offset = (page - 1) * page_size
+    if offset + page_size > SEARCH_MAX_RESULTS:
+        return {
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'statusCode': 400,
+            'body': json.dumps({'error': f'Only the first {SEARCH_MAX_RESULTS} results can be paged through, refine the address'})
+        }
+    cache_key = f"orders:search:{' '.join(sorted(tokens))}:{page}:{page_size}"
+
+    ttl, ttl_class = cache_ttl('search')
+    try:
+        if if_none_match:
+            etag = check_not_modified(cache_key, if_none_match)
+            if etag:
+                emit_metric('CacheHit', 1, KeyClass='search', TtlClass=ttl_class)
+                emit_metric('NotModified', 1, KeyClass='search')
+                logger.info(f"Not modified, latency: {(time.time() - start_time) * 1000:.2f} ms")
+                return not_modified_response(etag)
+        cached_body, compressed_body, etag = get_cached_body(cache_key, encoding)
+        emit_metric('CacheHit', int(cached_body is not None or compressed_body is not None), KeyClass='search', TtlClass=ttl_class)
+        if cached_body or compressed_body:
+            logger.info(f"Cache hit, latency: {(time.time() - start_time) * 1000:.2f} ms")
+            return json_response(cached_body, encoding, compressed_body, etag)
+    except redis.RedisError as e:
+        logger.error(f"Valkey error (reader): {e}")
+
+    try:
+        # Mỗi shard trả về offset + page_size dòng mới nhất, ghép lại theo order_date giảm dần rồi cắt trang
+        results = scatter(lambda shard: search_shard(shard, tokens, offset + page_size))
+        merged = heapq.merge(*results, key=lambda row: row[1], reverse=True)
+        rows = list(islice(merged, offset, offset + page_size))
+        body = f'{{"orders": {encode_rows(SEARCH_COLUMNS, rows)}, "page": {page}, "page_size": {page_size}}}'
+
+        try:
+            fill_cache(cache_key, ttl, body)
+        except redis.RedisError as e:
+            logger.error(f"Valkey error (primary): {e}")
+
+        logger.info(f"Cache miss, search latency: {(time.time() - start_time) * 1000:.2f} ms")
+        return json_response(body, encoding)
     except mysql.connector.Error as e:
+        if e.errno == ER_NO_SUCH_TABLE:
+            logger.error("Table order_address_tokens is missing, run create-table to enable address search")
+            return {
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'statusCode': 503,
+                'body': json.dumps({'error': 'Address search is not available yet'})
+            }
         logger.error(f"Database error: {e}")
         return {
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
             'statusCode': 500,
             'body': json.dumps({'error': f'Database error: {e}'})
         }
+
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'ServerlessDB')
+
+
+def emit_metric(name, value, unit='Count', **dimensions):
+    """Write a CloudWatch Embedded Metric Format record to stdout."""
+    print(json.dumps({
+        '_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': METRICS_NAMESPACE,
+                'Dimensions': [list(dimensions)],
+                'Metrics': [{'Name': name, 'Unit': unit}]
+            }]
+        },
+        name: value,
+        **dimensions
+    }))
+
+# Chính sách TTL theo loại khóa và tuổi dữ liệu: danh sách "tuổi_tối_thiểu_ngày:ttl_giây".
+# Dữ liệu càng cũ càng ít thay đổi nên được cache lâu hơn; tier đầu tiên áp dụng cho dữ liệu mới nhất.
+CACHE_TTL_POLICY = {
+    'order': os.environ.get('CACHE_TTL_ORDER', '0:60,7:600,90:3600'),
+    'filter': os.environ.get('CACHE_TTL_FILTER', '0:60,7:900,90:21600'),
+    'search': os.environ.get('CACHE_TTL_SEARCH', '0:60'),
+}
+
+
+def parse_ttl_tiers(spec):
+    """Parse "0:60,7:600" into [(0.0, 60), (7.0, 600)] sorted by minimum age."""
+    return sorted((float(age), int(ttl)) for age, ttl in (item.split(':') for item in spec.split(',')))
+
+
+CACHE_TTL_TIERS = {key_class: parse_ttl_tiers(spec) for key_class, spec in CACHE_TTL_POLICY.items()}
+
+
+def cache_ttl(key_class, data_date=None):
+    """Return (ttl_seconds, ttl_class) for a cache entry whose newest covered data is from data_date.
+
+    Without a data_date (open-ended ranges) the data counts as current.
+    """
+    age_days = 0
+    if data_date:
+        try:
+            data_datetime = datetime.fromisoformat(str(data_date)).replace(tzinfo=timezone.utc)
+            age_days = (datetime.now(timezone.utc) - data_datetime).total_seconds() / 86400
+        except ValueError:
+            pass
+    tiers = CACHE_TTL_TIERS[key_class]
+    min_age, ttl = tiers[0]
+    for tier_age, tier_ttl in tiers:
+        if age_days >= tier_age:
+            min_age, ttl = tier_age, tier_ttl
+    return ttl, f"{key_class}:{min_age:g}d"
+
+# Nén response theo Accept-Encoding của client. API Gateway chỉ trả body nhị phân khi body được mã hóa
+# base64 (isBase64Encoded) và BinaryMediaTypes khớp; brotli là tùy chọn, thiếu thư viện thì chỉ dùng gzip.
+RESPONSE_COMPRESSION_MIN_BYTES = int(os.environ.get('RESPONSE_COMPRESSION_MIN_BYTES', 1024))
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+
+def negotiate_encoding(headers):
+    """Pick 'br' (when brotli is installed) or 'gzip' from the request's Accept-Encoding, or None."""
+    accept = next((value or '' for name, value in (headers or {}).items() if name.lower() == 'accept-encoding'), '')
+    weights = {}
+    for token in accept.split(','):
+        name, _, params = token.partition(';')
+        weight = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                weight = float(params[2:])
+            except ValueError:
+                weight = 0.0
+        weights[name.strip().lower()] = weight
+    best, best_weight = None, 0.0
+    for encoding in (['br'] if brotli else []) + ['gzip']:
+        weight = weights.get(encoding, weights.get('*', 0.0))
+        if weight > best_weight:
+            best, best_weight = encoding, weight
+    return best
+
+
+def compress_body(body, encoding):
+    """Compress a response body and return it base64-encoded."""
+    data = body.encode('utf-8')
+    if encoding == 'br':
+        data = brotli.compress(data, quality=BROTLI_QUALITY)
+    else:
+        data = gzip.compress(data, compresslevel=GZIP_LEVEL)
+    return base64.b64encode(data).decode('ascii')
+
+
+def body_etag(body):
+    """Strong ETag of a cached body, computed once when the cache entry is filled."""
+    return '"' + hashlib.sha256(body.encode('utf-8')).hexdigest()[:32] + '"'
+
+
+def encoded_etag(etag, encoding):
+    """ETag of the compressed representation; it must differ from the uncompressed one."""
+    return f'{etag[:-1]}-{encoding}"'
+
+
+def matched_etag(if_none_match, etag):
+    """Return the If-None-Match tag matching etag or one of its compressed representations, or None."""
+    if if_none_match.strip() == '*':
+        return etag
+    accepted = {etag} | {encoded_etag(etag, encoding) for encoding in ('br', 'gzip')}
+    for tag in if_none_match.split(','):
+        tag = tag.strip().removeprefix('W/')
+        if tag in accepted:
+            return tag
+    return None
+
+
+def json_response(body, encoding=None, compressed_body=None, etag=None):
+    """Build a 200 response, compressed when the client accepts an encoding and the body is large enough."""
+    headers = {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*', 'Vary': 'Accept-Encoding'}
+    if encoding and compressed_body is None and len(body) >= RESPONSE_COMPRESSION_MIN_BYTES:
+        compressed_body = compress_body(body, encoding)
+    if compressed_body is None:
+        if etag:
+            headers['ETag'] = etag
+        return {'headers': headers, 'statusCode': 200, 'body': body}
+    headers['Content-Encoding'] = encoding
+    if etag:
+        headers['ETag'] = encoded_etag(etag, encoding)
+    return {'headers': headers, 'statusCode': 200, 'body': compressed_body, 'isBase64Encoded': True}
+
+
+def not_modified_response(etag):
+    return {
+        'headers': {'Access-Control-Allow-Origin': '*', 'Vary': 'Accept-Encoding', 'ETag': etag},
+        'statusCode': 304,
+        'body': ''
+    }
+
+
+def fill_cache(cache_key, ttl, body):
+    """Cache a body together with its ETag under the same TTL and drop compressed variants of the old body."""
+    pipe = primary_cache.pipeline(transaction=False)
+    pipe.setex(cache_key, ttl, body)
+    pipe.setex(f"{cache_key}:etag", ttl, body_etag(body))
+    pipe.delete(*(f"{cache_key}:{encoding}" for encoding in ('br', 'gzip')))
+    pipe.execute()
+
+
+def check_not_modified(cache_key, if_none_match):
+    """Return the matching ETag when the cached entry is unchanged for the client, without reading the body.
+
+    The entry must still exist: an ETag left behind by an invalidated entry never matches.
+    """
+    pipe = primary_cache.pipeline(transaction=False)
+    pipe.get(f"{cache_key}:etag")
+    pipe.exists(cache_key)
+    etag, exists = pipe.execute()
+    if not (etag and exists):
+        return None
+    return matched_etag(if_none_match, etag)
+
+
+def get_cached_body(cache_key, encoding=None):
+    """Return (body, compressed_body, etag) for a cache entry.
+
+    The compressed variant is stored next to the entry with the entry's remaining TTL the first
+    time an encoding is requested, so each cache fill is compressed at most once per encoding.
+    The variant, body and ETag are read in one round trip, so bodies below
+    RESPONSE_COMPRESSION_MIN_BYTES (which never get a variant) cost a single pipeline.
+    Variants are stored as '<etag>:<compressed body>' and ignored when the ETag no longer
+    matches, in case a fill raced with the compression of the previous body.
+    """
+    pipe = primary_cache.pipeline(transaction=False)
+    if not encoding:
+        pipe.get(cache_key)
+        pipe.get(f"{cache_key}:etag")
+        body, etag = pipe.execute()
+        return body, None, etag
+    variant_key = f"{cache_key}:{encoding}"
+    pipe.get(variant_key)
+    pipe.get(f"{cache_key}:etag")
+    pipe.get(cache_key)
+    pipe.ttl(cache_key)
+    variant, etag, body, ttl = pipe.execute()
+    if variant is not None:
+        variant_etag, _, compressed_body = variant.partition(':')
+        if variant_etag == etag:
+            return None, compressed_body, etag
+    if body is None or len(body) < RESPONSE_COMPRESSION_MIN_BYTES:
+        return body, None, etag
+    compressed_body = compress_body(body, encoding)
+    if ttl > 0 and etag:
+        primary_cache.setex(variant_key, ttl, f"{etag}:{compressed_body}")
+    return body, compressed_body, etag
+
+
+def request_header(event, name):
+    """Case-insensitive lookup of a request header."""
+    return next((value for key, value in (event.get('headers') or {}).items() if key.lower() == name), None)
+
+
+def request_body(event):
+    """Decode the API Gateway request body, which arrives base64-encoded because of BinaryMediaTypes."""
+    body = event.get('body')
+    if isinstance(body, str) and event.get('isBase64Encoded'):
+        body = base64.b64decode(body).decode('utf-8')
+    return body
+
+
+# Phát hiện hot key: một phần (HOT_KEY_SAMPLE_RATE) lượt đọc được đếm bằng ZINCRBY vào sorted set của cửa sổ
+# HOT_KEY_WINDOW_SECONDS hiện tại. Top-K của cửa sổ trước (ước lượng từ HOT_KEY_MIN_HITS lượt đọc trở lên) là hot key:
+# chúng được giữ trong bộ nhớ của container warm (HOT_KEY_LOCAL_TTL giây), được cache trong Valkey với TTL dài hơn
+# (HOT_KEY_TTL) và được dựng lại ở luồng nền khi bản trong Valkey đã cũ hơn TTL thường, nên không bao giờ hết hạn
+# giữa chừng. Lambda đóng băng luồng nền khi handler trả về; việc refresh dở dang được tiếp tục ở lần gọi sau.
+HOT_KEYS = os.environ.get('HOT_KEYS', 'on') == 'on'
+HOT_KEY_SAMPLE_RATE = float(os.environ.get('HOT_KEY_SAMPLE_RATE', 0.05))
+HOT_KEY_WINDOW_SECONDS = int(os.environ.get('HOT_KEY_WINDOW_SECONDS', 60))
+HOT_KEY_TOP_K = int(os.environ.get('HOT_KEY_TOP_K', 20))
+HOT_KEY_MIN_HITS = int(os.environ.get('HOT_KEY_MIN_HITS', 60))
+HOT_KEY_TTL = int(os.environ.get('HOT_KEY_TTL', 600))
+HOT_KEY_LOCAL_TTL = float(os.environ.get('HOT_KEY_LOCAL_TTL', 5))
+HOT_KEY_LIST_REFRESH_SECONDS = 30
+HOT_KEY_REFRESH_LOCK_SECONDS = 30
+HOT_KEY_PREFIX = '{hotkeys}'
+
+hot_keys = set()
+hot_keys_loaded_at = 0
+local_cache = {}
+refreshing_keys = set()
+refresh_executor = ThreadPoolExecutor(max_workers=2)
+# local_cache, refreshing_keys và hot_keys được sửa từ cả luồng handler lẫn luồng của refresh_executor
+hot_keys_lock = threading.Lock()
+
+
+def hot_key_window(windows_ago=0):
+    return f"{HOT_KEY_PREFIX}:{int(time.time() // HOT_KEY_WINDOW_SECONDS) - windows_ago}"
+
+
+def track_key_access(cache_key):
+    """Count a sampled read of cache_key in the current window."""
+    if not HOT_KEYS or random.random() >= HOT_KEY_SAMPLE_RATE:
+        return
+    window_key = hot_key_window()
+    try:
+        pipe = primary_cache.pipeline(transaction=False)
+        pipe.zincrby(window_key, 1, cache_key)
+        pipe.expire(window_key, HOT_KEY_WINDOW_SECONDS * 3)
+        pipe.execute()
+    except redis.RedisError as e:
+        logger.error(f"Valkey error (hot key tracking): {e}")
+
+
+def load_hot_keys(windows_ago=1):
+    """Return [(cache_key, estimated_reads)] of a window's top keys above HOT_KEY_MIN_HITS."""
+    entries = primary_cache.zrevrangebyscore(
+        hot_key_window(windows_ago), '+inf', HOT_KEY_MIN_HITS * HOT_KEY_SAMPLE_RATE,
+        start=0, num=HOT_KEY_TOP_K, withscores=True
+    )
+    return [(cache_key, round(score / HOT_KEY_SAMPLE_RATE)) for cache_key, score in entries]
+
+
+def is_hot_key(cache_key):
+    """Whether cache_key was hot in the last complete window; the list is reloaded every HOT_KEY_LIST_REFRESH_SECONDS."""
+    global hot_keys, hot_keys_loaded_at
+    if not HOT_KEYS:
+        return False
+    now = time.time()
+    if now - hot_keys_loaded_at >= HOT_KEY_LIST_REFRESH_SECONDS:
+        hot_keys_loaded_at = now
+        try:
+            loaded = {key for key, _ in load_hot_keys()}
+        except redis.RedisError as e:
+            logger.error(f"Valkey error (hot keys): {e}")
+            loaded = hot_keys
+        with hot_keys_lock:
+            hot_keys = loaded
+            # Key không còn hot thì bỏ khỏi bộ nhớ của container
+            for key in list(local_cache):
+                if key not in hot_keys:
+                    del local_cache[key]
+    with hot_keys_lock:
+        return cache_key in hot_keys
+
+
+def local_cache_get(cache_key, encoding=None):
+    """Return (body, compressed_body, etag) of a hot key kept in this container, or None when absent or expired."""
+    with hot_keys_lock:
+        entry = local_cache.get(cache_key)
+        if entry is None or time.time() >= entry['expires_at']:
+            return None
+        compressed_body = entry['variants'].get(encoding) if encoding else None
+    if encoding and compressed_body is None and len(entry['body']) >= RESPONSE_COMPRESSION_MIN_BYTES:
+        # Nén ngoài lock; entry thay thế bởi refresh là dict mới nên không nhận nhầm bản nén cũ
+        compressed_body = compress_body(entry['body'], encoding)
+        with hot_keys_lock:
+            entry['variants'][encoding] = compressed_body
+    return entry['body'], compressed_body, entry['etag']
+
+
+def local_cache_put(cache_key, body, etag):
+    with hot_keys_lock:
+        local_cache[cache_key] = {'body': body, 'etag': etag, 'variants': {}, 'expires_at': time.time() + HOT_KEY_LOCAL_TTL}
+
+
+def refresh_hot_key(cache_key, ttl, loader, key_class):
+    """Rebuild a hot key with loader() on a background thread and store it in Valkey and this container.
+
+    A short NX lock in Valkey lets a single container rebuild each key.
+    """
+    try:
+        if not primary_cache.set(f"{cache_key}:refresh", 1, nx=True, ex=HOT_KEY_REFRESH_LOCK_SECONDS):
+            return
+        body = loader()
+        fill_cache(cache_key, ttl, body)
+        local_cache_put(cache_key, body, body_etag(body))
+        emit_metric('HotKeyRefresh', 1, KeyClass=key_class)
+    except (redis.RedisError, mysql.connector.Error) as e:
+        logger.error(f"Error refreshing hot key {cache_key}: {e}")
+    except Exception as e:
+        logger.error(f"Unexpected error refreshing hot key {cache_key}: {e}", exc_info=True)
+    finally:
+        with hot_keys_lock:
+            refreshing_keys.discard(cache_key)
+
+
+def pin_hot_key(cache_key, body, etag, ttl, base_ttl, loader, key_class):
+    """Keep a hot key read from Valkey in this container and schedule a rebuild once it is older than base_ttl.
+
+    loader runs on another thread, so it must not use the pooled connections of the request.
+    """
+    local_cache_put(cache_key, body, etag)
+    with hot_keys_lock:
+        if cache_key in refreshing_keys:
+            return
+    try:
+        remaining = primary_cache.ttl(cache_key)
+    except redis.RedisError as e:
+        logger.error(f"Valkey error (hot key TTL): {e}")
+        return
+    if 0 <= remaining <= ttl - base_ttl:
+        with hot_keys_lock:
+            if cache_key in refreshing_keys:
+                return
+            refreshing_keys.add(cache_key)
+        refresh_executor.submit(refresh_hot_key, cache_key, ttl, loader, key_class)
+
+
+# Tombstone ngắn hạn cho các lần tra cứu không tìm thấy đơn hàng (negative caching)
+NEGATIVE_CACHE_TTL = int(os.environ.get('NEGATIVE_CACHE_TTL', 15))
+NEGATIVE_CACHE_MARKER = '__missing__'
+
+# Bloom filter (bitmap trong Valkey) để loại nhanh order_id chưa từng được tạo.
+# Chỉ được dùng để trả 404 khi cờ ready tồn tại, tức là đã rebuild từ toàn bộ bảng orders.
+ORDER_BLOOM_FILTER = os.environ.get('ORDER_BLOOM_FILTER', 'off') == 'on'
+ORDER_BLOOM_BITS = int(os.environ.get('ORDER_BLOOM_BITS', 1 << 24))
+ORDER_BLOOM_HASHES = 7
+ORDER_BLOOM_KEY = '{orders:bloom}'
+ORDER_BLOOM_READY_KEY = '{orders:bloom}:ready'
+
+
+def bloom_offsets(order_id):
+    """Bit offsets of order_id in the Bloom filter (double hashing over one blake2b digest)."""
+    digest = hashlib.blake2b(order_id.lower().encode('utf-8'), digest_size=16).digest()
+    h1 = int.from_bytes(digest[:8], 'big')
+    h2 = int.from_bytes(digest[8:], 'big') | 1
+    return [(h1 + i * h2) % ORDER_BLOOM_BITS for i in range(ORDER_BLOOM_HASHES)]
+
+
+def bloom_might_contain(order_id):
+    """Return False only when a ready Bloom filter proves order_id was never inserted."""
+    if not ORDER_BLOOM_FILTER:
+        return True
+    try:
+        pipe = primary_cache.pipeline(transaction=False)
+        pipe.exists(ORDER_BLOOM_READY_KEY)
+        for offset in bloom_offsets(order_id):
+            pipe.getbit(ORDER_BLOOM_KEY, offset)
+        ready, *bits = pipe.execute()
+        return not ready or all(bits)
+    except redis.RedisError as e:
+        logger.error(f"Valkey error (bloom): {e}")
+        return True
+
+
+def rebuild_order_bloom(reset=False):
+    """Add every order_id in the table to the Bloom filter and mark it ready.
+
+    Bits are OR-ed into the live bitmap, so orders inserted while the rebuild runs are
+    never lost; reset=True clears stale bits from deleted orders first.
+    """
+    conn = None
+    try:
+        if reset:
+            primary_cache.delete(ORDER_BLOOM_READY_KEY, ORDER_BLOOM_KEY)
+        count = 0
+        for shard in all_shards():
+            conn = get_db_connection(shard)
+            # Đơn hàng đã lưu trữ vẫn đọc được qua get_order nên cũng phải có trong Bloom filter
+            for table in ('orders', 'orders_archive') if get_archive_ranges(shard) else ('orders',):
+                cursor = conn.cursor(buffered=False)
+                cursor.execute(f"SELECT order_id FROM {table}")
+                while True:
+                    rows = cursor.fetchmany(10000)
+                    if not rows:
+                        break
+                    pipe = primary_cache.pipeline(transaction=False)
+                    for (stored_order_id,) in rows:
+                        for offset in bloom_offsets(decode_id(stored_order_id)):
+                            pipe.setbit(ORDER_BLOOM_KEY, offset, 1)
+                    pipe.execute()
+                    count += len(rows)
+                cursor.close()
+            conn.close()
+        primary_cache.set(ORDER_BLOOM_READY_KEY, 1)
+        logger.info(f"Bloom filter rebuilt with {count} orders")
+        return {'status': 'completed', 'orders': count}
+    except (mysql.connector.Error, redis.RedisError) as e:
+        logger.error(f"Error rebuilding bloom filter: {e}")
+        return {'status': 'failed', 'reason': str(e)}
     finally:
         if conn and conn.is_connected():
             conn.close()
             logger.info("Database connection closed")
 
-def get_order(order_id, order_date):
+# Chỉ mục đơn hàng gần đây theo khách hàng trong Valkey (được duy trì bởi crud-operations và insert-bulk).
+# Khóa floor đánh dấu chỉ mục đã được dựng: chỉ mục đầy đủ với mọi đơn có score > floor ('-inf' = đầy đủ).
+CUSTOMER_INDEX = os.environ.get('CUSTOMER_INDEX', 'on') == 'on'
+CUSTOMER_INDEX_MAX = int(os.environ.get('CUSTOMER_INDEX_MAX', 500))
+CUSTOMER_INDEX_TTL = int(os.environ.get('CUSTOMER_INDEX_TTL', 86400))
+FILTER_LIMIT = 100
+FILTER_COLUMNS = ('order_id', 'order_date', 'customer_id', 'total_amount', 'status')
+
+# Chỉ ghi chỉ mục nếu không có lần ghi nào (version) xảy ra kể từ khi đọc DB
+CUSTOMER_INDEX_BUILD_LUA = """
+local version = redis.call('GET', KEYS[4]) or '0'
+if version ~= ARGV[1] then return 0 end
+redis.call('DEL', KEYS[1], KEYS[2])
+for i = 4, #ARGV, 3 do
+    redis.call('ZADD', KEYS[1], ARGV[i + 1], ARGV[i])
+    redis.call('HSET', KEYS[2], ARGV[i], ARGV[i + 2])
+end
+redis.call('SET', KEYS[3], ARGV[3], 'EX', ARGV[2])
+for i = 1, 2 do
+    redis.call('EXPIRE', KEYS[i], ARGV[2])
+end
+return 1
+"""
+
+CUSTOMER_INDEX_READ_LUA = """
+local floor = redis.call('GET', KEYS[3])
+if not floor then return {'missing'} end
+local min = ARGV[1]
+local coverage = 'complete'
+if floor ~= '-inf' and (min == '-inf' or tonumber(min) <= tonumber(floor)) then
+    min = '(' .. floor
+    coverage = 'partial'
+end
+local result = {coverage}
+local ids = redis.call('ZREVRANGEBYSCORE', KEYS[1], ARGV[2], min)
+if #ids > 0 then
+    local records = redis.call('HMGET', KEYS[2], unpack(ids))
+    for i = 1, #records do
+        result[#result + 1] = records[i]
+    end
+end
+return result
+"""
+
+customer_index_build_script = primary_cache.register_script(CUSTOMER_INDEX_BUILD_LUA)
+customer_index_read_script = primary_cache.register_script(CUSTOMER_INDEX_READ_LUA)
+
+
+def customer_index_keys(customer_id):
+    """Keys of a customer's index; the hash tag keeps them in one slot for the Lua scripts."""
+    base = f"{{orders:customer:{customer_id.lower()}}}"
+    return [base, f"{base}:records", f"{base}:floor", f"{base}:version"]
+
+
+def order_date_score(value):
+    return int(datetime.fromisoformat(str(value)).replace(tzinfo=timezone.utc).timestamp())
+
+
+def customer_index_build(customer_id, stored_customer_id):
+    """Load a customer's newest CUSTOMER_INDEX_MAX orders from MySQL into the index."""
+    keys = customer_index_keys(customer_id)
+    version = primary_cache.get(keys[3]) or '0'
+    shard = shard_for_customer(stored_customer_id)
+    query_start = time.time()
+    cursor = execute_statement(CUSTOMER_INDEX_BUILD_SQL, (stored_customer_id, CUSTOMER_INDEX_MAX + 1), shard)
+    rows = cursor.fetchall()
+    record_slow_query(
+        pooled_conns.get(shard), 'customer_index_build', CUSTOMER_INDEX_BUILD_SQL,
+        (stored_customer_id, CUSTOMER_INDEX_MAX + 1), len(rows), (time.time() - query_start) * 1000
+    )
+
+    floor = '-inf'
+    if len(rows) > CUSTOMER_INDEX_MAX:
+        floor = order_date_score(rows[CUSTOMER_INDEX_MAX][1])
+        rows = rows[:CUSTOMER_INDEX_MAX]
+    args = [version, CUSTOMER_INDEX_TTL, floor]
+    for row, record in zip(rows, convert_columns(cursor.column_names, rows)):
+        args.extend([record[0], order_date_score(row[1]), json.dumps(record)])
+    built = customer_index_build_script(keys=keys, args=args)
+    logger.info(f"Customer index build for {customer_id}: {len(rows)} orders, floor {floor}, applied={bool(built)}")
+
+
+def customer_index_lookup(customer_id, stored_customer_id, status, start_date, end_date, archived=False):
+    """Answer a customer filter from the index, or return None when MySQL must be queried.
+
+    archived means the range may hold archived orders, so a complete index is not a complete answer.
+    """
+    if start_date and end_date:
+        try:
+            score_range = [order_date_score(start_date), order_date_score(end_date)]
+        except ValueError:
+            return None
+    else:
+        score_range = ['-inf', '+inf']
+
+    keys = customer_index_keys(customer_id)
+    coverage, *records = customer_index_read_script(keys=keys[:3], args=score_range)
+    if coverage == 'missing':
+        customer_index_build(customer_id, stored_customer_id)
+        coverage, *records = customer_index_read_script(keys=keys[:3], args=score_range)
+        if coverage == 'missing':
+            return None
+
+    rows = [row for row in (json.loads(record) for record in records if record) if not status or row[4] == status]
+    # Câu SQL gốc không có ORDER BY, nên 100 đơn mới nhất khớp điều kiện cũng là một kết quả hợp lệ
+    if (coverage == 'complete' and not archived) or len(rows) >= FILTER_LIMIT:
+        return rows[:FILTER_LIMIT]
+    return None
+
+# Câu lệnh nóng chạy qua execute_statement (prepared statement)
+SELECT_ORDER_SQL = (
+    "SELECT order_id, order_date, customer_id, total_amount, status, shipping_address "
+    "FROM orders WHERE order_id = %s AND order_date = %s"
+)
+SELECT_ARCHIVED_ORDER_SQL = (
+    "SELECT order_id, order_date, customer_id, total_amount, status, shipping_address "
+    "FROM orders_archive WHERE order_id = %s AND order_date = %s"
+)
+CUSTOMER_INDEX_BUILD_SQL = (
+    "SELECT order_id, order_date, customer_id, total_amount, status "
+    "FROM orders WHERE customer_id = %s ORDER BY order_date DESC LIMIT %s"
+)
+
+def fetch_order(shard, stored_order_id, order_date):
+    query_start = time.time()
+    cursor = execute_statement(SELECT_ORDER_SQL, (stored_order_id, order_date), shard)
+    rows = cursor.fetchall()
+    record_slow_query(
+        pooled_conns.get(shard), 'get_order', SELECT_ORDER_SQL, (stored_order_id, order_date),
+        len(rows), (time.time() - query_start) * 1000
+    )
+    if not rows and archive_overlaps(get_archive_ranges(shard), order_date, order_date):
+        cursor = execute_statement(SELECT_ARCHIVED_ORDER_SQL, (stored_order_id, order_date), shard)
+        rows = cursor.fetchall()
+        emit_metric('ArchiveQuery', 1, Operation='get_order')
+    return cursor.column_names, rows
+
+
+def get_order(order_id, order_date, customer_id=None, encoding=None, if_none_match=None):
     start_time = time.time()
     cache_key = f"order:{order_id}:{order_date}"
 
+    ttl, ttl_class = cache_ttl('order', order_date)
     try:
-        cached_order = primary_cache.get(cache_key)
-        if cached_order:
-            latency_ms = (time.time() - start_time) * 1000
-            logger.info(f"Cache hit, latency: {latency_ms:.2f} ms")
+        if if_none_match:
+            etag = check_not_modified(cache_key, if_none_match)
+            if etag:
+                emit_metric('CacheHit', 1, KeyClass='order', TtlClass=ttl_class)
+                emit_metric('NotModified', 1, KeyClass='order')
+                logger.info(f"Not modified, latency: {(time.time() - start_time) * 1000:.2f} ms")
+                return not_modified_response(etag)
+        cached_order, _, etag = get_cached_body(cache_key)
+        emit_metric('CacheHit', int(cached_order is not None), KeyClass='order', TtlClass=ttl_class)
+        if cached_order == NEGATIVE_CACHE_MARKER:
+            emit_metric('NegativeCacheHit', 1, Operation='get_order')
+            logger.info(f"Negative cache hit, latency: {(time.time() - start_time) * 1000:.2f} ms")
             return {
                 'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'statusCode': 200,
-                'body': cached_order
+                'statusCode': 404,
+                'body': json.dumps({'error': 'Order not found'})
             }
+        if cached_order:
+            emit_metric('NegativeCacheHit', 0, Operation='get_order')
+            latency_ms = (time.time() - start_time) * 1000
+            logger.info(f"Cache hit, latency: {latency_ms:.2f} ms")
+            return json_response(cached_order, encoding, etag=etag)
     except redis.RedisError as e:
         logger.error(f"Valkey error (reader): {e}")
 
+    if not bloom_might_contain(order_id):
+        emit_metric('NegativeCacheHit', 1, Operation='get_order')
+        logger.info(f"Bloom filter miss, latency: {(time.time() - start_time) * 1000:.2f} ms")
+        return {
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'statusCode': 404,
+            'body': json.dumps({'error': 'Order not found'})
+        }
+    emit_metric('NegativeCacheHit', 0, Operation='get_order')
+
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor(dictionary=True)
-        cursor.execute(
-            "SELECT order_id, order_date, customer_id, total_amount, status, shipping_address "
-            "FROM orders WHERE order_id = %s AND order_date = %s",
-            (order_id, order_date)
-        )
-        order = cursor.fetchone()
+        stored_order_id = encode_id(order_id)
+    except ValueError:
+        return {
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'statusCode': 400,
+            'body': json.dumps({'error': 'Invalid order_id'})
+        }
 
-        if not order:
+    try:
+        stored_customer_id = encode_id(customer_id) if customer_id else None
+    except ValueError:
+        return {
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'statusCode': 400,
+            'body': json.dumps({'error': 'Invalid customer_id'})
+        }
+
+    try:
+        # Không có customer_id thì tra cứu song song trên mọi shard
+        shards = [shard_for_customer(stored_customer_id)] if customer_id else all_shards()
+        results = scatter(lambda shard: fetch_order(shard, stored_order_id, order_date), shards)
+        column_names, rows = next((result for result in results if result[1]), results[0])
+
+        if not rows:
+            try:
+                # ETag của bản ghi trước khi bị xóa không được khớp với tombstone
+                pipe = primary_cache.pipeline(transaction=False)
+                pipe.setex(cache_key, NEGATIVE_CACHE_TTL, NEGATIVE_CACHE_MARKER)
+                pipe.delete(f"{cache_key}:etag")
+                pipe.execute()
+            except redis.RedisError as e:
+                logger.error(f"Valkey error (primary): {e}")
             return {
                 'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
                 'statusCode': 404,
                 'body': json.dumps({'error': 'Order not found'})
             }
 
+        order_json = encode_row(column_names, rows[0])
+
         try:
-            primary_cache.setex(cache_key, 60, json.dumps(order, default=str))
+            fill_cache(cache_key, ttl, order_json)
         except redis.RedisError as e:
             logger.error(f"Valkey error (primary): {e}")
 
         latency_ms = (time.time() - start_time) * 1000
         logger.info(f"Cache miss, query latency: {latency_ms:.2f} ms")
 
-        cursor.close()
-        conn.close()
-
-        return {
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'statusCode': 200,
-            'body': json.dumps({'order': order, 'latency_ms': latency_ms}, default=str)
-        }
+        return json_response(f'{{"order": {order_json}, "latency_ms": {json.dumps(latency_ms)}}}', encoding)
     except mysql.connector.Error as e:
         logger.error(f"Database error: {e}")
+        close_pooled_connection()
         return {
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
             'statusCode': 500,
             'body': json.dumps({'error': f'Database error: {e}'})
         }
+
+def benchmark_statements(order_id, order_date, iterations):
+    """Compare text-protocol and prepared execution of the get_order SELECT on one connection."""
+    stored_order_id = encode_id(order_id)
+    conn = None
+    try:
+        conn = get_db_connection()
+        results = {}
+        for mode in ('text', 'prepared'):
+            cursor = conn.cursor(prepared=(mode == 'prepared'))
+            # Lần chạy đầu (prepare) không tính vào thời gian
+            cursor.execute(SELECT_ORDER_SQL, (stored_order_id, order_date))
+            cursor.fetchall()
+            start = time.perf_counter()
+            for _ in range(iterations):
+                cursor.execute(SELECT_ORDER_SQL, (stored_order_id, order_date))
+                cursor.fetchall()
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            cursor.close()
+            results[mode] = {'total_ms': round(elapsed_ms, 2), 'avg_ms': round(elapsed_ms / iterations, 3)}
+        logger.info(f"Statement benchmark ({iterations} iterations): {results}")
+        return {'status': 'completed', 'iterations': iterations, 'results': results}
+    except mysql.connector.Error as e:
+        logger.error(f"Database error during statement benchmark: {e}")
+        return {'status': 'failed', 'reason': f'Database error: {e}'}
     finally:
         if conn and conn.is_connected():
             conn.close()
             logger.info("Database connection closed")
 
+def report_hot_keys():
+    """Report the hot keys of the last complete window and the leaders of the current one."""
+    return {
+        'status': 'completed',
+        'window_seconds': HOT_KEY_WINDOW_SECONDS,
+        'sample_rate': HOT_KEY_SAMPLE_RATE,
+        'hot_keys': [{'key': key, 'estimated_reads': reads} for key, reads in load_hot_keys(1)],
+        'current_window': [{'key': key, 'estimated_reads': reads} for key, reads in load_hot_keys(0)],
+    }
+
+def top_slow_queries(limit=10):
+    """Aggregate the slow-query ring buffer by SQL shape, slowest total time first."""
+    entries = [json.loads(entry) for entry in primary_cache.lrange(SLOW_QUERY_KEY, 0, -1)]
+    shapes = {}
+    for entry in entries:
+        key = (entry['fingerprint'], tuple(entry['param_shape']))
+        shape = shapes.setdefault(key, {
+            'fingerprint': entry['fingerprint'],
+            'operation': entry['operation'],
+            'sql': entry['sql'],
+            'param_shape': entry['param_shape'],
+            'count': 0,
+            'total_ms': 0,
+            'max_ms': 0,
+            'max_rows': 0,
+            'last_seen': entry['recorded_at'],
+        })
+        shape['count'] += 1
+        shape['total_ms'] += entry['duration_ms']
+        shape['max_ms'] = max(shape['max_ms'], entry['duration_ms'])
+        shape['max_rows'] = max(shape['max_rows'], entry['rows'])
+        # Ring buffer lưu mới nhất trước, nên kế hoạch đầu tiên gặp là kế hoạch gần nhất
+        if 'plan' in entry and 'plan' not in shape:
+            shape['plan'] = entry['plan']
+
+    ranked = sorted(shapes.values(), key=lambda shape: shape['total_ms'], reverse=True)[:limit]
+    for shape in ranked:
+        shape['avg_ms'] = round(shape['total_ms'] / shape['count'], 2)
+        shape['total_ms'] = round(shape['total_ms'], 2)
+    return {'status': 'completed', 'samples': len(entries), 'shapes': ranked}
+
 def lambda_handler(event, context):
     logger.info(f"Received event: {json.dumps(event, default=str)}")
     try:
+        if event.get('action') == 'benchmark_statements':
+            return benchmark_statements(event['order_id'], event['order_date'], int(event.get('iterations', 200)))
+        if event.get('action') == 'rebuild_order_bloom':
+            return rebuild_order_bloom(bool(event.get('reset', False)))
+        if event.get('action') == 'slow_queries':
+            return top_slow_queries(int(event.get('limit', 10)))
+        if event.get('action') == 'hot_keys':
+            return report_hot_keys()
+
         http_method = event.get('httpMethod', '')
         query_params = event.get('queryStringParameters', {}) or {}
-        body = {} if event.get('body') is None else json.loads(event.get('body', '{}'))
+        raw_body = request_body(event)
+        body = {} if raw_body is None else json.loads(raw_body)
+        encoding = negotiate_encoding(event.get('headers'))
+        if_none_match = request_header(event, 'if-none-match')
 
         if query_params.get('order_id') and query_params.get('order_date'):
-            return get_order(query_params.get('order_id'), query_params.get('order_date'))
+            return get_order(
+                query_params.get('order_id'), query_params.get('order_date'), query_params.get('customer_id'),
+                encoding, if_none_match
+            )
+        elif query_params.get('address'):
+            try:
+                page = int(query_params.get('page', 1))
+                page_size = int(query_params.get('page_size', 20))
+            except ValueError:
+                return {
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'statusCode': 400,
+                    'body': json.dumps({'error': 'page and page_size must be integers'})
+                }
+            return search_orders(query_params['address'], page, page_size, encoding, if_none_match)
         else:
             customer_id = query_params.get('customer_id') or body.get('customer_id')
             status = query_params.get('status') or body.get('status')
             start_date = query_params.get('start_date') or body.get('start_date')
             end_date = query_params.get('end_date') or body.get('end_date')
-            return filter_orders(customer_id, status, start_date, end_date)
+            columnar = (query_params.get('format') or body.get('format')) == 'columnar'
+            return filter_orders(customer_id, status, start_date, end_date, columnar, encoding, if_none_match)
     except Exception as e:
         logger.error(f"Unexpected error in lambda_handler: {str(e)}", exc_info=True)
         return {
@@ -0,0 +1,517 @@
+import json
+import mysql.connector
+import os
+import logging
+import time
+import re
+import uuid
+from datetime import datetime
+import boto3
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger()
+
+# Sharding theo customer_id: SHARD_BACKENDS (JSON) liệt kê các backend MySQL, mỗi phần tử gồm
+# host, port, database, user và password (bỏ trống password để dùng IAM token qua RDS Proxy).
+# Không đặt biến này thì chỉ có một backend là PROXY_ENDPOINT như trước.
+SHARD_SLOTS = int(os.environ.get('SHARD_SLOTS', 1024))
+
+
+def load_shard_backends():
+    spec = os.environ.get('SHARD_BACKENDS')
+    if spec:
+        return json.loads(spec)
+    return [{
+        'host': os.environ.get('PROXY_ENDPOINT'),
+        'port': 3306,
+        'database': os.environ.get('DB_NAME'),
+        'user': os.environ.get('DB_USER'),
+    }]
+
+
+SHARD_BACKENDS = load_shard_backends()
+
+# Token IAM được cache theo từng host
+cached_tokens = {}
+
+def get_db_token(backend):
+    current_time = time.time()
+
+    # Kiểm tra nếu token còn hợp lệ (giả sử TTL là 840 giây để có buffer 60 giây trước khi hết hạn)
+    cached_token, token_expiry = cached_tokens.get(backend['host'], (None, 0))
+    if cached_token and current_time < token_expiry:
+        return cached_token
+
+    # Tạo token mới
+    rds_client = boto3.client('rds')
+    cached_token = rds_client.generate_db_auth_token(
+        DBHostname=backend['host'],
+        Port=backend.get('port', 3306),
+        DBUsername=backend['user'],
+        Region=os.environ['AWS_REGION']
+    )
+    # Cập nhật thời gian hết hạn (15 phút = 900 giây, trừ 60 giây để an toàn)
+    cached_tokens[backend['host']] = (cached_token, current_time + 840)
+    return cached_token
+
+
+def get_db_connection(shard=0):
+    """Establish a MySQL database connection to one shard backend (RDS Proxy by default)."""
+    try:
+        backend = SHARD_BACKENDS[shard]
+        return mysql.connector.connect(
+            host=backend['host'],
+            port=backend.get('port', 3306),
+            user=backend['user'],
+            password=backend.get('password') or get_db_token(backend),
+            database=backend['database'],
+            connection_timeout=10
+        )
+    except mysql.connector.Error as e:
+        logger.error(f"Database connection error (shard {shard}): {e}")
+        raise
+    except Exception as e:
+        logger.error(f"Error creating database connection (shard {shard}): {str(e)}")
+        raise
+
+# Bảng shard_map trên shard 0 ghi lại các khoảng slot đã được chuyển bằng reshard-orders (bản ghi
+# sau ghi đè bản ghi trước); slot không có trong bảng thuộc về shard theo cách chia đều mặc định.
+SELECT_SHARD_MAP_SQL = "SELECT slot_start, slot_end, shard FROM shard_map ORDER BY id"
+ER_NO_SUCH_TABLE = 1146
+
+
+def default_shard_map():
+    return [slot * len(SHARD_BACKENDS) // SHARD_SLOTS for slot in range(SHARD_SLOTS)]
+
+
+def load_shard_map(conn):
+    """Read the slot -> shard list from the shard_map table on shard 0."""
+    slots = default_shard_map()
+    cursor = conn.cursor()
+    try:
+        cursor.execute(SELECT_SHARD_MAP_SQL)
+        for slot_start, slot_end, shard in cursor.fetchall():
+            slots[slot_start:slot_end + 1] = [shard] * (slot_end - slot_start + 1)
+        # Kết thúc snapshot đọc: nếu không, lần tải sau trên cùng kết nối vẫn thấy map cũ
+        conn.commit()
+    except mysql.connector.Error as e:
+        if e.errno != ER_NO_SUCH_TABLE:
+            raise
+    finally:
+        cursor.close()
+    return slots
+
+# Chỉ mục địa chỉ giao hàng: FULLTEXT không dùng được trên bảng partition, nên mỗi từ của
+# shipping_address được lưu vào order_address_tokens (tạo bởi create-table) trong cùng transaction với đơn hàng.
+ADDRESS_TOKEN_MAX_LENGTH = 32
+ADDRESS_TOKEN_PATTERN = re.compile(r'[^\W_]+')
+INSERT_ADDRESS_TOKENS_SQL = "INSERT IGNORE INTO order_address_tokens (token, order_id, order_date) VALUES (%s, %s, %s)"
+DELETE_ADDRESS_TOKENS_SQL = "DELETE FROM order_address_tokens WHERE order_id = %s AND order_date = %s"
+
+
+def address_tokens(address):
+    """Split a shipping address into distinct lowercase word tokens of at least 2 characters."""
+    return sorted({
+        token[:ADDRESS_TOKEN_MAX_LENGTH] for token in ADDRESS_TOKEN_PATTERN.findall(str(address).lower()) if len(token) >= 2
+    })
+
+
+def write_address_tokens(conn, orders, replace=False):
+    """Index (stored_order_id, order_date, shipping_address) tuples in conn's open transaction.
+
+    replace=True first drops the orders' existing tokens (pass an empty address to only delete).
+    A missing token table only logs a warning so writes keep working before create-table has run.
+    """
+    cursor = conn.cursor()
+    try:
+        if replace:
+            cursor.executemany(DELETE_ADDRESS_TOKENS_SQL, [(order_id, order_date) for order_id, order_date, _ in orders])
+        rows = [
+            (token, order_id, order_date)
+            for order_id, order_date, address in orders for token in address_tokens(address)
+        ]
+        if rows:
+            cursor.executemany(INSERT_ADDRESS_TOKENS_SQL, rows)
+    except mysql.connector.Error as e:
+        if e.errno != ER_NO_SUCH_TABLE:
+            raise
+        logger.warning("Table order_address_tokens is missing, run create-table to enable address search")
+    finally:
+        cursor.close()
+
+SHARD_MAP_REFRESH_SECONDS = int(os.environ.get('SHARD_MAP_REFRESH_SECONDS', 30))
+RESHARD_BATCH_SIZE = int(os.environ.get('RESHARD_BATCH_SIZE', 1000))
+RESHARD_TIME_MARGIN_MS = int(os.environ.get('RESHARD_TIME_MARGIN_MS', 15000))
+RESHARD_PHASES = ('copy', 'flip', 'catchup', 'cleanup', 'all')
+
+# Định dạng lưu order_id/customer_id: 'uuid' (VARCHAR(36)) hoặc 'binary' (BINARY(16))
+ORDER_ID_FORMAT = os.environ.get('ORDER_ID_FORMAT', 'uuid')
+
+
+def encode_id(value):
+    """Convert an API string ID to its storage form; raises ValueError for malformed IDs in binary mode."""
+    if ORDER_ID_FORMAT == 'binary':
+        return uuid.UUID(value).bytes
+    return value
+
+
+def decode_id(value):
+    """Convert a stored ID back to its canonical string form."""
+    if isinstance(value, (bytes, bytearray)):
+        return str(uuid.UUID(bytes=bytes(value)))
+    return value
+
+# Slot tính trong SQL phải khớp shard_slot() của các Lambda khác: CRC32 trên byte lưu trữ, UUID dạng chuỗi viết thường
+if ORDER_ID_FORMAT == 'binary':
+    SLOT_CONDITION = "MOD(CRC32(customer_id), %s) BETWEEN %s AND %s"
+else:
+    SLOT_CONDITION = "MOD(CRC32(LOWER(customer_id)), %s) BETWEEN %s AND %s"
+
+ORDER_COLUMNS = ('order_id', 'customer_id', 'order_date', 'total_amount', 'status',
+                 'shipping_address', 'created_at', 'updated_at')
+
+# Chỉ ghi đè khi bản nguồn mới hơn, để catch-up không đè lên thay đổi đã ghi vào shard đích sau khi flip.
+# updated_at phải được gán sau cùng vì MySQL tính các phép gán từ trái sang phải.
+def build_upsert_sql(table):
+    return (
+        f"INSERT INTO {table} ({', '.join(ORDER_COLUMNS)}) VALUES ({', '.join(['%s'] * len(ORDER_COLUMNS))}) "
+        "ON DUPLICATE KEY UPDATE "
+        + ', '.join(
+            f"{column} = IF(VALUES(updated_at) > updated_at, VALUES({column}), {column})"
+            for column in ORDER_COLUMNS if column not in ('order_id', 'order_date')
+        )
+    )
+
+
+# Partition cũ được create-table chuyển sang orders_archive; các khoảng ngày đã lưu trữ nằm trong
+# orders_archive_ranges của từng shard. Slot được chuyển cùng với các đơn hàng đã lưu trữ của nó.
+ARCHIVE_TABLE = 'orders_archive'
+SELECT_ARCHIVE_RANGES_SQL = "SELECT range_start, range_end, status FROM orders_archive_ranges"
+UPSERT_ORDERS_SQL = build_upsert_sql('orders')
+UPSERT_ARCHIVE_SQL = build_upsert_sql(ARCHIVE_TABLE)
+INSERT_SHARD_MAP_SQL = "INSERT INTO shard_map (slot_start, slot_end, shard) VALUES (%s, %s, %s)"
+
+
+def shard_ranges(slots):
+    """Collapse the slot -> shard list into contiguous {slot_start, slot_end, shard} ranges."""
+    ranges = []
+    for slot, shard in enumerate(slots):
+        if ranges and ranges[-1]['shard'] == shard:
+            ranges[-1]['slot_end'] = slot
+        else:
+            ranges.append({'slot_start': slot, 'slot_end': slot, 'shard': shard})
+    return ranges
+
+
+def shard_status():
+    conn = None
+    try:
+        conn = get_db_connection(0)
+        slots = load_shard_map(conn)
+        return {
+            'status': 'ok',
+            'slots': SHARD_SLOTS,
+            'backends': [{'shard': shard, 'host': backend['host']} for shard, backend in enumerate(SHARD_BACKENDS)],
+            'slots_per_shard': {str(shard): slots.count(shard) for shard in range(len(SHARD_BACKENDS))},
+            'ranges': shard_ranges(slots)
+        }
+    finally:
+        if conn and conn.is_connected():
+            conn.close()
+
+
+def load_archive_ranges(conn):
+    """Return the shard's [(range_start, range_end, status)] archive ranges, empty before the first archive run."""
+    cursor = conn.cursor()
+    try:
+        cursor.execute(SELECT_ARCHIVE_RANGES_SQL)
+        ranges = [tuple(row) for row in cursor.fetchall()]
+        conn.commit()
+        return ranges
+    except mysql.connector.Error as e:
+        if e.errno != ER_NO_SUCH_TABLE:
+            raise
+        return []
+    finally:
+        cursor.close()
+
+
+def in_archived_range(ranges, order_date):
+    day = order_date.date() if isinstance(order_date, datetime) else order_date
+    return any(status == 'archived' and range_start <= day < range_end for range_start, range_end, status in ranges)
+
+
+def count_slot_rows(conn, slot_start, slot_end, tables=('orders',)):
+    cursor = conn.cursor()
+    try:
+        count = 0
+        for table in tables:
+            cursor.execute(f"SELECT COUNT(*) FROM {table} WHERE {SLOT_CONDITION}", (SHARD_SLOTS, slot_start, slot_end))
+            count += cursor.fetchone()[0]
+        return count
+    finally:
+        cursor.close()
+
+
+def copy_slots(source_conn, target_conn, slot_start, slot_end, batch_size, since=None, after=None, context=None,
+               table='orders', target_ranges=()):
+    """Copy the rows of a slot range from source to target in primary-key order.
+
+    Returns (copied, last_key); last_key is None when the range is exhausted, otherwise the
+    key to pass back as 'after' because the Lambda ran out of time. Copies are idempotent.
+    Rows of orders_archive go to the target's orders_archive when the target has archived their
+    date range, otherwise to its hot table, where the target's own archive run picks them up.
+    """
+    sql = f"SELECT {', '.join(ORDER_COLUMNS)} FROM {table} WHERE {SLOT_CONDITION}"
+    base_params = [SHARD_SLOTS, slot_start, slot_end]
+    if since:
+        sql += " AND updated_at >= %s"
+        base_params.append(since)
+    copied = 0
+    read_cursor = source_conn.cursor()
+    write_cursor = target_conn.cursor()
+    try:
+        while True:
+            if context and context.get_remaining_time_in_millis() < RESHARD_TIME_MARGIN_MS:
+                logger.info(f"Stopping copy before timeout after {copied} rows, resume after {after}")
+                return copied, after
+            page_sql, params = sql, list(base_params)
+            if after:
+                page_sql += " AND (order_id, order_date) > (%s, %s)"
+                params += [after[0], after[1]]
+            read_cursor.execute(page_sql + " ORDER BY order_id, order_date LIMIT %s", params + [batch_size])
+            rows = read_cursor.fetchall()
+            # Đọc trong snapshot mới ở mỗi trang thay vì giữ một transaction dài trên shard nguồn
+            source_conn.commit()
+            if not rows:
+                return copied, None
+            hot_rows = rows
+            if table == ARCHIVE_TABLE:
+                archived_rows = [row for row in rows if in_archived_range(target_ranges, row[2])]
+                hot_rows = [row for row in rows if not in_archived_range(target_ranges, row[2])]
+                if archived_rows:
+                    write_cursor.executemany(UPSERT_ARCHIVE_SQL, archived_rows)
+            if hot_rows:
+                write_cursor.executemany(UPSERT_ORDERS_SQL, hot_rows)
+                # Upsert giữ bản mới hơn đã có ở shard đích: token được dựng lại từ dòng đang lưu ở đó
+                keys = [value for row in hot_rows for value in (row[0], row[2])]
+                write_cursor.execute(
+                    "SELECT order_id, order_date, shipping_address FROM orders WHERE (order_id, order_date) IN ("
+                    + ', '.join(['(%s, %s)'] * len(hot_rows)) + ")",
+                    keys
+                )
+                write_address_tokens(target_conn, write_cursor.fetchall(), replace=True)
+            target_conn.commit()
+            copied += len(rows)
+            after = (rows[-1][0], rows[-1][2])
+    finally:
+        read_cursor.close()
+        write_cursor.close()
+
+
+def copy_slot_tables(source_conn, target_conn, slot_start, slot_end, batch_size, tables, target_ranges,
+                     since=None, after=None, context=None):
+    """Copy a slot range from each table in turn; returns (copied, resume), resume None when done.
+
+    after and resume are {'table', 'order_id', 'order_date'}, so a resumed call skips finished tables.
+    """
+    copied = 0
+    after_table = after.get('table', 'orders') if after else None
+    for table in tables[tables.index(after_table) if after_table in tables else 0:]:
+        last_key = (encode_id(after['order_id']), after['order_date']) if table == after_table else None
+        count, last_key = copy_slots(source_conn, target_conn, slot_start, slot_end, batch_size, since=since,
+                                     after=last_key, context=context, table=table, target_ranges=target_ranges)
+        copied += count
+        if last_key:
+            return copied, {'table': table, 'order_id': decode_id(last_key[0]), 'order_date': str(last_key[1])}
+    return copied, None
+
+
+def delete_slots(conn, slot_start, slot_end, batch_size, before, context=None, table='orders'):
+    """Delete the rows of a slot range last updated before `before`, with their address tokens, in batches.
+
+    Rows written later (by a Lambda still using the old map) are kept so they can be copied first.
+    Archived orders have no address tokens. Returns (deleted, finished).
+    """
+    deleted = 0
+    cursor = conn.cursor()
+    try:
+        while True:
+            if context and context.get_remaining_time_in_millis() < RESHARD_TIME_MARGIN_MS:
+                return deleted, False
+            cursor.execute(f"SELECT order_id, order_date FROM {table} WHERE {SLOT_CONDITION} AND updated_at < %s LIMIT %s",
+                           (SHARD_SLOTS, slot_start, slot_end, before, batch_size))
+            keys = cursor.fetchall()
+            if keys:
+                if table == 'orders':
+                    write_address_tokens(conn, [(order_id, order_date, '') for order_id, order_date in keys], replace=True)
+                cursor.executemany(f"DELETE FROM {table} WHERE order_id = %s AND order_date = %s", keys)
+            conn.commit()
+            deleted += len(keys)
+            if len(keys) < batch_size:
+                return deleted, True
+    finally:
+        cursor.close()
+
+
+def flip_slots(conn, slot_start, slot_end, target):
+    """Point the slot range at the target shard and wait until every Lambda has reloaded the map."""
+    cursor = conn.cursor()
+    try:
+        cursor.execute(INSERT_SHARD_MAP_SQL, (slot_start, slot_end, target))
+        conn.commit()
+    finally:
+        cursor.close()
+    # crud/query đọc lại shard map sau tối đa SHARD_MAP_REFRESH_SECONDS; chờ thêm vài giây cho request đang chạy
+    wait_seconds = SHARD_MAP_REFRESH_SECONDS + 5
+    logger.info(f"Slots {slot_start}-{slot_end} now map to shard {target}, waiting {wait_seconds}s for map refresh")
+    time.sleep(wait_seconds)
+
+
+def database_now(conn):
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT NOW()")
+        return str(cursor.fetchone()[0])
+    finally:
+        cursor.close()
+
+
+def move_slots(body, context=None):
+    """Move a slot range to another shard: copy, flip the map, copy rows changed meanwhile, delete from source.
+
+    Phases can be run one at a time ('copy', 'flip', 'catchup', 'cleanup') or together ('all').
+    The copy phase returns 'copy_started_at', which catch-up needs to find rows changed during
+    the copy; catch-up returns 'catchup_started_at' for cleanup. Cleanup copies rows written to
+    the source since then one last time and only deletes rows older than that final pass; rows
+    written to the source afterwards are reported as 'late_rows' and cleanup must be re-run.
+    Archived orders of the slots move in the same passes (see copy_slots). Orders deleted on the
+    source between copy and flip are not propagated.
+    """
+    slot_start = int(body['slot_start'])
+    slot_end = int(body['slot_end'])
+    target = int(body['target'])
+    batch_size = int(body.get('batch_size', RESHARD_BATCH_SIZE))
+    phase = body.get('phase', 'all')
+    dry_run = bool(body.get('dry_run', False))
+    if not 0 <= slot_start <= slot_end < SHARD_SLOTS:
+        return {'status': 'failed', 'reason': f'Slot range must be within 0-{SHARD_SLOTS - 1}'}
+    if not 0 <= target < len(SHARD_BACKENDS):
+        return {'status': 'failed', 'reason': f'Unknown target shard {target}'}
+    if phase not in RESHARD_PHASES:
+        return {'status': 'failed', 'reason': f"Unknown phase '{phase}', expected one of {list(RESHARD_PHASES)}"}
+
+    conns = {}
+    try:
+        conns[0] = get_db_connection(0)
+        slots = load_shard_map(conns[0])
+        if 'source' in body:
+            source = int(body['source'])
+        else:
+            # Sau khi flip, map đã trỏ sang shard đích nên các phase sau cần 'source' truyền vào
+            owners = set(slots[slot_start:slot_end + 1])
+            if len(owners) != 1:
+                return {'status': 'failed', 'reason': f'Slots {slot_start}-{slot_end} span shards {sorted(owners)}, move them separately'}
+            source = owners.pop()
+        if source == target:
+            return {'status': 'failed', 'reason': f'Slots {slot_start}-{slot_end} already belong to shard {target}'}
+        for shard in (source, target):
+            if shard not in conns:
+                conns[shard] = get_db_connection(shard)
+
+        result = {'slot_start': slot_start, 'slot_end': slot_end, 'source': source, 'target': target, 'phase': phase}
+        source_ranges = load_archive_ranges(conns[source])
+        tables = ('orders', ARCHIVE_TABLE) if source_ranges else ('orders',)
+        if dry_run:
+            result.update({'status': 'dry_run', 'rows': count_slot_rows(conns[source], slot_start, slot_end, tables)})
+            return result
+        target_ranges = load_archive_ranges(conns[target]) if source_ranges else []
+        # Partition đang lưu trữ dở có đơn hàng ở cả hai bảng và bảng staging: chờ lần archive đó xong
+        if any(status != 'archived' for _, _, status in source_ranges + target_ranges):
+            return {'status': 'failed', 'reason': f'Shard {source} or {target} is archiving a partition, finish the archive run first'}
+
+        after = body.get('after')
+
+        if phase in ('copy', 'all'):
+            result['copy_started_at'] = body.get('copy_started_at') or database_now(conns[source])
+            copied, resume = copy_slot_tables(conns[source], conns[target], slot_start, slot_end, batch_size,
+                                              tables, target_ranges, after=after, context=context)
+            result['copied'] = copied
+            if resume:
+                result.update({'status': 'in_progress', 'after': resume})
+                return result
+            after = None
+
+        if phase in ('flip', 'all'):
+            flip_slots(conns[0], slot_start, slot_end, target)
+            result['flipped'] = True
+
+        if phase in ('catchup', 'all'):
+            since = result.get('copy_started_at') or body.get('copy_started_at')
+            if not since:
+                return {'status': 'failed', 'reason': "Phase 'catchup' needs 'copy_started_at' from the copy phase"}
+            result['catchup_started_at'] = body.get('catchup_started_at') or database_now(conns[source])
+            caught_up, resume = copy_slot_tables(conns[source], conns[target], slot_start, slot_end, batch_size,
+                                                 tables, target_ranges, since=since, after=after, context=context)
+            result['caught_up'] = caught_up
+            if resume:
+                result.update({'status': 'in_progress', 'after': resume})
+                return result
+            after = None
+
+        if phase in ('cleanup', 'all'):
+            # Không xóa khỏi shard nguồn khi map vẫn trỏ vào nó
+            if phase == 'cleanup' and any(shard != target for shard in load_shard_map(conns[0])[slot_start:slot_end + 1]):
+                return {'status': 'failed', 'reason': f'Slots {slot_start}-{slot_end} are not mapped to shard {target} yet'}
+            since = result.get('catchup_started_at') or body.get('catchup_started_at')
+            if not since:
+                return {'status': 'failed', 'reason': "Phase 'cleanup' needs 'catchup_started_at' from the catchup phase"}
+            # Lambda còn giữ map cũ có thể vẫn ghi vào shard nguồn sau catch-up: copy lần cuối
+            # những dòng đó rồi mới xóa, và chỉ xóa các dòng cũ hơn lần copy cuối này
+            cutoff = database_now(conns[source])
+            late_copied, resume = copy_slot_tables(conns[source], conns[target], slot_start, slot_end, batch_size,
+                                                   tables, target_ranges, since=since, after=after, context=context)
+            result['late_copied'] = late_copied
+            if resume:
+                result.update({'status': 'in_progress', 'catchup_started_at': since, 'after': resume})
+                return result
+            result['deleted'] = 0
+            for table in tables:
+                deleted, finished = delete_slots(conns[source], slot_start, slot_end, batch_size, cutoff, context, table)
+                result['deleted'] += deleted
+                if not finished:
+                    result.update({'status': 'in_progress', 'catchup_started_at': since})
+                    return result
+            late_rows = count_slot_rows(conns[source], slot_start, slot_end, tables)
+            if late_rows:
+                logger.warning(f"{late_rows} rows were written to shard {source} after the final copy, re-run cleanup")
+                result.update({'status': 'in_progress', 'late_rows': late_rows, 'catchup_started_at': cutoff})
+                return result
+
+        result['status'] = 'completed'
+        logger.info(f"Reshard {phase} for slots {slot_start}-{slot_end} ({source} -> {target}) completed: {result}")
+        return result
+    finally:
+        for conn in conns.values():
+            if conn.is_connected():
+                conn.close()
+                logger.info("Database connection closed")
+
+def lambda_handler(event, context):
+    logger.info(f"Received event: {json.dumps(event, default=str)}")
+    try:
+        action = event.get('action', 'status')
+        if action == 'status':
+            return shard_status()
+        elif action == 'move':
+            return move_slots(event, context)
+        else:
+            return {'status': 'failed', 'reason': f'Unknown action {action}'}
+    except (KeyError, ValueError) as e:
+        logger.error(f"Invalid reshard request: {e}")
+        return {'status': 'failed', 'reason': f'Invalid request: {e}'}
+    except mysql.connector.Error as e:
+        logger.error(f"Database error during reshard: {e}")
+        return {'status': 'failed', 'reason': f'Database error: {e}'}
+    except Exception as e:
+        logger.error(f"Unexpected error in lambda_handler: {str(e)}", exc_info=True)
+        return {'status': 'failed', 'reason': f'Internal server error: {str(e)}'}